@@ -1,79 +1,121 @@
 """add_scan_profiles.py: create one or more scan profiles in a given Detectify team
 
-This version of the script DOES NOT avoid creating duplicate scan profiles. Please check your list of domains before
-running this script!
+The existing scan profiles are listed once before anything is created, and domains that already have a scan profile,
+or that appear more than once in the input, are skipped. Re-running the script on the same list of domains therefore
+only creates the scan profiles that are still missing.
 
 The API key permissions required by this script are the following:
 - Allow creating scan profiles
+- Allow listing scan profiles
 - Allow listing domains
 
-Usage: add_scan_profiles.py [-h] [-d [DOMAIN [DOMAIN ...]]] [-f FILE] key
+Usage: add_scan_profiles.py [-h] [-d [DOMAIN [DOMAIN ...]]] [-f FILE] [-w WORKERS]
+                            [--no-cache] [--refresh]
+                            key
 """
 
 import argparse
 import json
+import os
+import sys
 import requests
 
-API_BASE_URL = 'https://api.detectify.com/rest'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
 
+from detectify import API_BASE_URL, daemon, metrics, ratelimit, timeouts  # noqa: E402
+from detectify.bulk import pooled_session, run_bulk  # noqa: E402
+from detectify.concurrency import DEFAULT_CONCURRENCY  # noqa: E402
+from detectify.daemon import RemoteInventory  # noqa: E402
+from detectify.domains import iter_domains  # noqa: E402
+from detectify.inventory import AssetInventory  # noqa: E402
+from detectify.pagination import iter_assets  # noqa: E402
+from detectify.roots import RootIndex  # noqa: E402
+from detectify.store import AssetStore  # noqa: E402
 
-def create_scan_profile(assets: dict, asset_name: str, key: str) -> None:
+
+def create_scan_profile(asset_token: str, asset_name: str, key: str,
+                        session: requests.Session = None) -> requests.Response:
     """Create an Application Scan profile for a given domain
 
-    :param assets: A dictionary of assets and tokens
-    :param asset_name: The name of the asset associated with the given token
+    :param asset_token: The token of the root asset the domain belongs to
+    :param asset_name: The name of the domain to create a scan profile for
     :param key: A valid Detectify API key
+    :param session: An optional session to reuse connections between calls
+    :return: The API response
     """
     api_endpoint = '/v2/profiles/'
-    asset_token = get_root_asset_token(assets, asset_name)
-    if not asset_token:
-        return  # If asset_token is not found, skip
     payload = json.dumps({'asset_token': asset_token,
                           'endpoint': asset_name})
-    r = requests.post(url=f'{API_BASE_URL}{api_endpoint}',
-                      headers={'X-Detectify-Key': key,
-                               'content-type': 'application/json'},
-                      data=payload)
+    r = (session or requests).post(url=f'{API_BASE_URL}{api_endpoint}',
+                                   headers={'X-Detectify-Key': key,
+                                            'content-type': 'application/json'},
+                                   data=payload)
     print(f'Added scan profile for {asset_name} with code {r.status_code}: {r.reason}')
+    return r
 
 
-def get_root_asset_token(assets: dict, asset_name: str) -> str:
+def get_root_asset_token(assets: RootIndex, asset_name: str) -> str:
     """Look up the asset token associated with the root asset given a domain in Detectify
 
-    :param assets: A dictionary of assets and tokens
+    :param assets: An index of root asset names and tokens
     :param asset_name: The name of the asset to look up the root asset token for
     :return: A root asset token
     """
-    # For each named root asset, check to see if it is a substring of the provided asset name, and return the first
-    try:
-        return assets[[root_asset for root_asset in assets if root_asset in asset_name][0]]
-    except IndexError:
+    # Resolve to the longest registered root asset that the provided asset name is a subdomain of
+    root_asset = assets.resolve(asset_name)
+    if root_asset is None:
         print(f'{asset_name} is not associated with any assets. Skipping.')
+        return None
+    return root_asset[1]
+
+
+def profile_key(endpoint: str) -> str:
+    """Normalise a scan profile endpoint, so that a domain matches the profile created for it
+
+    :param endpoint: The endpoint of a scan profile, or a domain name
+    :return: The lowercase endpoint without scheme or trailing slash
+    """
+    endpoint = endpoint.strip().lower()
+    if '://' in endpoint:
+        endpoint = endpoint.split('://', 1)[1]
+    host, _, path = endpoint.partition('/')
+    path = path.rstrip('/')
+    return host.rstrip('.') + (f'/{path}' if path else '')
+
+
+def get_profile_endpoints(key: str) -> set:
+    """Get the endpoints of every scan profile in a given Detectify team
 
+    The list is always fetched from the API, as a stale copy could let a duplicate through.
 
-def get_assets(key: str) -> dict:
+    :param key: A valid Detectify API key
+    :return: A set of normalised endpoints, as returned by profile_key
+    """
+    print('Querying list of scan profiles...')
+    api_endpoint = '/v2/profiles/'
+    r = requests.get(url=f'{API_BASE_URL}{api_endpoint}',
+                     headers={'X-Detectify-Key': key,
+                              'content-type': 'application/json'})
+    r.raise_for_status()
+    return {profile_key(profile.get('endpoint') or profile.get('name') or '') for profile in r.json()}
+
+
+def get_assets(key: str, use_cache: bool = True, refresh: bool = False) -> dict:
     """Get the full list of apex domains and subdomains from Detectify for later filtering
 
     :param key: A valid Detectify API key
-    :return: A dictionary of assets and tokens
+    :param use_cache: Answer lookups from the inventory daemon or local asset inventory instead of enumerating assets
+    :param refresh: Force the local asset inventory to be refreshed before use
+    :return: A dictionary-like mapping of asset names to tokens
     """
+    if use_cache:
+        client = daemon.connect(key)
+        inventory = client.inventory() if client else AssetInventory(key)
+        if refresh:
+            inventory.refresh()
+        return inventory
     print('Querying assets. . .')
-    all_assets = {}
-    marker = ''
-    has_more = True
-    while has_more:
-        api_endpoint = f'/v2/assets/'
-        r = requests.get(url=f'{API_BASE_URL}{api_endpoint}?marker={marker}',
-                         headers={'X-Detectify-Key': key,
-                                  'content-type': 'application/json'})
-        for asset in r.json()['assets']:
-            all_assets[asset['name']] = asset['token']
-        try:
-            marker = r.json()['next_marker']
-        except KeyError:  # next_marker may not exist when has_more is False
-            pass
-        has_more = r.json()['has_more']
-    return all_assets
+    return AssetStore.from_assets(iter_assets(key))
 
 
 def main():
@@ -82,21 +124,54 @@ def main():
     parser.add_argument('-d', '--domain', type=str, nargs='*',
                         help='one or more domains for Application Scan')
     parser.add_argument('-f', '--file', type=str,
-                        help='a file containing a list of domains')
+                        help='a file containing a list of domains, or - for standard input')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_CONCURRENCY,
+                        help=f'number of scan profiles to create at once (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='enumerate assets from the API instead of using the local asset inventory')
+    parser.add_argument('--refresh', action='store_true',
+                        help='refresh the local asset inventory before use')
+    metrics.add_arguments(parser)
+    ratelimit.add_arguments(parser)
+    timeouts.add_arguments(parser)
     args = parser.parse_args()
+    metrics.start(args, 'add_scan_profiles')
+    ratelimit.start(args)
+    timeouts.start(args)
     if not (args.domain or args.file):
         parser.error('No domains specified. Use at least one of flag -d or -f.')
-    assets = get_assets(args.key)   # Must get full list of assets to convert names to tokens
-    print(f'Retrieved {len(assets)} assets')
-
-    if args.domain:
-        for domain in args.domain:
-            create_scan_profile(assets, domain, args.key)
-
-    if args.file:
-        with open(args.domain_file) as domains_to_delete:
-            for domain in domains_to_delete.read().splitlines():
-                create_scan_profile(assets, domain, args.key)
+    with metrics.phase('enumerate'):
+        assets = get_assets(args.key, not args.no_cache, args.refresh)   # Used to convert names to tokens
+        # The daemon resolves root assets itself, without sending the whole list over
+        root_index = assets if isinstance(assets, RemoteInventory) else RootIndex(assets.items())
+        print(f'Retrieved {len(root_index)} assets')
+        existing = get_profile_endpoints(args.key)
+        print(f'Retrieved {len(existing)} scan profiles')
+
+    domains = iter_domains(args.domain or [], [args.file] if args.file else [])
+    skipped = unresolved = 0
+
+    def resolve():
+        nonlocal skipped, unresolved, root_index
+        for domain in domains:
+            endpoint = profile_key(domain)
+            if endpoint in existing:
+                skipped += 1
+                continue
+            # A root asset added since the local inventory was synced is only found after a refresh
+            if isinstance(assets, AssetInventory) and root_index.resolve(domain) is None and assets.refresh_once():
+                root_index = RootIndex(assets.items())
+            asset_token = get_root_asset_token(root_index, domain)
+            if not asset_token:  # If asset_token is not found, skip
+                unresolved += 1
+                continue
+            existing.add(endpoint)  # A domain listed twice is only created once
+            yield asset_token, domain
+
+    with metrics.phase('mutate'), pooled_session(args.workers) as session:
+        summary = run_bulk(lambda target: create_scan_profile(*target, args.key, session), resolve(), args.workers)
+    print(f'Created {summary.succeeded} scan profiles, skipped {skipped} domains that already have one, '
+          f'{unresolved} not associated with any asset, {summary.failed} failed')
 
 
 if __name__ == '__main__':
@@ -1,42 +1,66 @@
-"""remove_all_scan_profile_schedules.py: trigger scans on all Application Scan profiles in a given Detectify team
+"""remove_all_scan_profile_schedules.py: remove the schedules of all Application Scan profiles in a Detectify team
 
-This script triggers IMMEDIATE Application Scans. Please ensure you have permission to start scans before running this
-script!
+Only scan profiles that currently have a schedule are sent a request. The profiles acted on can be narrowed down by
+endpoint, root domain or include/exclude files.
+
+The list of scan profiles fetched by an earlier run is revalidated with a conditional request where the API supports it.
 
 The API key permissions required by this script are the following:
 - Allow listing scan profiles
+- Allow listing scan schedules
 - Allow deleting scan schedule
 
-Usage: remove_all_scan_profile_schedules.py [-h] key
+If a run is interrupted, re-run it with --resume to skip the scan profiles that were already unscheduled. The tokens
+of scan profiles that failed are written to a retry file, which can be passed back with -f.
+
+Usage: remove_all_scan_profile_schedules.py [-h] [-f FILE] [--resume] [--retry-file RETRY_FILE]
+                                            [--no-http-cache] [--cache-ttl CACHE_TTL]
+                                            [--endpoint GLOB] [--endpoint-regex REGEX] [--root ROOT]
+                                            [--include FILE] [--exclude FILE]
+                                            key
 """
 
 import argparse
+import os
+import sys
 import requests
 
-API_BASE_URL = 'https://api.detectify.com/rest'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from detectify import API_BASE_URL, daemon, filters, httpcache, metrics, ratelimit, timeouts  # noqa: E402
+from detectify.httpcache import ResponseCache  # noqa: E402
+from detectify.journal import Journal, read_targets  # noqa: E402
 
 
-def remove_scan_profile_schedule(profile: dict, key: str) -> None:
+def remove_scan_profile_schedule(profile: dict, key: str) -> requests.Response:
     """Remove the configured schedule on a given Application Scan profile
 
     :param profile: A dictionary containing the necessary identifiers for an Application Scan profile
     :param key: A valid Detectify API key
+    :return: The API response
     """
     api_endpoint = f'/v2/scanschedules/{profile["token"]}/'
     r = requests.delete(url=f'{API_BASE_URL}{api_endpoint}',
                         headers={'X-Detectify-Key': key,
                                  'content-type': 'application/json'})
     print(f'Removed scan schedule from scan profile {profile["name"]} with code {r.status_code}: {r.reason}')
+    return r
 
 
-def get_scan_profiles(key: str) -> list:
-    """Get the full set of scan profiles from a given Detectify team
+def get_scan_profiles(key: str, cache: ResponseCache = None) -> list:
+    """Get the full set of scan profiles from a given Detectify team, or from the inventory daemon if it is running
 
     :param key: A valid Detectify API key
+    :param cache: An optional response cache, used to revalidate the list fetched by an earlier run
     :return: A list of dictionaries containing identifiers for all Application Scan profiles
     """
+    client = daemon.connect(key)
+    if client:
+        return client.scan_profiles()
     print('Querying list of scan profiles...')
     api_endpoint = f'/v2/profiles/'
+    if cache:
+        return cache.get_json(f'{API_BASE_URL}{api_endpoint}')
     r = requests.get(url=f'{API_BASE_URL}{api_endpoint}',
                      headers={'X-Detectify-Key': key,
                               'content-type': 'application/json'})
@@ -46,12 +70,47 @@ def get_scan_profiles(key: str) -> list:
 def main():
     parser = argparse.ArgumentParser(description='Run all application scan profiles')
     parser.add_argument('key', type=str, help='a valid Detectify API key')
+    parser.add_argument('-f', '--file', type=str,
+                        help='only act on the scan profile tokens listed in this file, such as a retry file')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip scan profiles completed by an earlier, interrupted run')
+    parser.add_argument('--retry-file', type=str,
+                        help='where to write the tokens of scan profiles that failed')
+    metrics.add_arguments(parser)
+    ratelimit.add_arguments(parser)
+    timeouts.add_arguments(parser)
+    httpcache.add_arguments(parser)
+    filters.add_arguments(parser, schedule=False)
     args = parser.parse_args()
-
-    scan_profiles = get_scan_profiles(args.key)
-
-    for profile in scan_profiles:
-        remove_scan_profile_schedule(profile, args.key)
+    metrics.start(args, 'remove_all_scan_profile_schedules')
+    ratelimit.start(args)
+    timeouts.start(args)
+
+    cache = httpcache.from_args(args)
+    with metrics.phase('enumerate'):
+        scan_profiles = get_scan_profiles(args.key, cache)
+    if args.file:
+        tokens = set(read_targets(args.file))
+        scan_profiles = [profile for profile in scan_profiles if profile['token'] in tokens]
+    with metrics.phase('resolve'):
+        # Only profiles that have a schedule need a DELETE
+        try:
+            profile_filter = filters.from_args(args, cache, has_schedule=True)
+        except requests.HTTPError as e:
+            print(f'Could not list scan schedules, trying every selected profile: {e}')
+            profile_filter = filters.from_args(args, cache)
+        scan_profiles = profile_filter.apply(scan_profiles)
+
+    def profile_token(profile: dict) -> str:
+        return profile['token']
+
+    with metrics.phase('mutate'), \
+            Journal('remove_all_scan_profile_schedules', args.key, args.resume, retry_path=args.retry_file) as journal:
+        scan_profiles = journal.read_ahead(scan_profiles, [args.file] if args.file else [])
+        remove_schedule = journal.track(lambda profile: remove_scan_profile_schedule(profile, args.key),
+                                        target=profile_token)
+        for profile in journal.pending(scan_profiles, target=profile_token):
+            remove_schedule(profile)
 
 
 if __name__ == '__main__':
@@ -3,40 +3,98 @@
 This script triggers IMMEDIATE Application Scans. Please ensure you have permission to start scans before running this
 script!
 
+The profiles to scan can be narrowed down by endpoint, root domain, whether they have a schedule, or include/exclude
+files. --has-schedule and --no-schedule also require permission to list scan schedules.
+
+With --max-concurrent, scans are started in waves instead of all at once: at most that many scans run at the same time,
+scans of the same root asset are started at least --root-spacing seconds apart, and the status of running scans is
+polled so that the next profile starts as soon as a scan finishes. --priority orders the profiles by a file of tokens
+or endpoints, most urgent first.
+
+The list of scan profiles fetched by an earlier run is revalidated with a conditional request where the API supports it.
+
 The API key permissions required by this script are the following:
 - Allow listing scan profiles
 - Allow starting scan
-
-Usage: run_all_application_scans.py [-h] key
+- Allow getting scan status (with --max-concurrent)
+
+If a run is interrupted, re-run it with --resume to skip the scan profiles that were already started. The tokens of
+scan profiles that failed are written to a retry file, which can be passed back with -f.
+
+Usage: run_all_application_scans.py [-h] [-f FILE] [--resume] [--retry-file RETRY_FILE]
+                                    [--no-http-cache] [--cache-ttl CACHE_TTL]
+                                    [--endpoint GLOB] [--endpoint-regex REGEX] [--root ROOT]
+                                    [--has-schedule | --no-schedule] [--include FILE] [--exclude FILE]
+                                    [--max-concurrent MAX_CONCURRENT] [--root-spacing ROOT_SPACING]
+                                    [--poll-interval POLL_INTERVAL] [--priority FILE]
+                                    key
 """
 
 import argparse
+import os
+import sys
 import requests
 
-API_BASE_URL = 'https://api.detectify.com/rest'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from detectify import API_BASE_URL, daemon, filters, httpcache, metrics, ratelimit, timeouts  # noqa: E402
+from detectify.httpcache import ResponseCache  # noqa: E402
+from detectify.journal import Journal, read_targets  # noqa: E402
+from detectify.scheduler import DEFAULT_POLL_INTERVAL, WaveScheduler, prioritize, read_priorities  # noqa: E402
 
+# Scan states in which a profile no longer takes a slot
+FINISHED_STATES = {'stopped', 'finished', 'completed', 'done', 'idle', 'failed', 'cancelled'}
 
-def start_application_scan(profile: dict, key: str) -> None:
+
+def start_application_scan(profile: dict, key: str) -> requests.Response:
     """Trigger an immediate scan on a given Application Scan profile
 
     :param profile: A dictionary containing the necessary identifiers for an Application Scan profile
     :param key: A valid Detectify API key
+    :return: The API response
     """
     api_endpoint = f'/v2/scans/{profile["token"]}/'
     r = requests.post(url=f'{API_BASE_URL}{api_endpoint}',
                       headers={'X-Detectify-Key': key,
                                'content-type': 'application/json'})
     print(f'Starting scan on {profile["endpoint"]} with code {r.status_code}: {r.reason}')
+    return r
+
+
+def is_scan_running(profile: dict, key: str) -> bool:
+    """Check whether a scan is currently running on a given Application Scan profile
+
+    :param profile: A dictionary containing the necessary identifiers for an Application Scan profile
+    :param key: A valid Detectify API key
+    :raises requests.HTTPError: If the API answers with an error other than 404
+    :return: True if a scan is queued or running
+    """
+    api_endpoint = f'/v2/scans/{profile["token"]}/'
+    r = requests.get(url=f'{API_BASE_URL}{api_endpoint}',
+                     headers={'X-Detectify-Key': key,
+                              'content-type': 'application/json'})
+    if r.status_code == 404:  # No active scan
+        return False
+    r.raise_for_status()
+    status = r.json()
+    state = status.get('state') or status.get('status') or ''
+    return state.lower() not in FINISHED_STATES
 
 
-def get_scan_profiles(key: str) -> list:
-    """Get the full set of scan profiles from a given Detectify team
+def get_scan_profiles(key: str, cache: ResponseCache = None) -> list:
+    """Get the full set of scan profiles from a given Detectify team, or from the inventory daemon if it is running
 
     :param key: A valid Detectify API key
+    :param cache: An optional response cache, used to revalidate the list fetched by an earlier run
     :return: A list of dictionaries containing identifiers for all Application Scan profiles
     """
+    client = daemon.connect(key)
+    if client:
+        return client.scan_profiles()
     print('Querying list of scan profiles...')
     api_endpoint = f'/v2/profiles/'
+    if cache:
+        return cache.get_json(f'{API_BASE_URL}{api_endpoint}')
     r = requests.get(url=f'{API_BASE_URL}{api_endpoint}',
                      headers={'X-Detectify-Key': key,
                               'content-type': 'application/json'})
@@ -46,12 +104,56 @@ def get_scan_profiles(key: str) -> list:
 def main():
     parser = argparse.ArgumentParser(description='Run all application scan profiles')
     parser.add_argument('key', type=str, help='a valid Detectify API key')
+    parser.add_argument('-f', '--file', type=str,
+                        help='only act on the scan profile tokens listed in this file, such as a retry file')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip scan profiles completed by an earlier, interrupted run')
+    parser.add_argument('--retry-file', type=str,
+                        help='where to write the tokens of scan profiles that failed')
+    metrics.add_arguments(parser)
+    ratelimit.add_arguments(parser)
+    timeouts.add_arguments(parser)
+    httpcache.add_arguments(parser)
+    filters.add_arguments(parser)
+    parser.add_argument('--max-concurrent', type=int,
+                        help='start scans in waves, with at most this many running at once')
+    parser.add_argument('--root-spacing', type=float, default=0.0,
+                        help='with --max-concurrent, seconds between scans of the same root asset (default: 0)')
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                        help=f'with --max-concurrent, seconds between scan status checks '
+                             f'(default: {DEFAULT_POLL_INTERVAL:g})')
+    parser.add_argument('--priority', type=str, metavar='FILE',
+                        help='start the profiles whose token or endpoint is listed in this file first, in file order')
     args = parser.parse_args()
-
-    scan_profiles = get_scan_profiles(args.key)
-
-    for profile in scan_profiles:
-        start_application_scan(profile, args.key)
+    metrics.start(args, 'run_all_application_scans')
+    ratelimit.start(args)
+    timeouts.start(args)
+
+    cache = httpcache.from_args(args)
+    with metrics.phase('enumerate'):
+        scan_profiles = get_scan_profiles(args.key, cache)
+    if args.file:
+        tokens = set(read_targets(args.file))
+        scan_profiles = [profile for profile in scan_profiles if profile['token'] in tokens]
+    with metrics.phase('resolve'):
+        scan_profiles = filters.from_args(args, cache).apply(scan_profiles)
+        if args.priority:
+            scan_profiles = prioritize(scan_profiles, read_priorities(args.priority))
+
+    def profile_token(profile: dict) -> str:
+        return profile['token']
+
+    with metrics.phase('mutate'), \
+            Journal('run_all_application_scans', args.key, args.resume, retry_path=args.retry_file) as journal:
+        scan_profiles = journal.read_ahead(scan_profiles, [args.file] if args.file else [])
+        start_scan = journal.track(lambda profile: start_application_scan(profile, args.key), target=profile_token)
+        if args.max_concurrent:
+            scheduler = WaveScheduler(start_scan, lambda profile: is_scan_running(profile, args.key),
+                                      args.max_concurrent, args.root_spacing, args.poll_interval)
+            scheduler.run(journal.pending(scan_profiles, target=profile_token))
+        else:
+            for profile in journal.pending(scan_profiles, target=profile_token):
+                start_scan(profile)
 
 
 if __name__ == '__main__':
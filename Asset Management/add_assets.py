@@ -1,48 +1,93 @@
 """add_asset.py: add assets to a given Detectify team
 
+Zone files are checked locally for an $ORIGIN before they are uploaded, and a zone file is skipped if its content is
+unchanged since its last successful upload. Use --force to upload it anyway.
+
+If a run is interrupted, re-run it with --resume to skip the domains that were already added. Domains that could not
+be added are written to a retry file, which can be passed back with -f.
+
 The API key permissions required by this script are the following:
 - Allow creating domains
 - Allow uploading zone files
 
 Usage: add_assets.py [-h] [-d [DOMAIN [DOMAIN ...]]] [-f FILE]
-                     [-z [ZONEFILE [ZONEFILE ...]]]
+                     [-z [ZONEFILE [ZONEFILE ...]]] [-w WORKERS]
+                     [--resume] [--retry-file RETRY_FILE] [--compress] [--force]
                      key
 """
 
 import argparse
 import json
+import os
+import sys
 import requests
 
-API_BASE_URL = 'https://api.detectify.com/rest'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from detectify import API_BASE_URL, metrics, ratelimit, timeouts  # noqa: E402
+from detectify.bulk import pooled_session, run_bulk  # noqa: E402
+from detectify.concurrency import DEFAULT_CONCURRENCY  # noqa: E402
+from detectify.domains import iter_domains  # noqa: E402
+from detectify.inventory import AssetInventory  # noqa: E402
+from detectify.journal import Journal  # noqa: E402
+from detectify.zonefile import UploadHistory, ZoneFileError, open_upload, parse_zone_file  # noqa: E402
 
 
-def add_asset(domain: str, key: str) -> None:
+def add_asset(domain: str, key: str, session: requests.Session = None) -> requests.Response:
     """Add an asset to Detectify
 
     :param domain: An FQDN to add to the Detectify asset inventory
     :param key: A valid Detectify API key
+    :param session: An optional session to reuse connections between calls
+    :return: The API response
     """
     api_endpoint = f'/v2/assets/'
     payload = json.dumps({'name': domain.strip()})
-    r = requests.post(url=f'{API_BASE_URL}{api_endpoint}',
-                      headers={'X-Detectify-Key': key,
-                               'content-type': 'application/json'},
-                      data=payload)
+    r = (session or requests).post(url=f'{API_BASE_URL}{api_endpoint}',
+                                   headers={'X-Detectify-Key': key,
+                                            'content-type': 'application/json'},
+                                   data=payload)
     print(f'Added asset {domain.strip()} with code {r.status_code}: {r.reason}')
+    return r
 
 
-def upload_zone_file(zone_file: str, key: str) -> None:
+def upload_zone_file(zone_file: str, key: str, session: requests.Session = None, compress: bool = False,
+                     history: UploadHistory = None) -> requests.Response:
     """Upload a zone file to populate domain information
 
+    The zone file is validated locally first and streamed to the API from disk. If an upload history is given, zone
+    files whose content has not changed since their last successful upload are skipped.
+
     :param zone_file: A zone file including a specified $ORIGIN
     :param key: A valid Detectify API key
+    :param session: An optional session to reuse connections between calls
+    :param compress: Whether to gzip the zone file before uploading it
+    :param history: An optional record of previous uploads, used to skip unchanged zone files
+    :return: The API response, or None if the zone file was skipped
     """
+    try:
+        zone = parse_zone_file(zone_file)
+    except (OSError, ZoneFileError) as e:
+        print(f'Skipping zone file {zone_file}: {e}')
+        return None
+    if history and history.is_unchanged(zone):
+        print(f'Zone file {zone_file} for {zone.origin} is unchanged since its last upload, skipping.')
+        return None
+
     api_endpoint = f'/v2/zone/file/'
-    r = requests.post(url=f'{API_BASE_URL}{api_endpoint}',
-                      headers={'X-Detectify-Key': key,
-                               'content-type': 'application/json'},
-                      data=open(zone_file, 'rb'))
-    print(f'Uploaded zone file {zone_file} with code {r.status_code}: {r.reason}')
+    headers = {'X-Detectify-Key': key,
+               'content-type': 'text/plain'}
+    if compress:
+        headers['content-encoding'] = 'gzip'
+    with open_upload(zone_file, compress) as body:
+        r = (session or requests).post(url=f'{API_BASE_URL}{api_endpoint}',
+                                       headers=headers,
+                                       data=body)
+    print(f'Uploaded zone file {zone_file} ({zone.records} records for {zone.origin}) '
+          f'with code {r.status_code}: {r.reason}')
+    if r.ok and history:
+        history.record(zone)
+    return r
 
 
 def main():
@@ -51,25 +96,48 @@ def main():
     parser.add_argument('-d', '--domain', type=str, nargs='*',
                         help='one or more domains to add to Detectify')
     parser.add_argument('-f', '--file', type=str,
-                        help='a file containing a list of apex domains')
+                        help='a file containing a list of apex domains, or - for standard input')
     parser.add_argument('-z', '--zonefile', type=str, nargs='*',
                         help='one or more zone files including a specified $ORIGIN')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_CONCURRENCY,
+                        help=f'number of assets or zone files to add at once (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip domains completed by an earlier, interrupted run')
+    parser.add_argument('--retry-file', type=str,
+                        help='where to write domains that failed (default: add_assets.retry)')
+    parser.add_argument('--compress', action='store_true',
+                        help='gzip zone files while uploading them')
+    parser.add_argument('--force', action='store_true',
+                        help='upload zone files even if they are unchanged since their last upload')
+    metrics.add_arguments(parser)
+    ratelimit.add_arguments(parser)
+    timeouts.add_arguments(parser)
     args = parser.parse_args()
+    metrics.start(args, 'add_assets')
+    ratelimit.start(args)
+    timeouts.start(args)
     if not (args.domain or args.file or args.zonefile):
         parser.error('No domains specified. Use at least one of flag -d, -f, or -z.')
 
-    if args.domain:
-        for domain in args.domain:
-            add_asset(domain, args.key)
-
-    if args.file:
-        with open(args.file, 'r') as infile:
-            for domain in infile.read().splitlines():
-                add_asset(domain, args.key)
+    added = 0
+    if args.domain or args.file:
+        domains = iter_domains(args.domain or [], [args.file] if args.file else [])
+        with metrics.phase('mutate'), \
+                Journal('add_assets', args.key, args.resume, retry_path=args.retry_file) as journal, \
+                pooled_session(args.workers) as session:
+            domains = journal.read_ahead(domains, [args.file] if args.file else [])
+            added += run_bulk(journal.track(lambda domain: add_asset(domain, args.key, session)),
+                              journal.pending(domains), args.workers).succeeded
 
     if args.zonefile:
-        for zone_file in args.zonefile:
-            upload_zone_file(zone_file, args.key)
+        history = None if args.force else UploadHistory(args.key)
+        with metrics.phase('upload'), pooled_session(args.workers) as session:
+            added += run_bulk(lambda zone_file: upload_zone_file(zone_file, args.key, session, args.compress, history),
+                              args.zonefile, args.workers).succeeded
+
+    if added:  # so that the next lookup, such as add_scan_profiles.py resolving the new assets, re-syncs
+        with AssetInventory(args.key) as inventory:
+            inventory.invalidate()
 
 
 if __name__ == '__main__':
@@ -1,88 +1,124 @@
 """delete_assets.py: delete specified root assets from a given Detectify team
 
+If a run is interrupted, re-run it with --resume to skip the domains that were already deleted. Domains that could not
+be deleted are written to a retry file, which can be passed back with -f.
+
 The API key permissions required by this script are the following:
 - Allow deleting domains
 - Allow listing domains
 
-Usage: delete_assets.py [-h] [-d [DOMAIN [DOMAIN ...]]] [-f FILE] key
+Usage: delete_assets.py [-h] [-d [DOMAIN [DOMAIN ...]]] [-f FILE] [-w WORKERS]
+                        [--resume] [--retry-file RETRY_FILE] [--no-cache] [--refresh]
+                        key
 """
 
 import argparse
+import os
+import sys
 import requests
 
-API_BASE_URL = 'https://api.detectify.com/rest'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from detectify import API_BASE_URL, daemon, metrics, ratelimit, timeouts  # noqa: E402
+from detectify.bulk import pooled_session, run_bulk  # noqa: E402
+from detectify.concurrency import DEFAULT_CONCURRENCY  # noqa: E402
+from detectify.domains import iter_domains  # noqa: E402
+from detectify.inventory import AssetInventory  # noqa: E402
+from detectify.journal import Journal  # noqa: E402
+from detectify.pagination import iter_assets  # noqa: E402
+from detectify.store import AssetStore  # noqa: E402
 
 
-def delete_asset(asset_token: str, asset_name: str, key: str) -> None:
+def delete_asset(asset_token: str, asset_name: str, key: str,
+                 session: requests.Session = None) -> requests.Response:
     """Delete a given Detectify asset
 
     :param asset_token: The internal UUID used to identify individual assets
     :param asset_name: The name of the asset associated with the given token
     :param key: A valid Detectify API key
+    :param session: An optional session to reuse connections between calls
+    :return: The API response
     """
-    try:
-        api_endpoint = f'/v2/assets/{asset_token}/'
-        r = requests.delete(url=f'{API_BASE_URL}{api_endpoint}',
-                            headers={'X-Detectify-Key': key,
-                                     'content-type': 'application/json'})
-        print(f'deleted asset {asset_name} with code {r.status_code}: {r.reason}')
-    except KeyError:
-        print(f'Asset {asset_name} not found, skipping')
-        pass
-
-
-def get_assets(key: str) -> dict:
+    api_endpoint = f'/v2/assets/{asset_token}/'
+    r = (session or requests).delete(url=f'{API_BASE_URL}{api_endpoint}',
+                                     headers={'X-Detectify-Key': key,
+                                              'content-type': 'application/json'})
+    print(f'deleted asset {asset_name} with code {r.status_code}: {r.reason}')
+    return r
+
+
+def get_assets(key: str, use_cache: bool = True, refresh: bool = False) -> dict:
     """Get the full list of apex domains and subdomains from Detectify for later filtering
 
     :param key: A valid Detectify API key
-    :return: A dictionary of assets and tokens
+    :param use_cache: Answer lookups from the inventory daemon or local asset inventory instead of enumerating assets
+    :param refresh: Force the local asset inventory to be refreshed before use
+    :return: A dictionary-like mapping of asset names to tokens
     """
+    if use_cache:
+        client = daemon.connect(key)
+        if client:
+            inventory = client.inventory(include_subdomains=True)
+        else:
+            inventory = AssetInventory(key, include_subdomains=True)
+        if refresh:
+            inventory.refresh()
+        return inventory
     print('Querying assets. . .')
-    all_assets = {}
-    marker = ''
-    has_more = True
-    while has_more:
-        api_endpoint = f'/v2/assets/'
-        r = requests.get(url=f'{API_BASE_URL}{api_endpoint}?marker={marker}&include_subdomains=true',
-                         headers={'X-Detectify-Key': key,
-                                  'content-type': 'application/json'})
-        for asset in r.json()['assets']:
-            all_assets[asset['name']] = asset['token']
-        try:
-            marker = r.json()['next_marker']
-        except KeyError:  # next_marker may not exist when has_more is False
-            pass
-        has_more = r.json()['has_more']
-    return all_assets
+    return AssetStore.from_assets(iter_assets(key, include_subdomains=True))
 
 
 def main():
     parser = argparse.ArgumentParser(description='Delete assets from Detectify')
     parser.add_argument('key', type=str, help='a valid Detectify API key')
     parser.add_argument('-d', '--domain', type=str, nargs='*',
-                        help='one or more domains to add to Detectify')
+                        help='one or more domains to delete from Detectify')
     parser.add_argument('-f', '--file', type=str,
-                        help='a file containing a list of apex domains')
+                        help='a file containing a list of apex domains, or - for standard input')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_CONCURRENCY,
+                        help=f'number of assets to delete at once (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip domains completed by an earlier, interrupted run')
+    parser.add_argument('--retry-file', type=str,
+                        help='where to write domains that failed (default: delete_assets.retry)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='enumerate assets from the API instead of using the local asset inventory')
+    parser.add_argument('--refresh', action='store_true',
+                        help='refresh the local asset inventory before use')
+    metrics.add_arguments(parser)
+    ratelimit.add_arguments(parser)
+    timeouts.add_arguments(parser)
     args = parser.parse_args()
+    metrics.start(args, 'delete_assets')
+    ratelimit.start(args)
+    timeouts.start(args)
     if not (args.domain or args.file):
         parser.error('No domains specified. Use at least one of flag -d or -f.')
-    assets = get_assets(args.key)   # Must get full list of assets to convert names to tokens
-    print(f'Retrieved {len(assets)} assets')
+    with metrics.phase('enumerate'):
+        assets = get_assets(args.key, not args.no_cache, args.refresh)   # Used to convert names to tokens
+        print(f'Retrieved {len(assets)} assets')
+
+    domains = iter_domains(args.domain or [], [args.file] if args.file else [])
 
-    if args.domain:
-        for domain in args.domain:
+    def resolve(domains):
+        for domain in domains:
             if domain in assets:
-                delete_asset(assets[domain], domain, args.key)
+                yield assets[domain], domain
             else:
                 print(f'Domain {domain} not found in assets, skipping.')
 
-    if args.file:
-        with open(args.file) as domains_to_delete:
-            for domain in domains_to_delete.read().splitlines():
-                if domain in assets:
-                    delete_asset(assets[domain], domain, args.key)
-            else:
-                print(f'Domain {domain} not found in assets, skipping.')
+    with metrics.phase('mutate'), \
+            Journal('delete_assets', args.key, args.resume, retry_path=args.retry_file) as journal, \
+            pooled_session(args.workers) as session:
+        domains = journal.read_ahead(domains, [args.file] if args.file else [])
+        summary = run_bulk(journal.track(lambda target: delete_asset(*target, args.key, session),
+                                         target=lambda t: t[1]),
+                           resolve(journal.pending(domains)), args.workers)
+
+    if summary.succeeded:  # so that later lookups do not return the tokens of deleted assets
+        with AssetInventory(args.key) as inventory:
+            inventory.invalidate()
+
 
 if __name__ == '__main__':
     main()
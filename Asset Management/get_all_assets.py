@@ -1,64 +1,146 @@
 """get_all_assets.py: fetch all assets within a given Detectify team and optionally write to a file
 
+Assets are written to the file as each page arrives. The output format follows the file extension (.csv or .jsonl,
+optionally followed by .gz for gzip compression) unless --format or --gzip are given.
+
+With --diff-against, the asset names are compared to a snapshot saved by the previous run, which is then replaced, and
+only the assets added or removed since then are written to the file, or printed if no file is given. The first run
+with a new snapshot file only saves the snapshot.
+
 The API key permissions required by this script are the following:
 - Allow listing domains
 
-Usage: get_all_assets.py [-h] [-f FILE] key
+Usage: get_all_assets.py [-h] [-f FILE] [--format {csv,jsonl}] [--gzip] [--diff-against SNAPSHOT] key
 """
 
 import argparse
 import csv
-import requests
+import os
+import sys
+from typing import Iterable, Iterator
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
 
-API_BASE_URL = 'https://api.detectify.com/rest'
+from detectify import metrics, ratelimit, timeouts  # noqa: E402
+from detectify.export import FORMATS, export_format, open_export, write_jsonl  # noqa: E402
+from detectify.pagination import iter_assets  # noqa: E402
+from detectify.snapshot import ADDED, update_snapshot  # noqa: E402
 
 
-def export_to_csv(all_assets: list, file: str) -> None:
+def export_to_csv(all_assets: Iterable, file: str, compress: bool = None) -> int:
     """Export all assets from a given Detectify team to csv
 
-    :param all_assets: A list of dictionaries containing asset information
+    :param all_assets: An iterable of dictionaries containing asset information
+    :param file: The name of the file to save to
+    :param compress: Whether to gzip the output, defaults to True for file names ending in .gz
+    :return: The number of assets written
+    """
+    count = 0
+    with open_export(file, compress) as f:
+        writer = csv.writer(f)
+        for asset in all_assets:
+            writer.writerow([asset['name']])
+            count += 1
+    return count
+
+
+def export_to_jsonl(all_assets: Iterable, file: str, compress: bool = None) -> int:
+    """Export all assets from a given Detectify team to JSON Lines, one full asset object per line
+
+    :param all_assets: An iterable of dictionaries containing asset information
     :param file: The name of the file to save to
+    :param compress: Whether to gzip the output, defaults to True for file names ending in .gz
+    :return: The number of assets written
     """
-    with open(f'{file}', 'w+', newline='') as f:
+    count = 0
+    with open_export(file, compress) as f:
+        for asset in all_assets:
+            write_jsonl(f, asset)
+            count += 1
+    return count
+
+
+def export_changes(changes: Iterable, file: str = None, fmt: str = None, compress: bool = None) -> tuple:
+    """Export the assets added and removed since the last snapshot, or print them if no file is given
+
+    :param changes: An iterable of (change, name) tuples from update_snapshot
+    :param file: The name of the file to save to
+    :param fmt: The output format, one of FORMATS, inferred from the file name by default
+    :param compress: Whether to gzip the output, defaults to True for file names ending in .gz
+    :return: The number of assets added and removed
+    """
+    counts = {'added': 0, 'removed': 0}
+    if not file:
+        for change, name in changes:
+            print(f'{"+" if change == ADDED else "-"} {name}')
+            counts[change] += 1
+        return counts['added'], counts['removed']
+
+    jsonl = export_format(file, fmt) == 'jsonl'
+    with open_export(file, compress) as f:
         writer = csv.writer(f)
-        writer.writerows([[x['name']] for x in all_assets])
+        if not jsonl:
+            writer.writerow(['change', 'name'])
+        for change, name in changes:
+            if jsonl:
+                write_jsonl(f, {'change': change, 'name': name})
+            else:
+                writer.writerow([change, name])
+            counts[change] += 1
+    return counts['added'], counts['removed']
 
 
-def get_assets(key: str) -> list:
+def get_assets(key: str) -> Iterator[dict]:
     """Get the full list of apex domains and subdomains from Detectify
 
     :param key: A valid Detectify API key
-    :return: A list of dictionaries containing asset information
+    :return: An iterator of dictionaries containing asset information, streamed page by page
     """
     print('Querying assets. . .')
-    all_assets = []
-    marker = ''
-    has_more = True
-    while has_more:
-        api_endpoint = f'/v2/assets/'
-        r = requests.get(url=f'{API_BASE_URL}{api_endpoint}?marker={marker}&include_subdomains=true',
-                         headers={'X-Detectify-Key': key,
-                                  'content-type': 'application/json'})
-        all_assets += r.json()['assets']
-        try:
-            marker = r.json()['next_marker']
-        except KeyError:  # next_marker may not exist when has_more is False
-            pass
-        has_more = r.json()['has_more']
-    return all_assets
+    return iter_assets(key, include_subdomains=True)
 
 
 def main():
     parser = argparse.ArgumentParser(description='get a count for all subdomains discovered so far in a team')
     parser.add_argument('key', type=str, help='a valid Detectify API key')
-    parser.add_argument('-f', '--file', type=str, help='save location for exported results in .csv format')
+    parser.add_argument('-f', '--file', type=str, help='save location for exported results in .csv or .jsonl format')
+    parser.add_argument('--format', type=str, choices=FORMATS,
+                        help='output format, inferred from the file extension by default')
+    parser.add_argument('--gzip', action='store_true', default=None,
+                        help='gzip the output, implied by a file name ending in .gz')
+    parser.add_argument('--diff-against', type=str, metavar='SNAPSHOT',
+                        help='only output assets added or removed since this snapshot, then update it')
+    metrics.add_arguments(parser)
+    ratelimit.add_arguments(parser)
+    timeouts.add_arguments(parser)
     args = parser.parse_args()
+    metrics.start(args, 'get_all_assets')
+    ratelimit.start(args)
+    timeouts.start(args)
 
     all_assets = get_assets(args.key)
-    
-    if args.file:
-        export_to_csv(all_assets, args.file)
 
+    # Assets are written as they are enumerated, so the export phase includes enumeration
+    if args.diff_against:
+        first_run = not os.path.exists(args.diff_against)
+        names = (asset['name'] for asset in all_assets)
+        with metrics.phase('export'):
+            added, removed = export_changes(update_snapshot(names, args.diff_against), args.file, args.format,
+                                            args.gzip)
+        if first_run:
+            print(f'Saved a first snapshot to {args.diff_against}')
+        else:
+            print(f'{added} assets added and {removed} removed since the last snapshot')
+        return
+
+    if args.file:
+        export = export_to_jsonl if export_format(args.file, args.format) == 'jsonl' else export_to_csv
+        with metrics.phase('export'):
+            count = export(all_assets, args.file, args.gzip)
+    else:
+        with metrics.phase('enumerate'):
+            count = sum(1 for _ in all_assets)
+    print(f'Retrieved {count} assets')
 
 if __name__ == '__main__':
     main()
@@ -1,99 +1,237 @@
 """bulk_update_SM_settings_from_list.py: update the Surface Monitoring settings for a given list of domains
 
+With --diff, the current settings of every listed domain are fetched first and only the domains whose settings differ
+from SETTINGS are updated, grouped by the change they need. --plan prints those groups without applying them. Settings
+fetched by earlier runs are revalidated with conditional requests, and dropped from the cache once they are updated.
+
 The API key permissions required by this script are the following:
 - Allow listing domains
 - Allow updating domains
 
-Usage: bulk_update_SM_settings_from_list.py [-h] domain_file key
+Usage: bulk_update_SM_settings_from_list.py [-h] [--diff] [--plan] [-c CONCURRENCY]
+                                            [--no-cache] [--refresh] [--no-http-cache] [--cache-ttl CACHE_TTL]
+                                            domain_file key
 """
 
 import argparse
 import json
+import os
+import sys
+from collections import defaultdict
+from typing import Iterable
 import requests
 
-API_BASE_URL = 'https://api.detectify.com/rest'
-
-
-def update_surface_monitoring_settings(domain: dict, key: str) -> None:
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from detectify import API_BASE_URL, daemon, httpcache, metrics, ratelimit, timeouts  # noqa: E402
+from detectify.bulk import pooled_session, run_bulk  # noqa: E402
+from detectify.compliance import SettingsMatrix, boolean_settings  # noqa: E402
+from detectify.concurrency import DEFAULT_CONCURRENCY, describe_error, map_ordered  # noqa: E402
+from detectify.domains import iter_domains  # noqa: E402
+from detectify.httpcache import ResponseCache  # noqa: E402
+from detectify.inventory import AssetInventory  # noqa: E402
+from detectify.pagination import iter_assets  # noqa: E402
+from detectify.store import AssetStore  # noqa: E402
+
+
+# Change these settings as desired
+# Current schema always available at https://developer.detectify.com/#operation/updateAssetSettings
+SETTINGS = {"brute_force": True,
+            "custom_headers": {},
+            "enable_active_tls_assessments": True,
+            "enable_certificate_assessments": True,
+            "enable_passive_tls_assessments": True,
+            "enable_tls_discovery": True,
+            "fingerprinting": True,
+            "include_discovered_ports_in_surface_monitoring": True,
+            "monitoring": True,
+            "requests_per_second": 0,
+            "scrape": True,
+            "ssl_audit": True,
+            "stateless_tests": True,
+            "subdomain_takeover_tests": True}
+
+
+def update_surface_monitoring_settings(domain: dict, key: str, session: requests.Session = None,
+                                       cache: ResponseCache = None) -> requests.Response:
     """Update the Surface Monitoring settings for a given domain
 
     :param domain: A dictionary containing an asset name and token
     :param key: A valid Detectify API key
+    :param session: An optional session to reuse connections between calls
+    :param cache: An optional response cache, from which the domain's previous settings are dropped
+    :return: The API response
     """
     api_endpoint = f'/v2/domains/{domain["token"]}/settings/'
-
-    # Change these settings as desired
-    # Current schema always available at https://developer.detectify.com/#operation/updateAssetSettings
-    payload = {"brute_force": True,
-               "custom_headers": {},
-               "enable_active_tls_assessments": True,
-               "enable_certificate_assessments": True,
-               "enable_passive_tls_assessments": True,
-               "enable_tls_discovery": True,
-               "fingerprinting": True,
-               "include_discovered_ports_in_surface_monitoring": True,
-               "monitoring": True,
-               "requests_per_second": 0,
-               "scrape": True,
-               "ssl_audit": True,
-               "stateless_tests": True,
-               "subdomain_takeover_tests": True}
-    r = requests.put(url=f'{API_BASE_URL}{api_endpoint}',
-                     headers={'X-Detectify-Key': key,
-                              'content-type': 'application/json'},
-                     data=json.dumps(payload))
+    r = (session or requests).put(url=f'{API_BASE_URL}{api_endpoint}',
+                                  headers={'X-Detectify-Key': key,
+                                           'content-type': 'application/json'},
+                                  data=json.dumps(SETTINGS))
+    if cache:
+        cache.invalidate(f'{API_BASE_URL}{api_endpoint}')
     print(f'Updated settings for asset {domain["name"]} with response code {r.status_code}: {r.reason}')
+    return r
+
+
+def get_asset_settings(key: str, token: str, session: requests.Session = None, cache: ResponseCache = None) -> dict:
+    """Get the Surface Monitoring settings for a given Detectify asset
+
+    :param key: A valid Detectify API key
+    :param token: A valid asset token for a root asset
+    :param session: An optional session to reuse connections between calls
+    :param cache: An optional response cache, used to revalidate settings fetched by earlier runs
+    :return: A dictionary containing all asset settings
+    """
+    api_endpoint = f'/v2/domains/{token}/settings/'
+    if cache:
+        return cache.get_json(f'{API_BASE_URL}{api_endpoint}', session)
+    r = (session or requests).get(url=f'{API_BASE_URL}{api_endpoint}',
+                                  headers={'X-Detectify-Key': key,
+                                           'content-type': 'application/json'})
+    r.raise_for_status()
+    return r.json()
+
+
+def diff_settings(current: dict, desired: dict) -> dict:
+    """Compare a domain's current settings with the desired settings
 
+    Only the settings present in the desired settings are compared, so settings that are not managed by this script
+    never cause an update.
 
-def get_root_assets(key: str) -> list:
+    :param current: The settings currently configured for a domain
+    :param desired: The settings the domain should have
+    :return: A dictionary mapping each differing setting to a (current, desired) pair
+    """
+    return {setting: (current.get(setting), value) for setting, value in desired.items()
+            if current.get(setting) != value}
+
+
+def plan_updates(domains: list, key: str, concurrency: int = DEFAULT_CONCURRENCY,
+                 cache: ResponseCache = None) -> list:
+    """Fetch the current settings of every domain concurrently and print a plan of the changes needed
+
+    Domains needing the same change are grouped, by the fingerprint of the boolean settings they need changed and by
+    the changes to any other settings, and each group is printed once. Domains whose settings could not be fetched are
+    reported and left out of the plan.
+
+    :param domains: A list of dictionaries containing asset names and tokens
+    :param key: A valid Detectify API key
+    :param concurrency: The maximum number of settings requests in flight at once
+    :param cache: An optional response cache, used to revalidate settings fetched by earlier runs
+    :return: The domains whose settings differ from the desired settings, grouped by change
+    """
+    matrix = SettingsMatrix(boolean_settings(SETTINGS))
+    other_settings = {setting: value for setting, value in SETTINGS.items() if setting not in matrix.settings}
+    fetched = []  # (domain, changes to settings that are not booleans), in the order of the matrix
+    failed = 0
+    with pooled_session(concurrency) as session:
+        def fetch(domain: dict) -> dict:
+            return get_asset_settings(key, domain['token'], session, cache)
+
+        for domain, settings, error in map_ordered(fetch, domains, concurrency):
+            if error:
+                print(f'Failed to get settings for asset {domain["name"]}: {describe_error(error)}')
+                failed += 1
+                continue
+            matrix.add(domain['name'], settings)
+            other = diff_settings(settings, other_settings)
+            fetched.append((domain, tuple(f'{setting}: {json.dumps(old)} -> {json.dumps(new)}'
+                                          for setting, (old, new) in sorted(other.items()))))
+
+    delta_of = {i: delta for delta, indices in matrix.deltas(SETTINGS).items() for i in indices}
+    groups = defaultdict(list)
+    for i, (domain, other) in enumerate(fetched):
+        if delta_of.get(i) or other:
+            groups[delta_of.get(i, 0), other].append(domain)
+    changes = []
+    for (delta, other), group in sorted(groups.items(), key=lambda group: -len(group[1])):
+        print(f'~ {len(group)} domains:')
+        for setting in matrix.describe(delta):
+            print(f'    {setting}: -> {json.dumps(SETTINGS[setting])}')
+        for change in other:
+            print(f'    {change}')
+        for domain in group:
+            print(f'      {domain["name"]}')
+        changes += group
+    print(f'Plan: {len(changes)} to update in {len(groups)} groups, {len(fetched) - len(changes)} unchanged, '
+          f'{failed} failed to fetch')
+    return changes
+
+
+def get_root_assets(key: str) -> AssetStore:
     """Get the full list of apex domains from Detectify
 
     :param key: A valid Detectify API key
-    :return: A list of dictionaries containing asset information
+    :return: A compact store of asset names and tokens
     """
-    marker = ''
-    has_more = True
-    assets = []
-    while has_more:
-        api_endpoint = '/v2/assets/'
-        r = requests.get(url=f'{API_BASE_URL}{api_endpoint}?marker={marker}',
-                         headers={'X-Detectify-Key': key,
-                                  'content-type': 'application/json'})
-        try:
-            marker = r.json()['next_marker']
-        except KeyError:  # next_marker may not exist when has_more is False
-            pass
-        has_more = r.json()['has_more']
-        assets += r.json()['assets']
-    return assets
-
-
-def domains_to_tokens(domains: list, key: str) -> list:
+    return AssetStore.from_assets(iter_assets(key))
+
+
+def domains_to_tokens(domains: Iterable[str], key: str, use_cache: bool = True, refresh: bool = False) -> list:
     """Associate each provided root domain with its token
 
-    :param domains: A list of domains provided by the user
+    :param domains: The normalised domains provided by the user, without duplicates
     :param key: A valid Detectify API key
+    :param use_cache: Look up tokens in the inventory daemon or local asset inventory instead of enumerating assets
+    :param refresh: Force the local asset inventory to be refreshed before use
     :return: A filtered list of dictionaries containing asset names and tokens
     """
-    all_assets = get_root_assets(key)
+    if not use_cache:
+        root_assets = get_root_assets(key)
+        return [{'name': domain, 'token': root_assets[domain]}
+                for domain in domains if domain in root_assets]
     tokens = []
-    for asset in all_assets:
-        if asset['name'] in domains:
-            tokens.append({'name': asset['name'], 'token': asset['token']})
+    client = daemon.connect(key)
+    with client.inventory() if client else AssetInventory(key) as inventory:
+        if refresh:
+            inventory.refresh()
+        for domain in domains:
+            token = inventory.get(domain)
+            if token:
+                tokens.append({'name': domain, 'token': token})
     return tokens
 
 
 def main():
     parser = argparse.ArgumentParser(description='update the Surface Monitoring settings for a given list of domains')
-    parser.add_argument('domain_file', type=str, help='a file containing a list of apex domains')
+    parser.add_argument('domain_file', type=str,
+                        help='a file containing a list of apex domains, or - for standard input')
     parser.add_argument('key', type=str, help='a valid Detectify API key')
+    parser.add_argument('--diff', action='store_true',
+                        help='fetch the current settings first and only update domains whose settings differ')
+    parser.add_argument('--plan', action='store_true',
+                        help='print the changes --diff would make without applying them (implies --diff)')
+    parser.add_argument('-c', '--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help=f'number of domains to fetch or update at once (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='enumerate assets from the API instead of using the local asset inventory')
+    parser.add_argument('--refresh', action='store_true',
+                        help='refresh the local asset inventory before use')
+    metrics.add_arguments(parser)
+    ratelimit.add_arguments(parser)
+    timeouts.add_arguments(parser)
+    httpcache.add_arguments(parser)
     args = parser.parse_args()
-
-    with open(args.domain_file) as file:
-        domains = domains_to_tokens(file.read().splitlines(), args.key)
-
-    for domain in domains:
-        update_surface_monitoring_settings(domain, args.key)
+    metrics.start(args, 'bulk_update_SM_settings_from_list')
+    ratelimit.start(args)
+    timeouts.start(args)
+
+    with metrics.phase('resolve'):
+        domains = domains_to_tokens(iter_domains(files=[args.domain_file]), args.key, not args.no_cache,
+                                    args.refresh)
+
+    cache = httpcache.from_args(args)
+    if args.diff or args.plan:
+        with metrics.phase('plan'):
+            domains = plan_updates(domains, args.key, args.concurrency, cache)
+        if cache:
+            cache.report()
+        if args.plan:
+            return
+
+    with metrics.phase('mutate'), pooled_session(args.concurrency) as session:
+        run_bulk(lambda domain: update_surface_monitoring_settings(domain, args.key, session, cache), domains,
+                 args.concurrency)
 
 
 if __name__ == '__main__':
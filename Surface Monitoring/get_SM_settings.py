@@ -1,86 +1,190 @@
 """get_SM_settings.py: retrieve and export the Surface Monitoring settings for all domains in a given Detectify team
 
+Settings are written to the file as they arrive. The output format follows the file extension (.csv or .jsonl,
+optionally followed by .gz for gzip compression) unless --format or --gzip are given.
+
 The API key permissions required by this script are the following:
 - Allow listing domains
 
-Usage: get_SM_settings.py [-h] key file
+With --report, a compliance report is printed once every setting has been fetched: how many domains have each boolean
+setting on or off, the groups of domains with identical settings, and, given a --baseline file of the settings every
+domain should have, which domains deviate from it and what would need to change.
+
+Usage: get_SM_settings.py [-h] [-c CONCURRENCY] [--format {csv,jsonl}] [--gzip]
+                          [--no-http-cache] [--cache-ttl CACHE_TTL] [--report] [--baseline FILE]
+                          key file
+
+Settings fetched by earlier runs are revalidated with conditional requests where the API supports them.
 """
 
 import argparse
 import csv
+import json
+import os
+import sys
+import time
+from typing import Iterable, Iterator
 import requests
 
-API_BASE_URL = 'https://api.detectify.com/rest'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
 
+from detectify import API_BASE_URL, daemon, httpcache, metrics, ratelimit, timeouts  # noqa: E402
+from detectify.bulk import pooled_session  # noqa: E402
+from detectify.compliance import SettingsMatrix, boolean_settings, print_report  # noqa: E402
+from detectify.concurrency import DEFAULT_CONCURRENCY, describe_error, map_ordered  # noqa: E402
+from detectify.export import FORMATS, export_format, open_export, write_jsonl  # noqa: E402
+from detectify.httpcache import ResponseCache  # noqa: E402
+from detectify.pagination import iter_assets  # noqa: E402
+from detectify.store import AssetStore  # noqa: E402
 
-def export_to_csv(asset_settings: list, file: str) -> None:
+
+def export_to_csv(asset_settings: Iterable, file: str, compress: bool = None) -> None:
     """Export all asset settings from a given Detectify team to csv
 
-    :param asset_settings: A list of dictionaries containing asset names and setting information
+    Rows are written as they arrive, with a column per setting of the first asset. Settings that later assets have in
+    addition are written to the 'other' column as JSON. Assets whose settings could not be fetched are written with
+    only their name and the error that occurred.
+
+    :param asset_settings: An iterable of dictionaries containing asset names and either setting information or an error
     :param file: The name of the file to save to
+    :param compress: Whether to gzip the output, defaults to True for file names ending in .gz
     """
-    with open(f'{file}', 'w+', newline='') as f:
+    with open_export(file, compress) as f:
         writer = csv.writer(f)
-        header_row = ['name'] + [x for x in asset_settings[0]['settings']]
-        writer.writerow(header_row)
+        columns = None
+        failed = []  # Failures seen before the first success, when the columns are not yet known
 
         for asset in asset_settings:
-            row = [asset['name']] + list(asset['settings'].values())
-            writer.writerow(row)
+            if 'error' in asset and columns is None:
+                failed.append(asset)
+                continue
+            if columns is None:
+                columns = list(asset['settings'])
+                writer.writerow(['name'] + columns + ['other', 'error'])
+                for failure in failed:
+                    writer.writerow([failure['name']] + [''] * (len(columns) + 1) + [failure['error']])
+            if 'error' in asset:
+                writer.writerow([asset['name']] + [''] * (len(columns) + 1) + [asset['error']])
+            else:
+                other = {setting: value for setting, value in asset['settings'].items() if setting not in columns}
+                writer.writerow([asset['name']] + [asset['settings'].get(x) for x in columns]
+                                + [json.dumps(other) if other else '', ''])
+
+        if columns is None:
+            writer.writerow(['name', 'error'])
+            writer.writerows([[failure['name'], failure['error']] for failure in failed])
+
+
+def export_to_jsonl(asset_settings: Iterable, file: str, compress: bool = None) -> None:
+    """Export all asset settings from a given Detectify team to JSON Lines, one asset per line
+
+    :param asset_settings: An iterable of dictionaries containing asset names and either setting information or an error
+    :param file: The name of the file to save to
+    :param compress: Whether to gzip the output, defaults to True for file names ending in .gz
+    """
+    with open_export(file, compress) as f:
+        for asset in asset_settings:
+            write_jsonl(f, asset)
 
 
-def get_asset_settings(key: str, token: str) -> dict:
+def get_asset_settings(key: str, token: str, cache: ResponseCache = None, session: requests.Session = None) -> dict:
     """Get the Surface Monitoring settings for a given Detectify asset
 
     :param key: A valid Detectify API key
     :param token: A valid asset token for a root asset
+    :param cache: An optional response cache, used to revalidate settings fetched by earlier runs
+    :param session: An optional session to reuse connections between calls
     :return: A dictionary containing all asset settings
     """
     api_endpoint = f'/v2/domains/{token}/settings/'
-    r = requests.get(url=f'{API_BASE_URL}{api_endpoint}',
-                     headers={'X-Detectify-Key': key,
-                              'content-type': 'application/json'})
+    if cache:
+        return cache.get_json(f'{API_BASE_URL}{api_endpoint}', session)
+    r = (session or requests).get(url=f'{API_BASE_URL}{api_endpoint}',
+                                  headers={'X-Detectify-Key': key,
+                                           'content-type': 'application/json'})
+    r.raise_for_status()
     return r.json()
 
 
-def get_root_assets(key: str) -> list:
-    """Get the full list of apex domains from Detectify
+def get_root_assets(key: str) -> AssetStore:
+    """Get the full list of apex domains from Detectify, or from the inventory daemon if it is running
 
     :param key: A valid Detectify API key
-    :return: A list of dictionaries containing asset information
+    :return: A compact store of asset names and tokens
     """
-    marker = ''
-    has_more = True
-    assets = []
-    while has_more:
-        api_endpoint = '/v2/assets/'
-        r = requests.get(url=f'{API_BASE_URL}{api_endpoint}?marker={marker}',
-                         headers={'X-Detectify-Key': key,
-                                  'content-type': 'application/json'})
-        try:
-            marker = r.json()['next_marker']
-        except KeyError:  # next_marker may not exist when has_more is False
-            pass
-        has_more = r.json()['has_more']
-        assets += r.json()['assets']
-    return assets
+    client = daemon.connect(key)
+    if client:
+        return client.inventory()
+    return AssetStore.from_assets(iter_assets(key))
+
+
+def fetch_asset_settings(root_assets: Iterable, key: str, concurrency: int = DEFAULT_CONCURRENCY,
+                         cache: ResponseCache = None) -> Iterator[dict]:
+    """Fetch the settings for each root asset concurrently, yielding them in the same order as the assets
+
+    :param root_assets: An iterable of dictionaries containing asset information
+    :param key: A valid Detectify API key
+    :param concurrency: The maximum number of settings requests in flight at once
+    :param cache: An optional response cache, used to revalidate settings fetched by earlier runs
+    :return: An iterator of dictionaries containing the asset name and either its settings or an error
+    """
+    with pooled_session(concurrency) as session:
+        def fetch(asset: dict) -> dict:
+            return get_asset_settings(key, asset['token'], cache, session)
+
+        for asset, settings, error in map_ordered(fetch, root_assets, concurrency):
+            if error:
+                print(f'Failed to get settings for asset {asset["name"]}: {describe_error(error)}')
+                yield {'name': asset['name'], 'error': describe_error(error)}
+            else:
+                yield {'name': asset['name'], 'settings': settings}
 
 
 def main():
     parser = argparse.ArgumentParser(description='export the Surface Monitoring settings for a given list of domains')
     parser.add_argument('key', type=str, help='a valid Detectify API key')
-    parser.add_argument('file', type=str, help='save location for exported results in .csv format')
+    parser.add_argument('file', type=str, help='save location for exported results in .csv or .jsonl format')
+    parser.add_argument('-c', '--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help=f'number of settings to fetch at once (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('--format', type=str, choices=FORMATS,
+                        help='output format, inferred from the file extension by default')
+    parser.add_argument('--gzip', action='store_true', default=None,
+                        help='gzip the output, implied by a file name ending in .gz')
+    metrics.add_arguments(parser)
+    ratelimit.add_arguments(parser)
+    timeouts.add_arguments(parser)
+    httpcache.add_arguments(parser)
+    parser.add_argument('--report', action='store_true',
+                        help='print a compliance report of the boolean settings once they are all fetched')
+    parser.add_argument('--baseline', type=str, metavar='FILE',
+                        help='a JSON file of the settings every domain should have, reported on (implies --report)')
     args = parser.parse_args()
-
-    root_assets = get_root_assets(args.key)
-    print(f'Retrieved {len(root_assets)} assets')
-    asset_settings = []
-
-    for asset in root_assets:
-        asset_settings.append({'name': asset['name'],
-                               'settings': get_asset_settings(args.key, asset['token'])})
-
-    export_to_csv(asset_settings, args.file)
+    metrics.start(args, 'get_SM_settings')
+    ratelimit.start(args)
+    timeouts.start(args)
+
+    with metrics.phase('enumerate'):
+        root_assets = get_root_assets(args.key)
+        print(f'Retrieved {len(root_assets)} assets')
+
+    # Settings are written as they are fetched, so the export phase includes the settings requests
+    export = export_to_jsonl if export_format(args.file, args.format) == 'jsonl' else export_to_csv
+    cache = httpcache.from_args(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    matrix = SettingsMatrix(boolean_settings(baseline or {})) if args.report or baseline else None
+    with metrics.phase('export'):
+        asset_settings = fetch_asset_settings(root_assets.assets(), args.key, args.concurrency, cache)
+        export(matrix.collect(asset_settings) if matrix is not None else asset_settings, args.file, args.gzip)
+    if cache:
+        cache.report()
+    if matrix is not None:
+        with metrics.phase('analyse'):
+            start = time.perf_counter()
+            print_report(matrix, baseline)
+            print(f'Analysed {len(matrix)} domains in {(time.perf_counter() - start) * 1000:.0f} ms')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,89 @@
+"""asset_memory.py: compare the memory needed to hold a team's assets in the representations used by the scripts
+
+Assets shaped like those returned by /v2/assets/ are generated for a mock team and held as a list of decoded JSON
+dictionaries, as a dictionary of names to tokens, and in a compact AssetStore. The peak memory allocated while building
+each representation and the memory it holds afterwards are measured with tracemalloc.
+
+Usage: asset_memory.py [-h] [--scales SCALES [SCALES ...]]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from mock_server import MockTeam  # noqa: E402
+
+from detectify.store import AssetStore  # noqa: E402
+
+SUBDOMAINS = 9
+
+
+def api_pages(team: MockTeam, page_size: int = 100):
+    """Yield pages of assets as freshly decoded JSON, the way the scripts receive them"""
+    marker = ''
+    while True:
+        page = json.loads(json.dumps(team.page(marker, page_size, include_subdomains=True)))
+        yield page['assets']
+        if not page['has_more']:
+            return
+        marker = page['next_marker']
+
+
+def build_json_list(team: MockTeam):
+    assets = []
+    for page in api_pages(team):
+        assets += page
+    return assets
+
+
+def build_dict(team: MockTeam):
+    return {asset['name']: asset['token'] for page in api_pages(team) for asset in page}
+
+
+def build_store(team: MockTeam):
+    return AssetStore.from_assets(asset for page in api_pages(team) for asset in page)
+
+
+REPRESENTATIONS = [('list of JSON dicts', build_json_list),
+                   ('dict of names to tokens', build_dict),
+                   ('AssetStore', build_store)]
+
+
+def measure(build, team: MockTeam) -> tuple:
+    """Measure the peak and retained memory of building a representation
+
+    :return: The peak and retained bytes allocated, and the build time in seconds
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build(team)
+    duration = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak, retained, duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare the memory used by asset representations')
+    parser.add_argument('--scales', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='total asset counts to measure at (default: 10000 100000 1000000)')
+    args = parser.parse_args()
+
+    print(f'{"representation":<26}{"assets":>10}{"peak MB":>10}{"held MB":>10}{"bytes/asset":>13}{"build s":>9}')
+    for scale in args.scales:
+        team = MockTeam(roots=max(scale // (SUBDOMAINS + 1), 1), subdomains=SUBDOMAINS, profiles=False)
+        count = len(team.assets)
+        for name, build in REPRESENTATIONS:
+            peak, retained, duration = measure(build, team)
+            print(f'{name:<26}{count:>10}{peak / 2 ** 20:>10.1f}{retained / 2 ** 20:>10.1f}'
+                  f'{retained / count:>13.0f}{duration:>9.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""async_client.py: compare fetching settings with a thread per request against the asyncio client
+
+A mock server is started with the given latency per request, and the Surface Monitoring settings of every root asset
+are fetched three ways: with requests on a pool of 8 threads (the scripts' default), with requests on one thread per
+connection, and with detectify.client keeping every call in flight over the same number of connections from a single
+event loop thread. Each mode runs in its own process, away from the mock server's threads, and reports its total time
+and the peak number of threads it used.
+
+Usage: async_client.py [-h] [--roots ROOTS] [--latency LATENCY] [--connections CONNECTIONS]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from mock_server import MockConfig, MockHandler, MockTeam, start_server  # noqa: E402
+
+from detectify.bulk import pooled_session  # noqa: E402
+from detectify.client import Client  # noqa: E402
+from detectify.concurrency import map_ordered  # noqa: E402
+
+
+def with_threads(url: str, tokens: list, workers: int) -> int:
+    session = pooled_session(workers)
+
+    def fetch(token: str) -> dict:
+        r = session.get(f'{url}/v2/domains/{token}/settings/', headers={'X-Detectify-Key': 'benchmark'})
+        r.raise_for_status()
+        return r.json()
+
+    return sum(error is None for _, _, error in map_ordered(fetch, tokens, workers))
+
+
+def with_client(url: str, tokens: list, connections: int) -> int:
+    with Client('benchmark', base_url=url, connections=connections) as client:
+        outcomes = client.map(lambda api, token: api.domain_settings(token), tokens, in_flight=len(tokens))
+        return sum(error is None for _, _, error in outcomes)
+
+
+def worker(args: argparse.Namespace) -> None:
+    """Fetch the settings of every root asset in one mode and print the duration and peak thread count as JSON"""
+    r = pooled_session().get(f'{args.url}/v2/assets/', headers={'X-Detectify-Key': 'benchmark'})
+    tokens = [asset['token'] for asset in r.json()['assets']]
+    peak = threading.active_count()
+    done = threading.Event()
+
+    def sample():
+        nonlocal peak
+        while not done.wait(0.005):
+            peak = max(peak, threading.active_count() - 1)  # not counting this thread
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    if args.mode == 'asyncio':
+        succeeded = with_client(args.url, tokens, args.connections)
+    else:
+        succeeded = with_threads(args.url, tokens, args.workers)
+    duration = time.perf_counter() - start
+    done.set()
+    sampler.join()
+    print(json.dumps({'calls': len(tokens), 'succeeded': succeeded, 'duration': duration, 'threads': peak}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare threaded requests with the asyncio client')
+    parser.add_argument('--roots', type=int, default=2000, help='root assets to fetch settings for (default: 2000)')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds of latency per request (default: 0.05)')
+    parser.add_argument('--connections', type=int, default=64,
+                        help='connections for the threaded and asyncio runs (default: 64)')
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    parser.add_argument('--mode', help=argparse.SUPPRESS)
+    parser.add_argument('--workers', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.mode:
+        return worker(args)
+
+    # The mock handler writes headers and body separately, which Nagle's algorithm holds back until the client's delayed
+    # ACK on every reused connection. Real servers do not, and the extra 40 ms per call would swamp the latency measured
+    MockHandler.disable_nagle_algorithm = True
+    team = MockTeam(roots=args.roots, subdomains=0, profiles=False)
+    server = start_server(team, MockConfig(page_size=args.roots, latency=args.latency, etags=False))
+    modes = [('8 threads', ['--mode', 'threads', '--workers', '8']),
+             (f'{args.connections} threads', ['--mode', 'threads', '--workers', str(args.connections)]),
+             (f'asyncio, {args.connections} conns', ['--mode', 'asyncio'])]
+    print(f'{"mode":<22}{"total s":>9}{"calls/s":>9}{"ok":>7}{"threads":>9}')
+    for name, options in modes:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--url', server.base_url,
+                                 '--connections', str(args.connections)] + options,
+                                check=True, capture_output=True, text=True).stdout
+        result = json.loads(output)
+        print(f'{name:<22}{result["duration"]:>9.2f}{result["calls"] / result["duration"]:>9.0f}'
+              f'{result["succeeded"]:>7}{result["threads"]:>9}')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,411 @@
+"""mock_server.py: a local stand-in for the Detectify v2 API, for benchmarking the scripts without touching production
+
+The server implements the endpoints used by the scripts in this repository against an in-memory team:
+- GET, POST /v2/assets/ and DELETE /v2/assets/{token}/, with marker pagination
+- GET, PUT /v2/domains/{token}/settings/
+- GET, POST /v2/profiles/
+- GET, POST /v2/scans/{token}/
+- GET /v2/scanschedules/ and DELETE /v2/scanschedules/{token}/
+- POST /v2/zone/file/
+
+Latency, page size, error rate, 429 injection and stragglers (a fraction of requests that take much longer to answer)
+are configurable. GET responses carry an ETag and are answered with
+304 Not Modified when the client sends a matching If-None-Match, unless --no-etags is given. GET /_stats returns request
+counts and bytes transferred, and POST /_reset clears them.
+
+Point the scripts at the server with DETECTIFY_API_BASE_URL=http://127.0.0.1:<port>
+
+Usage: mock_server.py [-h] [--port PORT] [--assets ASSETS] [--subdomains SUBDOMAINS] [--page-size PAGE_SIZE]
+                      [--latency LATENCY] [--error-rate ERROR_RATE] [--throttle-rate THROTTLE_RATE]
+                      [--retry-after RETRY_AFTER] [--no-etags] [--scan-duration SCAN_DURATION]
+                      [--straggler-rate STRAGGLER_RATE] [--straggler-delay STRAGGLER_DELAY]
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+DEFAULT_SETTINGS = {'brute_force': True,
+                    'custom_headers': {},
+                    'enable_active_tls_assessments': False,
+                    'enable_certificate_assessments': True,
+                    'enable_passive_tls_assessments': True,
+                    'enable_tls_discovery': True,
+                    'fingerprinting': True,
+                    'include_discovered_ports_in_surface_monitoring': False,
+                    'monitoring': True,
+                    'requests_per_second': 0,
+                    'scrape': True,
+                    'ssl_audit': True,
+                    'stateless_tests': True,
+                    'subdomain_takeover_tests': True}
+
+
+def make_token(name: str) -> str:
+    return hashlib.sha1(name.encode()).hexdigest()[:32]
+
+
+class MockConfig:
+    """Tunable behaviour of the mock server"""
+
+    def __init__(self, page_size: int = 100, latency: float = 0.0, error_rate: float = 0.0,
+                 throttle_rate: float = 0.0, retry_after: float = 1.0, etags: bool = True, scan_duration: float = 0.0,
+                 straggler_rate: float = 0.0, straggler_delay: float = 1.0, seed: int = 0):
+        """
+        :param page_size: The number of assets returned per page of /v2/assets/
+        :param latency: The number of seconds every request takes before it is answered
+        :param error_rate: The fraction of requests answered with 503
+        :param throttle_rate: The fraction of requests answered with 429
+        :param retry_after: The value of the Retry-After header sent with 429 responses, in seconds
+        :param etags: Whether GET responses carry an ETag and honour If-None-Match
+        :param scan_duration: The number of seconds a started scan stays running
+        :param straggler_rate: The fraction of requests delayed by straggler_delay on top of the latency
+        :param straggler_delay: The extra number of seconds a straggling request takes
+        :param seed: The seed for the random number generator deciding which requests fail
+        """
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.etags = etags
+        self.scan_duration = scan_duration
+        self.straggler_rate = straggler_rate
+        self.straggler_delay = straggler_delay
+        self.random = random.Random(seed)
+
+
+class MockTeam:
+    """The in-memory state of a single Detectify team"""
+
+    def __init__(self, roots: int = 100, subdomains: int = 9, profiles: bool = True):
+        """
+        :param roots: The number of root assets
+        :param subdomains: The number of subdomains under each root asset
+        :param profiles: Whether to create a scan profile, with a schedule, for every root asset
+        """
+        self.lock = threading.Lock()
+        self.assets = {}  # token -> asset, in insertion order
+        self.order = []  # tokens in listing order, with None for deleted assets
+        self.settings = {}
+        self.profiles = {}
+        self.schedules = set()
+        self.scans = Counter()
+        self.running = {}  # profile token -> time its scan finishes
+        self.zone_files = 0
+        for i in range(roots):
+            root = self.add_asset(f'domain{i:06d}.com')
+            for j in range(subdomains):
+                self.add_asset(f'sub{j}.{root["name"]}', root_token=root['token'])
+            if profiles:
+                profile = self.add_profile(root['token'], f'www.{root["name"]}')
+                self.schedules.add(profile['token'])
+
+    def add_asset(self, name: str, root_token: str = None) -> dict:
+        token = make_token(name)
+        asset = {'token': token,
+                 'name': name,
+                 'status': 'verified',
+                 'monitored': True,
+                 'created': '2023-01-01T00:00:00Z',
+                 'updated': '2023-01-01T00:00:00Z',
+                 'discovered': '2023-01-01T00:00:00Z',
+                 'last_seen': '2023-06-01T00:00:00Z',
+                 'source': {'value': 'manual' if root_token is None else 'detectify'}}
+        self.assets[token] = {'asset': asset, 'root': root_token}
+        self.order.append(token)
+        if root_token is None:
+            self.settings[token] = dict(DEFAULT_SETTINGS)
+        return asset
+
+    def add_profile(self, asset_token: str, endpoint: str) -> dict:
+        token = make_token(f'profile:{endpoint}')
+        profile = {'token': token, 'name': endpoint, 'endpoint': endpoint, 'asset_token': asset_token,
+                   'created': '2023-01-01T00:00:00Z', 'status': 'verified'}
+        self.profiles[token] = profile
+        return profile
+
+    def page(self, marker: str, page_size: int, include_subdomains: bool) -> dict:
+        """Get one page of the asset listing, using the listing offset as the marker"""
+        offset = int(marker) if marker.isdigit() else 0
+        assets = []
+        while offset < len(self.order) and len(assets) < page_size:
+            token = self.order[offset]
+            offset += 1
+            entry = self.assets.get(token)
+            if entry and (include_subdomains or entry['root'] is None):
+                assets.append(entry['asset'])
+        page = {'assets': assets, 'has_more': offset < len(self.order)}
+        if page['has_more']:
+            page['next_marker'] = str(offset)
+        return page
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: 'MockServer'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, body=None, headers: dict = None) -> None:
+        data = b'' if body is None else json.dumps(body).encode()
+        headers = dict(headers or {})
+        if self.command == 'GET' and status == 200 and self.server.config.etags:
+            etag = f'"{hashlib.sha1(data).hexdigest()}"'
+            headers['ETag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                status, data = 304, b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.record(self.command, self.path, status, len(data))
+
+    def read_body(self) -> bytes:
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = b''
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def handle_request(self) -> None:
+        url = urlsplit(self.path)
+        body = self.read_body()
+        self.server.received(len(body))
+        if url.path == '/_stats':
+            return self.send_json(200, self.server.stats())
+        if url.path == '/_reset':
+            self.server.reset_stats()
+            return self.send_json(200, {})
+
+        config = self.server.config
+        if config.latency:
+            time.sleep(config.latency)
+        if config.straggler_rate:
+            with self.server.team.lock:
+                straggler = config.random.random() < config.straggler_rate
+            if straggler:
+                time.sleep(config.straggler_delay)
+        if not self.headers.get('X-Detectify-Key'):
+            return self.send_json(401, {'error': 'missing API key'})
+        with self.server.team.lock:
+            roll = config.random.random()
+        if roll < config.throttle_rate:
+            return self.send_json(429, {'error': 'rate limited'}, {'Retry-After': f'{config.retry_after:g}'})
+        if roll < config.throttle_rate + config.error_rate:
+            return self.send_json(503, {'error': 'service unavailable'})
+
+        for method, pattern, route in ROUTES:
+            match = re.fullmatch(pattern, url.path)
+            if method == self.command and match:
+                with self.server.team.lock:
+                    status, response = route(self.server, match, parse_qs(url.query), body)
+                return self.send_json(status, response)
+        self.send_json(404, {'error': 'not found'})
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+
+def list_assets(server, match, query, body):
+    page = server.team.page(query.get('marker', [''])[0], server.config.page_size,
+                            query.get('include_subdomains', ['false'])[0] == 'true')
+    return 200, page
+
+
+def create_asset(server, match, query, body):
+    name = json.loads(body or b'{}').get('name')
+    if not name:
+        return 400, {'error': 'name is required'}
+    if make_token(name) in server.team.assets:
+        return 409, {'error': 'asset already exists'}
+    return 200, server.team.add_asset(name)
+
+
+def delete_asset(server, match, query, body):
+    if server.team.assets.pop(match['token'], None) is None:
+        return 404, {'error': 'asset not found'}
+    server.team.settings.pop(match['token'], None)
+    return 200, {}
+
+
+def get_settings(server, match, query, body):
+    settings = server.team.settings.get(match['token'])
+    return (200, settings) if settings is not None else (404, {'error': 'asset not found'})
+
+
+def update_settings(server, match, query, body):
+    if match['token'] not in server.team.settings:
+        return 404, {'error': 'asset not found'}
+    server.team.settings[match['token']].update(json.loads(body or b'{}'))
+    return 200, server.team.settings[match['token']]
+
+
+def list_profiles(server, match, query, body):
+    return 200, list(server.team.profiles.values())
+
+
+def create_profile(server, match, query, body):
+    payload = json.loads(body or b'{}')
+    if payload.get('asset_token') not in server.team.assets:
+        return 400, {'error': 'asset not found'}
+    return 200, server.team.add_profile(payload['asset_token'], payload.get('endpoint', ''))
+
+
+def start_scan(server, match, query, body):
+    if match['token'] not in server.team.profiles:
+        return 404, {'error': 'scan profile not found'}
+    if server.team.running.get(match['token'], 0) > time.time():
+        return 409, {'error': 'a scan is already running'}
+    server.team.scans[match['token']] += 1
+    server.team.running[match['token']] = time.time() + server.config.scan_duration
+    return 202, {}
+
+
+def get_scan_status(server, match, query, body):
+    if match['token'] not in server.team.profiles:
+        return 404, {'error': 'scan profile not found'}
+    if server.team.running.get(match['token'], 0) > time.time():
+        return 200, {'scan_profile_token': match['token'], 'state': 'running'}
+    return 404, {'error': 'no active scan'}
+
+
+def list_schedules(server, match, query, body):
+    return 200, [{'scan_profile_token': token, 'frequency': 'weekly'} for token in sorted(server.team.schedules)]
+
+
+def delete_schedule(server, match, query, body):
+    if match['token'] not in server.team.schedules:
+        return 404, {'error': 'scan schedule not found'}
+    server.team.schedules.discard(match['token'])
+    return 202, {}
+
+
+def upload_zone_file(server, match, query, body):
+    if b'$ORIGIN' not in body:
+        return 400, {'error': 'zone file must specify an $ORIGIN'}
+    server.team.zone_files += 1
+    return 200, {}
+
+
+ROUTES = [('GET', r'/v2/assets/', list_assets),
+          ('POST', r'/v2/assets/', create_asset),
+          ('DELETE', r'/v2/assets/(?P<token>[^/]+)/', delete_asset),
+          ('GET', r'/v2/domains/(?P<token>[^/]+)/settings/', get_settings),
+          ('PUT', r'/v2/domains/(?P<token>[^/]+)/settings/', update_settings),
+          ('GET', r'/v2/profiles/', list_profiles),
+          ('POST', r'/v2/profiles/', create_profile),
+          ('GET', r'/v2/scans/(?P<token>[^/]+)/', get_scan_status),
+          ('POST', r'/v2/scans/(?P<token>[^/]+)/', start_scan),
+          ('GET', r'/v2/scanschedules/', list_schedules),
+          ('DELETE', r'/v2/scanschedules/(?P<token>[^/]+)/', delete_schedule),
+          ('POST', r'/v2/zone/file/', upload_zone_file)]
+
+
+class MockServer(ThreadingHTTPServer):
+    """A threaded HTTP server holding a mock team and request statistics"""
+
+    daemon_threads = True
+    request_queue_size = 128  # the default of 5 drops connections opened in a burst, which then wait for a SYN retry
+
+    def __init__(self, address: tuple, team: MockTeam, config: MockConfig):
+        super().__init__(address, MockHandler)
+        self.team = team
+        self.config = config
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def reset_stats(self) -> None:
+        with self._stats_lock:
+            self.requests = Counter()
+            self.statuses = Counter()
+            self.bytes_sent = 0
+            self.bytes_received = 0
+
+    def received(self, size: int) -> None:
+        with self._stats_lock:
+            self.bytes_received += size
+
+    def record(self, method: str, path: str, status: int, size: int) -> None:
+        if path.startswith('/_'):
+            return
+        endpoint = re.sub(r'/[0-9a-f]{32}/', '/{token}/', urlsplit(path).path)
+        with self._stats_lock:
+            self.requests[f'{method} {endpoint}'] += 1
+            self.statuses[status] += 1
+            self.bytes_sent += size
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {'requests': dict(self.requests),
+                    'statuses': {str(code): count for code, count in self.statuses.items()},
+                    'total_requests': sum(self.requests.values()),
+                    'bytes_sent': self.bytes_sent,
+                    'bytes_received': self.bytes_received}
+
+
+def start_server(team: MockTeam, config: MockConfig, port: int = 0) -> MockServer:
+    """Start a mock server on a background thread
+
+    :param team: The team the server should serve
+    :param config: The behaviour of the server
+    :param port: The port to listen on, or 0 to pick a free port
+    :return: The running server; call shutdown() to stop it
+    """
+    server = MockServer(('127.0.0.1', port), team, config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='run a local mock of the Detectify v2 API')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on (default: 8000)')
+    parser.add_argument('--assets', type=int, default=1000,
+                        help='total number of assets, including subdomains (default: 1000)')
+    parser.add_argument('--subdomains', type=int, default=9, help='subdomains per root asset (default: 9)')
+    parser.add_argument('--page-size', type=int, default=100, help='assets per page (default: 100)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds of latency per request (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests failing with 503')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of requests failing with 429')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='Retry-After sent with 429s (default: 1)')
+    parser.add_argument('--no-etags', action='store_true', help='do not send ETags or answer with 304 Not Modified')
+    parser.add_argument('--scan-duration', type=float, default=0.0,
+                        help='seconds a started scan stays running (default: 0)')
+    parser.add_argument('--straggler-rate', type=float, default=0.0,
+                        help='fraction of requests answered after an extra --straggler-delay')
+    parser.add_argument('--straggler-delay', type=float, default=1.0,
+                        help='extra seconds taken by straggling requests (default: 1)')
+    args = parser.parse_args()
+
+    team = MockTeam(roots=max(args.assets // (args.subdomains + 1), 1), subdomains=args.subdomains)
+    config = MockConfig(args.page_size, args.latency, args.error_rate, args.throttle_rate, args.retry_after,
+                        not args.no_etags, args.scan_duration, args.straggler_rate, args.straggler_delay)
+    server = MockServer(('127.0.0.1', args.port), team, config)
+    print(f'Serving {len(team.assets)} assets at {server.base_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""run_benchmarks.py: measure how the scripts in this repository scale, against the local mock API server
+
+Every script is run as a separate process against a fresh mock team at each scale, with a cold local cache. For each
+run the harness reports wall time, the number of API requests made, requests per second and the peak RSS of the script.
+
+Results can be saved with --output and compared against an earlier run with --baseline, so that a performance change
+can be shown with before and after numbers.
+
+Usage: run_benchmarks.py [-h] [--scales SCALES [SCALES ...]] [--scripts SCRIPTS [SCRIPTS ...]] [--latency LATENCY]
+                         [--page-size PAGE_SIZE] [--error-rate ERROR_RATE] [--throttle-rate THROTTLE_RATE]
+                         [--output OUTPUT] [--baseline BASELINE]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_server import MockConfig, MockTeam, start_server
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+SUBDOMAINS = 9
+KEY = 'benchmark-key'
+
+
+def write_lines(path: str, lines) -> str:
+    with open(path, 'w') as f:
+        f.writelines(f'{line}\n' for line in lines)
+    return path
+
+
+def root_names(team: MockTeam) -> list:
+    return [entry['asset']['name'] for entry in team.assets.values() if entry['root'] is None]
+
+
+# Each scenario maps a name to the script to run and a function building its arguments in a working directory
+SCENARIOS = {
+    'get_all_assets': ('Asset Management/get_all_assets.py',
+                       lambda team, tmp: [KEY, '-f', os.path.join(tmp, 'assets.csv')]),
+    'add_assets': ('Asset Management/add_assets.py',
+                   lambda team, tmp: [KEY, '-f', write_lines(os.path.join(tmp, 'new.txt'),
+                                                             [f'new-{name}' for name in root_names(team)])]),
+    'delete_assets': ('Asset Management/delete_assets.py',
+                      lambda team, tmp: [KEY, '-f', write_lines(os.path.join(tmp, 'roots.txt'), root_names(team))]),
+    'get_SM_settings': ('Surface Monitoring/get_SM_settings.py',
+                        lambda team, tmp: [KEY, os.path.join(tmp, 'settings.csv')]),
+    'bulk_update_SM_settings_from_list': ('Surface Monitoring/bulk_update_SM_settings_from_list.py',
+                                          lambda team, tmp: [write_lines(os.path.join(tmp, 'roots.txt'),
+                                                                         root_names(team)), KEY]),
+    'add_scan_profiles': ('Application Scanning/add_scan_profiles.py',
+                          lambda team, tmp: [KEY, '-f', write_lines(os.path.join(tmp, 'endpoints.txt'),
+                                                                    [f'app.{name}' for name in root_names(team)])]),
+    'run_all_application_scans': ('Application Scanning/run_all_application_scans.py', lambda team, tmp: [KEY]),
+    'remove_all_scan_profile_schedules': ('Application Scanning/remove_all_scan_profile_schedules.py',
+                                          lambda team, tmp: [KEY]),
+}
+
+
+def run_scenario(name: str, scale: int, config: MockConfig) -> dict:
+    """Run a single script against a fresh mock team of a given size
+
+    :param name: The name of a scenario in SCENARIOS
+    :param scale: The total number of assets in the team, including subdomains
+    :param config: The behaviour of the mock server
+    :return: A dictionary of measurements
+    """
+    script, build_args = SCENARIOS[name]
+    team = MockTeam(roots=max(scale // (SUBDOMAINS + 1), 1), subdomains=SUBDOMAINS)
+    server = start_server(team, config)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, DETECTIFY_API_BASE_URL=server.base_url, DETECTIFY_CACHE_DIR=tmp)
+            command = [sys.executable, os.path.join(REPO_ROOT, script)] + build_args(team, tmp)
+            start = time.perf_counter()
+            process = subprocess.Popen(command, cwd=tmp, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            _, status, usage = os.wait4(process.pid, 0)
+            wall_time = time.perf_counter() - start
+            stderr = process.stderr.read().decode(errors='replace')
+            process.stderr.close()
+        stats = server.stats()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    exit_code = os.waitstatus_to_exitcode(status)
+    if exit_code != 0:
+        print(f'{name} at {scale} assets exited with {exit_code}:\n{stderr}', file=sys.stderr)
+    peak_rss_kb = usage.ru_maxrss if sys.platform != 'darwin' else usage.ru_maxrss // 1024
+    return {'scenario': name,
+            'scale': scale,
+            'exit_code': exit_code,
+            'wall_time': wall_time,
+            'requests': stats['total_requests'],
+            'requests_per_second': stats['total_requests'] / wall_time if wall_time else 0.0,
+            'peak_rss_mb': peak_rss_kb / 1024,
+            'statuses': stats['statuses']}
+
+
+def print_results(results: list, baseline: dict = None) -> None:
+    """Print a table of results, with the change in wall time and peak RSS if a baseline is given
+
+    :param results: A list of measurements from run_scenario
+    :param baseline: Earlier measurements, keyed by (scenario, scale)
+    """
+    header = f'{"scenario":<36}{"scale":>8}{"wall s":>10}{"requests":>10}{"req/s":>10}{"RSS MB":>9}'
+    print(header + ('  vs baseline (time, RSS)' if baseline else ''))
+    for result in results:
+        line = (f'{result["scenario"]:<36}{result["scale"]:>8}{result["wall_time"]:>10.2f}{result["requests"]:>10}'
+                f'{result["requests_per_second"]:>10.1f}{result["peak_rss_mb"]:>9.1f}')
+        before = (baseline or {}).get((result['scenario'], result['scale']))
+        if before:
+            line += (f'  {result["wall_time"] / before["wall_time"]:.2f}x, '
+                     f'{result["peak_rss_mb"] / before["peak_rss_mb"]:.2f}x')
+        if result['exit_code']:
+            line += f'  (exit code {result["exit_code"]})'
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the scripts against a local mock Detectify API')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='total asset counts to benchmark at (default: 1000 10000 100000)')
+    parser.add_argument('--scripts', type=str, nargs='+', choices=sorted(SCENARIOS), default=list(SCENARIOS),
+                        help='scripts to benchmark (default: all)')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='seconds of latency per request (default: 0.005)')
+    parser.add_argument('--page-size', type=int, default=100, help='assets per page (default: 100)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests failing with 503')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of requests failing with 429')
+    parser.add_argument('--output', type=str, help='save the results to this JSON file')
+    parser.add_argument('--baseline', type=str, help='compare against results saved earlier with --output')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {(result['scenario'], result['scale']): result for result in json.load(f)['results']}
+
+    results = []
+    for scale in args.scales:
+        for name in args.scripts:
+            config = MockConfig(args.page_size, args.latency, args.error_rate, args.throttle_rate)
+            results.append(run_scenario(name, scale, config))
+            print(f'{name} at {scale} assets: {results[-1]["wall_time"]:.2f}s')
+
+    print()
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""startup_time.py: measure how long the `detectify` command takes to start, compared to running the scripts directly
+
+Every command is run repeatedly as a new process and the median wall time is reported, next to the time Python takes to
+start and do nothing at all. No command here talks to the API; they show the fixed cost paid on every invocation.
+
+Usage: startup_time.py [-h] [-n RUNS]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+KEY = 'benchmark-key'
+
+COMMANDS = [
+    ('python -c pass', ['-c', 'pass']),
+    ('detectify --help', ['-m', 'detectify', '--help']),
+    ('detectify assets --help', ['-m', 'detectify', 'assets', '--help']),
+    ('detectify inventory show', ['-m', 'detectify', 'inventory', 'show', KEY]),
+    ('detectify assets list --help', ['-m', 'detectify', 'assets', 'list', '--help']),
+    ('get_all_assets.py --help', [os.path.join(REPO_ROOT, 'Asset Management', 'get_all_assets.py'), '--help']),
+]
+
+
+def time_command(args: list, runs: int, env: dict) -> float:
+    """Run a Python command repeatedly and return its median wall time in seconds"""
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, check=True)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='measure the startup time of the detectify command')
+    parser.add_argument('-n', '--runs', type=int, default=20, help='runs per command (default: 20)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DETECTIFY_CACHE_DIR=tmp)
+        baseline = None
+        print(f'{"command":<32}{"median ms":>10}{"over python":>13}')
+        for name, command in COMMANDS:
+            duration = time_command(command, args.runs, env)
+            baseline = duration if baseline is None else baseline
+            print(f'{name:<32}{duration * 1000:>10.1f}{(duration - baseline) * 1000:>+13.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""tail_latency.py: measure how retries and hedged GETs cut the tail latency caused by slow requests
+
+A mock server is started with a fraction of requests injected as stragglers, and the Surface Monitoring settings of
+every root asset are fetched with a pool of workers, once with plain timeouts and once with hedged GETs. Each mode runs
+in its own process, since the request policy is installed process-wide. The latency of every call as seen by the
+caller is reported as percentiles, with the total time and the number of requests the server received.
+
+Usage: tail_latency.py [-h] [--calls CALLS] [--latency LATENCY] [--straggler-rate STRAGGLER_RATE]
+                       [--straggler-delay STRAGGLER_DELAY] [--workers WORKERS]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from mock_server import MockConfig, MockTeam, start_server  # noqa: E402
+
+from detectify import timeouts  # noqa: E402
+from detectify.bulk import pooled_session  # noqa: E402
+from detectify.concurrency import map_ordered  # noqa: E402
+
+MODES = [('timeouts only', []),
+         ('hedged GETs', ['--hedge'])]
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def worker(args: argparse.Namespace) -> None:
+    """Fetch the settings of every root asset through the request policy and print the latencies as JSON"""
+    policy = timeouts.start(args)
+    session = pooled_session(args.workers)
+    tokens = [asset['token'] for asset in session.get(f'{args.url}/v2/assets/',
+                                                      headers={'X-Detectify-Key': 'benchmark'}).json()['assets']]
+    tokens = (tokens * (args.calls // len(tokens) + 1))[:args.calls]
+
+    def fetch(token: str) -> float:
+        start = time.perf_counter()
+        r = session.get(f'{args.url}/v2/domains/{token}/settings/', headers={'X-Detectify-Key': 'benchmark'})
+        r.raise_for_status()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = [latency for _, latency, error in map_ordered(fetch, tokens, args.workers) if error is None]
+    print(json.dumps({'latencies': latencies, 'duration': time.perf_counter() - start, 'hedged': policy.hedged,
+                      'hedges_won': policy.hedges_won}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare tail latency with and without hedged GETs')
+    parser.add_argument('--calls', type=int, default=2000, help='settings requests per mode (default: 2000)')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds of latency per request (default: 0.005)')
+    parser.add_argument('--straggler-rate', type=float, default=0.02,
+                        help='fraction of requests that straggle (default: 0.02)')
+    parser.add_argument('--straggler-delay', type=float, default=0.5,
+                        help='extra seconds taken by straggling requests (default: 0.5)')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent requests (default: 8)')
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args, rest = parser.parse_known_args()
+    if args.worker:
+        timeouts_parser = argparse.ArgumentParser()
+        timeouts.add_arguments(timeouts_parser)
+        timeouts_parser.parse_args(rest, namespace=args)
+        return worker(args)
+
+    team = MockTeam(roots=100, subdomains=0, profiles=False)
+    print(f'{"mode":<16}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"max ms":>9}{"total s":>9}'
+          f'{"requests":>10}{"hedges":>8}{"won":>6}')
+    for name, options in MODES:
+        server = start_server(team, MockConfig(page_size=1000, latency=args.latency,
+                                               straggler_rate=args.straggler_rate,
+                                               straggler_delay=args.straggler_delay))
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', '--url', server.base_url,
+                                 '--calls', str(args.calls), '--workers', str(args.workers)] + options,
+                                check=True, capture_output=True, text=True).stdout
+        result = json.loads(output)
+        latencies = result['latencies']
+        requests_received = server.stats()['total_requests']
+        server.shutdown()
+        print(f'{name:<16}{percentile(latencies, 0.5) * 1000:>9.1f}{percentile(latencies, 0.95) * 1000:>9.1f}'
+              f'{percentile(latencies, 0.99) * 1000:>9.1f}{max(latencies) * 1000:>9.1f}{result["duration"]:>9.2f}'
+              f'{requests_received:>10}{result["hedged"]:>8}{result["hedges_won"]:>6}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+"""detectify: shared helpers for the Detectify v2 API example scripts
+
+The scripts under `Asset Management/`, `Application Scanning/` and `Surface Monitoring/` add the repository root to
+`sys.path` so that they can import from this package while still being runnable as standalone files.
+
+The API base URL can be overridden with the DETECTIFY_API_BASE_URL environment variable, for example to point the
+scripts at the mock server in `benchmarks/`.
+"""
+
+import os
+
+API_BASE_URL = os.environ.get('DETECTIFY_API_BASE_URL', 'https://api.detectify.com/rest')
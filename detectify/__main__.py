@@ -0,0 +1,3 @@
+from detectify.cli import main
+
+main()
@@ -0,0 +1,84 @@
+"""bulk.py: run many POST/DELETE calls concurrently over a pooled keep-alive session
+
+The scripts that add or remove things in bulk send one request per domain. Running those requests on a small pool of
+workers that share a session hides most of the round-trip latency and avoids opening a new connection for every call.
+"""
+
+from collections import Counter
+from typing import Callable, Iterable, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from detectify.concurrency import DEFAULT_CONCURRENCY, describe_error, map_ordered
+
+
+def pooled_session(workers: int = DEFAULT_CONCURRENCY) -> requests.Session:
+    """Create a session whose connection pool is large enough to keep one connection alive per worker
+
+    :param workers: The number of threads that will share the session
+    :return: A requests session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class BulkSummary:
+    """Counts of the outcomes of a bulk run, grouped by HTTP status code"""
+
+    def __init__(self):
+        self.status_codes = Counter()
+        self.errors = Counter()
+        self.skipped = 0
+
+    def record(self, response: Optional[requests.Response], error: Optional[Exception] = None) -> None:
+        """Record the outcome of a single call
+
+        :param response: The response received, or None if the call was skipped or failed
+        :param error: The exception raised by the call, if any
+        """
+        if error is not None:
+            self.errors[type(error).__name__] += 1
+        elif response is None:
+            self.skipped += 1
+        else:
+            self.status_codes[response.status_code] += 1
+
+    @property
+    def succeeded(self) -> int:
+        return sum(count for code, count in self.status_codes.items() if code < 400)
+
+    @property
+    def failed(self) -> int:
+        return sum(count for code, count in self.status_codes.items() if code >= 400) + sum(self.errors.values())
+
+    def report(self) -> None:
+        """Print the summary"""
+        print(f'Summary: {self.succeeded} succeeded, {self.failed} failed, {self.skipped} skipped')
+        for code, count in sorted(self.status_codes.items()):
+            print(f'  HTTP {code}: {count}')
+        for name, count in sorted(self.errors.items()):
+            print(f'  {name}: {count}')
+
+
+def run_bulk(func: Callable, items: Iterable, workers: int = DEFAULT_CONCURRENCY) -> BulkSummary:
+    """Call a function on every item concurrently and summarise the responses
+
+    Items are consumed lazily on the calling thread, so they may be produced by a generator that is not thread-safe,
+    and no more than twice the number of workers are in flight at any time.
+
+    :param func: A function taking a single item and returning a response, or None to skip the item
+    :param items: The items to process
+    :param workers: The number of concurrent calls
+    :return: A summary of the responses
+    """
+    summary = BulkSummary()
+    for item, response, error in map_ordered(func, items, workers):
+        if error is not None:
+            print(f'Request for {item} failed: {describe_error(error)}')
+        summary.record(response, error)
+    summary.report()
+    return summary
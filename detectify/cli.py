@@ -0,0 +1,123 @@
+"""cli.py: a single `detectify` command exposing every script as a subcommand
+
+Subcommands are only looked up by name until one is run, so `detectify --help` and the help of a command group import
+nothing beyond the standard library. A script, and everything it imports, is only loaded once its subcommand is run.
+Each script parses the remaining arguments itself, so `detectify assets add --help` shows the same options as
+`add_assets.py --help`.
+
+Usage: detectify [-h] <group> [<command>] [args ...]
+
+Example: detectify assets list $DETECTIFY_KEY -f assets.csv
+"""
+
+import os
+import runpy
+import sys
+from typing import List, Optional
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.join(PACKAGE_DIR, os.pardir)
+
+# group -> command -> (script directory, installed package, script file, description)
+COMMANDS = {
+    'assets': {
+        'list': ('Asset Management', 'asset_management', 'get_all_assets.py',
+                 'list every asset in a team, optionally exporting or diffing them'),
+        'add': ('Asset Management', 'asset_management', 'add_assets.py', 'add assets or upload zone files'),
+        'delete': ('Asset Management', 'asset_management', 'delete_assets.py', 'delete assets'),
+    },
+    'sm': {
+        'get': ('Surface Monitoring', 'surface_monitoring', 'get_SM_settings.py',
+                'export the Surface Monitoring settings of every root asset'),
+        'update': ('Surface Monitoring', 'surface_monitoring', 'bulk_update_SM_settings_from_list.py',
+                   'update the Surface Monitoring settings of a list of domains'),
+    },
+    'scans': {
+        'run': ('Application Scanning', 'application_scanning', 'run_all_application_scans.py',
+                'start a scan for every scan profile'),
+        'unschedule': ('Application Scanning', 'application_scanning', 'remove_all_scan_profile_schedules.py',
+                       'remove the schedule of every scan profile'),
+    },
+    'profiles': {
+        'add': ('Application Scanning', 'application_scanning', 'add_scan_profiles.py', 'create scan profiles'),
+    },
+}
+
+# Commands implemented by a module of this package rather than a script
+MODULES = {
+    'inventory': ('detectify.inventory', 'manage the local asset inventory cache'),
+    'teams': ('detectify.teams', 'run a command for every team in a key file'),
+    'daemon': ('detectify.daemon', 'keep the asset inventory warm in memory for other commands'),
+}
+
+
+def script_path(directory: str, package: str, file: str) -> str:
+    """Find a script in a source checkout or, failing that, in an installed copy of the package
+
+    :param directory: The directory of the script in the repository
+    :param package: The name of the package the script is installed as, under detectify.scripts
+    :param file: The file name of the script
+    :return: The path to the script
+    """
+    path = os.path.join(REPO_ROOT, directory, file)
+    if os.path.isfile(path):
+        return os.path.normpath(path)
+    return os.path.join(PACKAGE_DIR, 'scripts', package, file)
+
+
+def usage() -> str:
+    lines = ['usage: detectify [-h] <group> [<command>] [args ...]', '', 'commands:']
+    for group, commands in COMMANDS.items():
+        for command, (_, _, _, description) in commands.items():
+            lines.append(f'  {group + " " + command:<20}{description}')
+    for name, (_, description) in MODULES.items():
+        lines.append(f'  {name:<20}{description}')
+    lines += ['', 'Run `detectify <group> <command> --help` for the options of a command.']
+    return '\n'.join(lines)
+
+
+def group_usage(group: str) -> str:
+    lines = [f'usage: detectify {group} <command> [args ...]', '', 'commands:']
+    for command, (_, _, _, description) in COMMANDS[group].items():
+        lines.append(f'  {command:<12}{description}')
+    return '\n'.join(lines)
+
+
+def run(argv: List[str], path: Optional[str] = None, module: Optional[str] = None) -> None:
+    """Run a script or module as if it had been started from the command line
+
+    :param argv: The arguments to pass on
+    :param path: The path of a script to run
+    :param module: The name of a module to run, instead of a script
+    """
+    sys.argv = [path or module] + argv
+    if module:
+        runpy.run_module(module, run_name='__main__', alter_sys=True)
+    else:
+        runpy.run_path(path, run_name='__main__')
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage())
+        sys.exit(0 if argv else 2)
+
+    group, rest = argv[0], argv[1:]
+    if group in MODULES:
+        run(rest, module=MODULES[group][0])
+        return
+    if group not in COMMANDS:
+        sys.exit(f'{usage()}\n\ndetectify: error: unknown command {group!r}')
+    if not rest or rest[0] in ('-h', '--help'):
+        print(group_usage(group))
+        sys.exit(0 if rest else 2)
+    command = rest[0]
+    if command not in COMMANDS[group]:
+        sys.exit(f'{group_usage(group)}\n\ndetectify: error: unknown command {group} {command!r}')
+    directory, package, file, _ = COMMANDS[group][command]
+    run(rest[1:], path=script_path(directory, package, file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,503 @@
+"""client.py: an asyncio client for the v2 endpoints used by the scripts, with a synchronous facade
+
+The scripts build URLs and headers by hand around blocking `requests` calls, and need one thread per request in flight.
+AsyncClient sends requests from coroutines instead, with aiohttp over a pool of keep-alive connections, so a single
+thread can have thousands of calls outstanding: as many are on the wire as there are connections, and the rest wait for
+the next free connection rather than opening more. Like requests, it honours HTTPS_PROXY and NO_PROXY. The base URL,
+the X-Detectify-Key header and the endpoint paths live in one place, request bodies are built from typed models
+(NewAsset, NewScanProfile) and listings are decoded into typed models (Asset, AssetPage, ScanProfile, ScanStatus,
+ScanSchedule). Mutations return the Response itself, so callers can
+report its status code and reason as the scripts do today.
+
+Requests follow a timeouts.RequestPolicy (connect and read timeouts, the job deadline, and jittered retries of
+idempotent requests) and, when given, are paced by a ratelimit.RateLimiter. Every request is recorded in the metrics.
+Errors are raised as the requests exceptions the scripts already handle: requests.Timeout, requests.ConnectionError
+and, from raise_for_status, requests.HTTPError.
+
+Client runs an AsyncClient on an event loop in a background thread, so that synchronous code can call the same
+endpoints one at a time, or map an endpoint over many items with thousands of calls in flight:
+
+    with Client(key) as client:
+        for asset, settings, error in client.map(lambda api, asset: api.domain_settings(asset.token), assets):
+            ...
+"""
+
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, List, Optional
+from urllib.parse import urlencode
+
+import requests
+
+try:
+    import aiohttp
+except ImportError:  # pip install 'detectify-api-v2-examples[async]'
+    aiohttp = None
+
+from detectify import API_BASE_URL
+from detectify.metrics import METRICS, endpoint_name
+from detectify.ratelimit import DEFAULT_MAX_RETRIES, RateLimiter, parse_retry_after
+from detectify.timeouts import IDEMPOTENT_METHODS, RETRY_STATUSES, RequestPolicy
+from detectify.zonefile import iter_chunks
+
+DEFAULT_CONNECTIONS = 32
+DEFAULT_IN_FLIGHT = 1000
+USER_AGENT = 'detectify-api-v2-examples'
+
+
+class Response:
+    """A response read from the API, with the parts of requests.Response that the scripts use"""
+
+    def __init__(self, method: str, url: str, status_code: int, reason: str, headers: Dict[str, str],
+                 content: bytes):
+        self.method = method
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers  # lowercase names
+        self.content = content
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+    def raise_for_status(self) -> None:
+        """Raise requests.HTTPError if the API answered with an error status"""
+        if not self.ok:
+            raise requests.HTTPError(f'{self.status_code} {self.reason} for {self.method} {self.url}', response=self)
+
+
+class Asset:
+    """An asset, as listed by /v2/assets/"""
+
+    def __init__(self, token: str, name: str, status: str = '', monitored: bool = False, raw: Optional[dict] = None):
+        self.token = token
+        self.name = name
+        self.status = status
+        self.monitored = monitored
+        self.raw = raw if raw is not None else {'token': token, 'name': name}
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'Asset':
+        return cls(data['token'], data['name'], data.get('status', ''), bool(data.get('monitored')), data)
+
+
+class AssetPage:
+    """One page of /v2/assets/"""
+
+    def __init__(self, assets: List[Asset], has_more: bool, next_marker: str = ''):
+        self.assets = assets
+        self.has_more = has_more
+        self.next_marker = next_marker
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'AssetPage':
+        # next_marker may not exist when has_more is False
+        return cls([Asset.from_json(asset) for asset in data['assets']], bool(data.get('has_more')),
+                   data.get('next_marker', ''))
+
+
+class ScanProfile:
+    """An Application Scan profile, as listed by /v2/profiles/"""
+
+    def __init__(self, token: str, name: str, endpoint: str, asset_token: str = '', raw: Optional[dict] = None):
+        self.token = token
+        self.name = name
+        self.endpoint = endpoint
+        self.asset_token = asset_token
+        self.raw = raw if raw is not None else {'token': token, 'name': name, 'endpoint': endpoint}
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'ScanProfile':
+        name = data.get('name') or data.get('endpoint', '')
+        return cls(data['token'], name, data.get('endpoint') or name, data.get('asset_token', ''), data)
+
+
+class ScanStatus:
+    """The status of the scan of a profile, from /v2/scans/{token}/"""
+
+    def __init__(self, profile_token: str, state: str, raw: Optional[dict] = None):
+        self.profile_token = profile_token
+        self.state = state
+        self.raw = raw if raw is not None else {'scan_profile_token': profile_token, 'state': state}
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'ScanStatus':
+        return cls(data.get('scan_profile_token', ''), str(data.get('state') or data.get('status') or ''), data)
+
+
+class ScanSchedule:
+    """The schedule of a scan profile, as listed by /v2/scanschedules/"""
+
+    def __init__(self, profile_token: str, frequency: str = '', raw: Optional[dict] = None):
+        self.profile_token = profile_token
+        self.frequency = frequency
+        self.raw = raw if raw is not None else {'scan_profile_token': profile_token, 'frequency': frequency}
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'ScanSchedule':
+        return cls(data['scan_profile_token'], data.get('frequency', ''), data)
+
+
+class NewAsset:
+    """The body of a request adding an asset"""
+
+    def __init__(self, name: str):
+        self.name = name.strip()
+
+    def to_json(self) -> dict:
+        return {'name': self.name}
+
+
+class NewScanProfile:
+    """The body of a request creating a scan profile"""
+
+    def __init__(self, asset_token: str, endpoint: str):
+        """
+        :param asset_token: The token of the root asset the endpoint belongs to
+        :param endpoint: The domain or URL to scan
+        """
+        self.asset_token = asset_token
+        self.endpoint = endpoint
+
+    def to_json(self) -> dict:
+        return {'asset_token': self.asset_token, 'endpoint': self.endpoint}
+
+
+class AsyncClient:
+    """Coroutines calling the v2 endpoints of one Detectify team over a shared pool of connections"""
+
+    def __init__(self, key: str, base_url: str = API_BASE_URL, connections: int = DEFAULT_CONNECTIONS,
+                 policy: Optional[RequestPolicy] = None, limiter: Optional[RateLimiter] = None):
+        """
+        :param key: A valid Detectify API key
+        :param base_url: The base URL of the API
+        :param connections: The maximum number of connections open at once
+        :param policy: The timeouts, deadline and retries to apply, such as the one returned by timeouts.start
+        :param limiter: An optional rate limiter pacing every request, such as the one returned by ratelimit.start
+        """
+        if aiohttp is None:
+            raise ImportError("detectify.client needs aiohttp: pip install 'detectify-api-v2-examples[async]'")
+        self.key = key
+        self.base_url = base_url.rstrip('/')
+        self.connections = connections
+        self.policy = policy or RequestPolicy()
+        self.limiter = limiter
+        self._session = None
+
+    async def __aenter__(self) -> 'AsyncClient':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        """Close the connections"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _client(self) -> 'aiohttp.ClientSession':
+        # Created on first use, so that it belongs to the loop the client runs on. Proxies are taken from the
+        # environment (HTTPS_PROXY, NO_PROXY), as requests does
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connections), trust_env=True,
+                headers={'X-Detectify-Key': self.key, 'Accept': 'application/json', 'User-Agent': USER_AGENT})
+        return self._session
+
+    async def request(self, method: str, path: str, params: Optional[dict] = None, body: Optional[bytes] = None,
+                      content_type: str = 'application/json', headers: Optional[Dict[str, str]] = None) -> Response:
+        """Send a request to the API, retrying it as the request policy allows
+
+        :param method: The HTTP method
+        :param path: The path of the endpoint, such as '/v2/profiles/'
+        :param params: Query parameters
+        :param body: The request body
+        :param content_type: The content type of the body
+        :param headers: Additional request headers
+        :raises requests.Timeout: If the API did not answer in time, or the job's deadline has passed
+        :raises requests.ConnectionError: If the connection failed
+        :return: The response, whatever its status code
+        """
+        url = f'{self.base_url}{path}' + (f'?{urlencode(params)}' if params else '')
+        endpoint = endpoint_name(method, url)
+        headers = dict(headers or {}, **{'Content-Type': content_type})
+
+        attempts = 1 + (self.policy.retries if method in IDEMPOTENT_METHODS else 0)
+        attempt = throttled = 0
+        while True:
+            if self.limiter:
+                await self.limiter.acquire_async()
+            connect_timeout, read_timeout = self.policy.timeout(endpoint)
+            attempt += 1
+            start = time.perf_counter()
+            try:
+                response = await self._send(method, url, body, headers, connect_timeout, read_timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                METRICS.observe(endpoint, type(e).__name__, time.perf_counter() - start, len(body or b''), 0)
+                if attempt >= attempts:
+                    raise
+            else:
+                METRICS.observe(endpoint, str(response.status_code), time.perf_counter() - start, len(body or b''),
+                                len(response.content))
+                if self.limiter and response.status_code == 429:
+                    self.limiter.throttled(parse_retry_after(response.headers.get('retry-after')))
+                    if throttled >= DEFAULT_MAX_RETRIES:
+                        return response
+                    throttled += 1
+                    attempt -= 1  # a throttled request does not count as a failed attempt
+                    continue
+                if self.limiter:
+                    self.limiter.succeeded()
+                if response.status_code not in RETRY_STATUSES or attempt >= attempts:
+                    return response
+            self.policy.retried += 1
+            await asyncio.sleep(self.policy.backoff(attempt))
+
+    async def _send(self, method: str, url: str, body: Optional[bytes], headers: Dict[str, str],
+                    connect_timeout: float, read_timeout: float) -> Response:
+        # Waiting for a free connection is bounded only by the deadline, so that thousands of calls can queue for it
+        timeout = aiohttp.ClientTimeout(total=self.policy.remaining(), sock_connect=connect_timeout,
+                                        sock_read=read_timeout)
+        try:
+            async with self._client().request(method, url, data=body, headers=headers, timeout=timeout) as r:
+                return Response(method, url, r.status, r.reason or '',
+                                {name.lower(): value for name, value in r.headers.items()}, await r.read())
+        except aiohttp.ConnectionTimeoutError as e:
+            raise requests.ConnectTimeout(f'{method} {url}: no connection after {connect_timeout:g} s') from e
+        except asyncio.TimeoutError as e:
+            raise requests.ReadTimeout(f'{method} {url}: no response after {read_timeout:g} s') from e
+        except aiohttp.ClientError as e:
+            raise requests.ConnectionError(f'{method} {url}: {e}') from e
+
+    async def _json(self, method: str, path: str, params: Optional[dict] = None) -> Any:
+        r = await self.request(method, path, params)
+        r.raise_for_status()
+        return r.json()
+
+    async def map_ordered(self, func: Callable[[Any], Awaitable], items: Iterable,
+                          in_flight: int = DEFAULT_IN_FLIGHT) -> AsyncIterator[tuple]:
+        """Await a coroutine function on every item, yielding outcomes in input order
+
+        Items are consumed lazily, with at most in_flight calls started and not yet yielded.
+
+        :param func: A coroutine function taking a single item, such as a method of this client
+        :param items: The items to process
+        :param in_flight: The maximum number of calls started at once
+        :return: An async iterator of (item, result, exception) tuples, where exactly one of result and exception is set
+        """
+        async def outcome(item, task: asyncio.Future) -> tuple:
+            try:
+                return item, await task, None
+            except Exception as e:
+                return item, None, e
+
+        pending = deque()
+        for item in items:
+            pending.append((item, asyncio.ensure_future(func(item))))
+            if len(pending) >= max(in_flight, 1):
+                yield await outcome(*pending.popleft())
+        while pending:
+            yield await outcome(*pending.popleft())
+
+    async def asset_page(self, marker: str = '', include_subdomains: bool = False) -> AssetPage:
+        """Get a single page of assets
+
+        :param marker: The marker returned by the previous page, or an empty string for the first page
+        :param include_subdomains: Whether subdomains should be listed alongside root assets
+        """
+        params = {'marker': marker}
+        if include_subdomains:
+            params['include_subdomains'] = 'true'
+        return AssetPage.from_json(await self._json('GET', '/v2/assets/', params))
+
+    async def iter_assets(self, include_subdomains: bool = False) -> AsyncIterator[Asset]:
+        """Iterate over every asset, fetching the next page while the current one is being consumed
+
+        :param include_subdomains: Whether subdomains should be listed alongside root assets
+        """
+        pending = asyncio.ensure_future(self.asset_page('', include_subdomains))
+        while pending:
+            page = await pending
+            pending = asyncio.ensure_future(self.asset_page(page.next_marker, include_subdomains)) \
+                if page.has_more else None
+            for asset in page.assets:
+                yield asset
+
+    async def add_asset(self, asset: NewAsset) -> Response:
+        return await self.request('POST', '/v2/assets/', body=json.dumps(asset.to_json()).encode())
+
+    async def delete_asset(self, asset_token: str) -> Response:
+        return await self.request('DELETE', f'/v2/assets/{asset_token}/')
+
+    async def domain_settings(self, domain_token: str) -> dict:
+        """Get the Surface Monitoring settings of a root asset"""
+        return await self._json('GET', f'/v2/domains/{domain_token}/settings/')
+
+    async def update_domain_settings(self, domain_token: str, settings: dict) -> Response:
+        """Set the Surface Monitoring settings of a root asset
+
+        :param domain_token: The token of the root asset
+        :param settings: The settings to set, with the same names as returned by domain_settings
+        """
+        return await self.request('PUT', f'/v2/domains/{domain_token}/settings/', body=json.dumps(settings).encode())
+
+    async def scan_profiles(self) -> List[ScanProfile]:
+        return [ScanProfile.from_json(profile) for profile in await self._json('GET', '/v2/profiles/')]
+
+    async def create_scan_profile(self, profile: NewScanProfile) -> Response:
+        return await self.request('POST', '/v2/profiles/', body=json.dumps(profile.to_json()).encode())
+
+    async def start_scan(self, profile_token: str) -> Response:
+        return await self.request('POST', f'/v2/scans/{profile_token}/')
+
+    async def scan_status(self, profile_token: str) -> Optional[ScanStatus]:
+        """Get the status of the active scan of a profile
+
+        :return: The status, or None if the profile is not being scanned
+        """
+        r = await self.request('GET', f'/v2/scans/{profile_token}/')
+        if r.status_code == 404:  # No active scan
+            return None
+        r.raise_for_status()
+        return ScanStatus.from_json(r.json())
+
+    async def scan_schedules(self) -> List[ScanSchedule]:
+        return [ScanSchedule.from_json(schedule) for schedule in await self._json('GET', '/v2/scanschedules/')]
+
+    async def delete_scan_schedule(self, profile_token: str) -> Response:
+        return await self.request('DELETE', f'/v2/scanschedules/{profile_token}/')
+
+    async def upload_zone_file(self, path: str, compress: bool = False) -> Response:
+        """Upload a zone file, read in a worker thread so the event loop is not blocked
+
+        :param path: The path to the zone file
+        :param compress: Whether to gzip the zone file
+        """
+        body = await asyncio.get_running_loop().run_in_executor(None, lambda: b''.join(iter_chunks(path, compress)))
+        return await self.request('POST', '/v2/zone/file/', body=body, content_type='text/plain',
+                                  headers={'Content-Encoding': 'gzip'} if compress else None)
+
+
+def _outcome(item, future: Future) -> tuple:
+    try:
+        return item, future.result(), None
+    except Exception as e:
+        return item, None, e
+
+
+class Client:
+    """A synchronous facade running an AsyncClient on an event loop in a background thread
+
+    The methods can be called from any thread. Each one blocks until its request has completed, while map keeps many
+    requests in flight at once without a thread per request.
+    """
+
+    def __init__(self, key: str, **options):
+        """
+        :param key: A valid Detectify API key
+        :param options: Options of AsyncClient, such as connections, policy or limiter
+        """
+        self.aio = AsyncClient(key, **options)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='detectify-client', daemon=True)
+        self._thread.start()
+
+    def __enter__(self) -> 'Client':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close the connections and stop the event loop"""
+        if self._loop.is_closed():
+            return
+        self.run(self.aio.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def run(self, coroutine: Awaitable) -> Any:
+        """Run a coroutine on the client's event loop and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def map(self, func: Callable[[AsyncClient, Any], Awaitable], items: Iterable,
+            in_flight: int = DEFAULT_IN_FLIGHT) -> Iterator[tuple]:
+        """Call an endpoint for every item with many calls in flight, yielding outcomes in input order
+
+        Items are consumed lazily on the calling thread, with at most in_flight calls started and not yet yielded.
+
+        :param func: A function taking the AsyncClient and a single item and returning a coroutine, such as
+            lambda api, token: api.domain_settings(token)
+        :param items: The items to process
+        :param in_flight: The maximum number of calls started at once
+        :return: An iterator of (item, result, exception) tuples, where exactly one of result and exception is set
+        """
+        pending = deque()
+        for item in items:
+            pending.append((item, asyncio.run_coroutine_threadsafe(func(self.aio, item), self._loop)))
+            if len(pending) >= max(in_flight, 1):
+                yield _outcome(*pending.popleft())
+        while pending:
+            yield _outcome(*pending.popleft())
+
+    def request(self, method: str, path: str, **kwargs) -> Response:
+        return self.run(self.aio.request(method, path, **kwargs))
+
+    def asset_page(self, marker: str = '', include_subdomains: bool = False) -> AssetPage:
+        return self.run(self.aio.asset_page(marker, include_subdomains))
+
+    def iter_assets(self, include_subdomains: bool = False) -> Iterator[Asset]:
+        """Iterate over every asset, fetching the next page while the current one is being consumed"""
+        pending = asyncio.run_coroutine_threadsafe(self.aio.asset_page('', include_subdomains), self._loop)
+        while pending:
+            page = pending.result()
+            pending = asyncio.run_coroutine_threadsafe(self.aio.asset_page(page.next_marker, include_subdomains),
+                                                       self._loop) if page.has_more else None
+            yield from page.assets
+
+    def add_asset(self, asset: NewAsset) -> Response:
+        return self.run(self.aio.add_asset(asset))
+
+    def delete_asset(self, asset_token: str) -> Response:
+        return self.run(self.aio.delete_asset(asset_token))
+
+    def domain_settings(self, domain_token: str) -> dict:
+        return self.run(self.aio.domain_settings(domain_token))
+
+    def update_domain_settings(self, domain_token: str, settings: dict) -> Response:
+        return self.run(self.aio.update_domain_settings(domain_token, settings))
+
+    def scan_profiles(self) -> List[ScanProfile]:
+        return self.run(self.aio.scan_profiles())
+
+    def create_scan_profile(self, profile: NewScanProfile) -> Response:
+        return self.run(self.aio.create_scan_profile(profile))
+
+    def start_scan(self, profile_token: str) -> Response:
+        return self.run(self.aio.start_scan(profile_token))
+
+    def scan_status(self, profile_token: str) -> Optional[ScanStatus]:
+        return self.run(self.aio.scan_status(profile_token))
+
+    def scan_schedules(self) -> List[ScanSchedule]:
+        return self.run(self.aio.scan_schedules())
+
+    def delete_scan_schedule(self, profile_token: str) -> Response:
+        return self.run(self.aio.delete_scan_schedule(profile_token))
+
+    def upload_zone_file(self, path: str, compress: bool = False) -> Response:
+        return self.run(self.aio.upload_zone_file(path, compress))
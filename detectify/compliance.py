@@ -0,0 +1,264 @@
+"""compliance.py: analyse the Surface Monitoring settings of a whole team as packed bitsets
+
+Every boolean setting of every domain is stored as one bit. Per domain, the settings form a fingerprint, a 64-bit
+integer with one bit per setting, kept in a flat array next to a mask of the settings the domain reported at all. Per
+setting, the domains form a column, a bitset held in a single Python integer with one bit per domain. Fleet aggregates
+are then a population count per column, a baseline deviation is an XOR of each column with the baseline value, and
+grouping domains by their settings, or by how they deviate from a baseline, is a count of equal fingerprints. None of
+this touches a dictionary per domain, so analysing 100,000 domains takes milliseconds once their settings are fetched.
+
+The tracked settings grow as domains report new ones, so a setting that only some domains report is still compared;
+domains that did not report it count as missing it. Settings that are not booleans, such as custom_headers, are not part
+of the fingerprint, and at most 64 settings are tracked.
+"""
+
+from array import array
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+MAX_SETTINGS = 64
+
+
+def popcount(bits: int) -> int:
+    """Count the bits set in an integer"""
+    return bits.bit_count() if hasattr(bits, 'bit_count') else bin(bits).count('1')
+
+
+def iter_bits(bits: int) -> Iterator[int]:
+    """Iterate over the positions of the bits set in an integer, lowest first"""
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+    for i, byte in enumerate(data):
+        while byte:
+            low = byte & -byte
+            yield i * 8 + low.bit_length() - 1
+            byte ^= low
+
+
+def boolean_settings(settings: dict) -> List[str]:
+    """Get the names of the boolean settings in a domain's settings, in sorted order"""
+    return sorted(name for name, value in settings.items() if isinstance(value, bool))
+
+
+class SettingsMatrix:
+    """The boolean settings of many domains, as per-domain fingerprints and per-setting bitsets"""
+
+    def __init__(self, settings: Sequence[str] = ()):
+        """
+        :param settings: The names of boolean settings to track from the start, such as those of a baseline policy;
+            other boolean settings are tracked as soon as a domain reports them
+        """
+        if len(settings) > MAX_SETTINGS:
+            raise ValueError(f'at most {MAX_SETTINGS} settings can be tracked, got {len(settings)}')
+        self.names = []
+        self.values = array('Q')  # per domain, a bit per setting that is enabled
+        self.known = array('Q')  # per domain, a bit per setting that the domain reported
+        self.failed = []
+        self.untracked = set()  # boolean settings seen after 64 were already tracked
+        self.settings = []
+        self._enabled = []  # per setting, a bit per domain that has it enabled
+        self._reported = []  # per setting, a bit per domain that reported it
+        self._seen = set()  # the boolean settings tracked or untracked
+        self._columns = None
+        self._groups = None
+        for setting in settings:
+            self._track(setting)
+
+    def _track(self, setting: str) -> None:
+        """Start tracking a setting, which every domain added so far did not report"""
+        if setting in self._seen:
+            return
+        self._seen.add(setting)
+        if len(self.settings) >= MAX_SETTINGS:
+            self.untracked.add(setting)
+            return
+        self.settings.append(setting)
+        self._enabled.append(bytearray((len(self.names) + 7) // 8))
+        self._reported.append(bytearray((len(self.names) + 7) // 8))
+        self._columns = None
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, name: str, settings: dict) -> None:
+        """Add a domain's settings
+
+        :param name: The name of the domain
+        :param settings: Its settings, as returned by /v2/domains/{token}/settings/
+        """
+        for setting in sorted(settings.keys() - self._seen):
+            if isinstance(settings[setting], bool):
+                self._track(setting)
+        i = len(self.names)
+        byte, mask = i >> 3, 1 << (i & 7)
+        if mask == 1:
+            for column in self._enabled + self._reported:
+                column.append(0)
+        value = known = 0
+        for bit, setting in enumerate(self.settings):
+            current = settings.get(setting)
+            if isinstance(current, bool):
+                known |= 1 << bit
+                self._reported[bit][byte] |= mask
+                if current:
+                    value |= 1 << bit
+                    self._enabled[bit][byte] |= mask
+        self.names.append(name)
+        self.values.append(value)
+        self.known.append(known)
+        self._columns = self._groups = None
+
+    def collect(self, asset_settings: Iterable[dict]) -> Iterator[dict]:
+        """Add the settings of assets as they pass through, for example on their way to an export
+
+        :param asset_settings: An iterable of dictionaries containing asset names and either settings or an error
+        :return: The same dictionaries
+        """
+        for asset in asset_settings:
+            if 'error' in asset:
+                self.failed.append(asset['name'])
+            else:
+                self.add(asset['name'], asset['settings'])
+            yield asset
+
+    def fingerprint(self, settings: dict) -> Tuple[int, int]:
+        """Encode settings, such as a baseline policy, the same way as a domain's
+
+        :param settings: A dictionary of settings
+        :return: The bits of the enabled settings, and the bits of the settings that are given
+        """
+        value = known = 0
+        for bit, setting in enumerate(self.settings):
+            if isinstance(settings.get(setting), bool):
+                known |= 1 << bit
+                if settings[setting]:
+                    value |= 1 << bit
+        return value, known
+
+    def describe(self, bits: int) -> List[str]:
+        """Get the names of the settings whose bits are set"""
+        return [self.settings[bit] for bit in iter_bits(bits)]
+
+    def columns(self) -> List[Tuple[int, int]]:
+        """Get a pair of bitsets per setting, with a bit per domain
+
+        :return: For each setting, the domains that have it enabled and the domains that reported it
+        """
+        if self._columns is None:
+            self._columns = [(int.from_bytes(enabled, 'little'), int.from_bytes(reported, 'little'))
+                             for enabled, reported in zip(self._enabled, self._reported)]
+        return self._columns
+
+    def aggregates(self) -> Dict[str, Tuple[int, int, int]]:
+        """Count the domains that have each setting enabled, disabled, or not reported
+
+        :return: A dictionary of setting names to (enabled, disabled, missing) counts
+        """
+        counts = {}
+        for setting, (enabled, reported) in zip(self.settings, self.columns()):
+            on, seen = popcount(enabled), popcount(reported)
+            counts[setting] = (on, seen - on, len(self.names) - seen)
+        return counts
+
+    def groups(self) -> Dict[Tuple[int, int], List[int]]:
+        """Group domains with identical settings
+
+        :return: A dictionary of (enabled bits, reported bits) fingerprints to the indices of the domains sharing them,
+            largest group first
+        """
+        if self._groups is None:
+            groups = defaultdict(list)
+            for i, fingerprint in enumerate(zip(self.values, self.known)):
+                groups[fingerprint].append(i)
+            self._groups = dict(sorted(groups.items(), key=lambda group: -len(group[1])))
+        return self._groups
+
+    def deviations(self, baseline: dict) -> Dict[str, int]:
+        """Find the domains whose settings differ from a baseline policy, per setting
+
+        :param baseline: The settings every domain should have; settings it does not mention are not compared
+        :return: A dictionary of setting names to a bitset of the deviating domains, including domains that did not
+            report the setting
+        """
+        for setting in boolean_settings(baseline):  # a setting no domain reported deviates everywhere
+            self._track(setting)
+        everyone = (1 << len(self.names)) - 1
+        deviations = {}
+        for setting, (enabled, reported) in zip(self.settings, self.columns()):
+            if isinstance(baseline.get(setting), bool):
+                expected = everyone if baseline[setting] else 0
+                deviations[setting] = ((enabled ^ expected) & reported) | (everyone & ~reported)
+        return deviations
+
+    def deltas(self, baseline: dict) -> Dict[int, List[int]]:
+        """Group the domains that deviate from a baseline policy by which settings they would need changed
+
+        :param baseline: The settings every domain should have
+        :return: A dictionary of delta fingerprints, with a bit per setting to change, to the indices of the domains
+            needing that change, largest group first
+        """
+        for setting in boolean_settings(baseline):
+            self._track(setting)
+        value, known = self.fingerprint(baseline)
+        deltas = defaultdict(list)
+        # Domains with the same fingerprint need the same change, so the delta is computed once per fingerprint
+        for (current, reported), indices in self.groups().items():
+            delta = ((current ^ value) | ~reported) & known
+            if delta:
+                deltas[delta].extend(indices)
+        return dict(sorted(deltas.items(), key=lambda group: -len(group[1])))
+
+
+def print_report(matrix: SettingsMatrix, baseline: Optional[dict] = None, examples: int = 5,
+                 top: int = 10) -> None:
+    """Print fleet aggregates, the most common settings fingerprints and, given a baseline, the deviations from it
+
+    :param matrix: The settings of the fleet
+    :param baseline: The settings every domain should have
+    :param examples: The number of domain names to show per group
+    :param top: The number of groups to show
+    """
+    def sample(indices: List[int]) -> str:
+        names = ', '.join(matrix.names[i] for i in indices[:examples])
+        return names + (f' and {len(indices) - examples} more' if len(indices) > examples else '')
+
+    total = len(matrix)
+    print(f'Settings of {total} domains' + (f', {len(matrix.failed)} failed to fetch' if matrix.failed else ''))
+    if not total:
+        return
+    if not matrix.settings:
+        print('No boolean settings were reported')
+        return
+    if matrix.untracked:
+        print(f'Only {MAX_SETTINGS} settings are analysed, not: {", ".join(sorted(matrix.untracked))}')
+    width = max(len(setting) for setting in matrix.settings + boolean_settings(baseline or {}))
+    for setting, (enabled, disabled, missing) in matrix.aggregates().items():
+        print(f'  {setting:<{width}}  {enabled:>7} on  {disabled:>7} off  {missing:>7} missing  '
+              f'({enabled / total:.1%} on)')
+
+    groups = matrix.groups()
+    everything = (1 << len(matrix.settings)) - 1
+    print(f'{len(groups)} distinct settings fingerprints')
+    for (value, known), indices in list(groups.items())[:top]:
+        parts = []
+        if ~value & known:
+            parts.append('off: ' + ', '.join(matrix.describe(~value & known)))
+        if everything & ~known:
+            parts.append('missing: ' + ', '.join(matrix.describe(everything & ~known)))
+        print(f'  {len(indices):>7}  {"; ".join(parts) or "all on"}  e.g. {sample(indices)}')
+
+    if baseline is None:
+        return
+    deviations = matrix.deviations(baseline)
+    deviating = 0
+    for bits in deviations.values():
+        deviating |= bits
+    print(f'{total - popcount(deviating)} of {total} domains comply with the baseline')
+    for setting, bits in deviations.items():
+        if bits:
+            print(f'  {setting:<{width}}  {popcount(bits):>7} deviate')
+    deltas = matrix.deltas(baseline)
+    if deltas:
+        print(f'{len(deltas)} distinct changes needed')
+        for delta, indices in list(deltas.items())[:top]:
+            changes = ', '.join(f'{setting} -> {str(baseline[setting]).lower()}' for setting in matrix.describe(delta))
+            print(f'  {len(indices):>7}  {changes}  e.g. {sample(indices)}')
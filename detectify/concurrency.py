@@ -0,0 +1,47 @@
+"""concurrency.py: bounded-concurrency helpers for running many independent API calls at once"""
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator
+
+DEFAULT_CONCURRENCY = 8
+
+
+def _outcome(item, future: Future) -> tuple:
+    try:
+        return item, future.result(), None
+    except Exception as e:
+        return item, None, e
+
+
+def map_ordered(func: Callable, items: Iterable, concurrency: int = DEFAULT_CONCURRENCY) -> Iterator[tuple]:
+    """Call a function on every item using a pool of threads, yielding outcomes in input order
+
+    Items are consumed lazily and at most twice the number of workers are in flight at any time, so memory stays
+    bounded however many items there are. An exception raised for one item is returned alongside it instead of
+    aborting the remaining items.
+
+    :param func: A function taking a single item
+    :param items: The items to process
+    :param concurrency: The maximum number of concurrent calls
+    :return: An iterator of (item, result, exception) tuples, where exactly one of result and exception is set
+    """
+    window = max(concurrency, 1) * 2
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= window:
+                yield _outcome(*pending.popleft())
+        while pending:
+            yield _outcome(*pending.popleft())
+
+
+def describe_error(error: Exception) -> str:
+    """Summarise an exception on a single line for reports
+
+    :param error: The exception to summarise
+    :return: A one-line description of the exception
+    """
+    lines = str(error).splitlines()
+    return f'{type(error).__name__}: {lines[0]}' if lines else type(error).__name__
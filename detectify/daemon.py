@@ -0,0 +1,412 @@
+"""daemon.py: keep a team's asset inventory and scan profiles warm in memory, and answer lookups from the scripts
+
+Every script run normally starts cold: it enumerates assets or lists scan profiles before it can do anything, and
+throws the result away on exit. The daemon holds the asset names and tokens of a team (root assets, and all assets
+including subdomains, in compact AssetStores), an index of root assets and the list of scan profiles, and refreshes them
+in the background every --interval seconds. A refresh builds new copies before swapping them in, so lookups are never
+blocked by it.
+
+The daemon listens on a random port on localhost only, and writes the port and a random secret to a file readable by
+the current user alone in the cache directory. Scripts using the same API key find it through that file and, when it
+is running, use it instead of the local inventory or the API to resolve names to tokens, find root assets and list
+scan profiles. A name the daemon does not know triggers a single refresh, as with the local inventory, and requests
+for a refresh from several scripts at once are served by one enumeration.
+
+Usage: python -m detectify.daemon [-h] [--interval INTERVAL] {serve,status,refresh,stop} key
+"""
+
+import argparse
+import http.client
+import json
+import os
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+import requests
+
+from detectify import API_BASE_URL, ratelimit, timeouts
+from detectify.inventory import cache_dir, team_id
+from detectify.roots import RootIndex
+from detectify.store import AssetStore
+
+DEFAULT_INTERVAL = 15 * 60  # seconds between refreshes
+CONNECT_TIMEOUT = 0.5  # seconds to wait for a daemon that may not be running
+
+
+def state_path(key: str) -> str:
+    """Get the file through which scripts using an API key find its daemon
+
+    :param key: A valid Detectify API key
+    :return: The path to the daemon's state file
+    """
+    return os.path.join(cache_dir(), f'daemon-{team_id(key)[:16]}.json')
+
+
+def get_scan_profiles(key: str) -> list:
+    """Get the full set of scan profiles from a given Detectify team
+
+    :param key: A valid Detectify API key
+    :raises requests.HTTPError: If the scan profiles cannot be listed
+    :return: A list of dictionaries containing identifiers for all Application Scan profiles
+    """
+    r = requests.get(url=f'{API_BASE_URL}/v2/profiles/',
+                     headers={'X-Detectify-Key': key,
+                              'content-type': 'application/json'})
+    r.raise_for_status()
+    return r.json()
+
+
+class Snapshot:
+    """One consistent copy of a team's inventory, replaced as a whole on every refresh"""
+
+    def __init__(self, roots: AssetStore, assets: AssetStore, profiles: list, synced_at: float):
+        self.roots = roots
+        self.assets = assets
+        self.root_index = RootIndex(roots.items())
+        self.profiles = profiles
+        self.synced_at = synced_at  # when the enumeration started, so nothing changed before it is missing
+
+    def store(self, scope: str) -> AssetStore:
+        return self.assets if scope == 'all' else self.roots
+
+
+class InventoryDaemon:
+    """Holds the inventory of a team in memory and keeps it up to date"""
+
+    def __init__(self, key: str, interval: float = DEFAULT_INTERVAL, profiles: bool = True):
+        """
+        :param key: A valid Detectify API key
+        :param interval: The number of seconds between background refreshes
+        :param profiles: Whether to keep the list of scan profiles, which requires permission to list them
+        """
+        self.key = key
+        self.interval = interval
+        self.with_profiles = profiles
+        self.snapshot = None
+        self._refresh_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def refresh(self, requested_at: Optional[float] = None) -> Snapshot:
+        """Re-enumerate the team and swap in the new copy, unless another refresh finished since it was requested
+
+        :param requested_at: When the caller asked for a refresh; defaults to now
+        :return: The current snapshot
+        """
+        from detectify.pagination import iter_assets
+
+        requested_at = time.time() if requested_at is None else requested_at
+        with self._refresh_lock:
+            if self.snapshot is not None and self.snapshot.synced_at >= requested_at:
+                return self.snapshot
+            synced_at = time.time()
+            start = time.perf_counter()
+            roots = AssetStore.from_assets(iter_assets(self.key))
+            assets = AssetStore.from_assets(iter_assets(self.key, include_subdomains=True))
+            profiles = get_scan_profiles(self.key) if self.with_profiles else []
+            self.snapshot = Snapshot(roots, assets, profiles, synced_at)
+            print(f'Refreshed {len(roots)} root assets, {len(assets)} assets and {len(profiles)} scan profiles '
+                  f'in {time.perf_counter() - start:.1f}s')
+            return self.snapshot
+
+    def refresh_forever(self) -> None:
+        """Refresh every interval until stopped, keeping the previous copy if a refresh fails"""
+        while not self._stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f'Refresh failed, keeping the previous inventory: {type(e).__name__}: {e}')
+
+    def serve(self, path: str) -> None:
+        """Load the inventory, then answer queries until stopped
+
+        :param path: The state file to advertise the daemon's address in
+        """
+        self.refresh()
+        server = DaemonServer(self)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'port': server.server_address[1], 'secret': server.secret, 'pid': os.getpid()}, f)
+        refresher = threading.Thread(target=self.refresh_forever, daemon=True)
+        refresher.start()
+        print(f'Serving the inventory on port {server.server_address[1]}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stopped.set()
+            server.server_close()
+            if os.path.exists(path):
+                os.remove(path)
+
+    def status(self) -> dict:
+        snapshot = self.snapshot
+        return {'synced_at': snapshot.synced_at, 'roots': len(snapshot.roots), 'assets': len(snapshot.assets),
+                'profiles': len(snapshot.profiles)}
+
+
+class DaemonHandler(BaseHTTPRequestHandler):
+    """Answers queries against the daemon's current snapshot"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def send_json(self, status: int, body) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self) -> None:
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if not secrets.compare_digest(self.headers.get('X-Daemon-Secret', ''), self.server.secret):
+            return self.send_json(403, {'error': 'invalid secret'})
+        daemon = self.server.daemon
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        snapshot = daemon.snapshot
+        store = snapshot.store(query.get('scope', ['roots'])[0])
+        if self.command == 'GET' and url.path == '/status':
+            return self.send_json(200, daemon.status())
+        if self.command == 'GET' and url.path == '/assets':
+            return self.send_json(200, list(store.items()))
+        if self.command == 'GET' and url.path.startswith('/assets/'):
+            name = unquote(url.path[len('/assets/'):])
+            token = store.get(name)
+            return self.send_json(200, {'name': name, 'token': token}) if token else \
+                self.send_json(404, {'error': 'asset not found'})
+        if self.command == 'GET' and url.path.startswith('/roots/'):
+            root = snapshot.root_index.resolve(unquote(url.path[len('/roots/'):]))
+            return self.send_json(200, {'name': root[0], 'token': root[1]}) if root else \
+                self.send_json(404, {'error': 'no root asset'})
+        if self.command == 'GET' and url.path == '/profiles':
+            return self.send_json(200, snapshot.profiles)
+        if self.command == 'POST' and url.path == '/refresh':
+            try:
+                daemon.refresh(float(query.get('since', [time.time()])[0]))
+            except Exception as e:
+                return self.send_json(502, {'error': f'{type(e).__name__}: {e}'})
+            return self.send_json(200, daemon.status())
+        if self.command == 'POST' and url.path == '/stop':
+            self.send_json(200, {})
+            return threading.Thread(target=self.server.shutdown).start()
+        self.send_json(404, {'error': 'not found'})
+
+    do_GET = do_POST = handle_request
+
+
+class DaemonServer(ThreadingHTTPServer):
+    """An HTTP server on a random localhost port, answering only clients that know its secret"""
+
+    daemon_threads = True
+
+    def __init__(self, daemon: InventoryDaemon):
+        super().__init__(('127.0.0.1', 0), DaemonHandler)
+        self.daemon = daemon
+        self.secret = secrets.token_hex(16)
+
+
+class DaemonClient:
+    """A connection to a running daemon"""
+
+    def __init__(self, port: int, secret: str):
+        self.secret = secret
+        self._connection = http.client.HTTPConnection('127.0.0.1', port, timeout=CONNECT_TIMEOUT)
+        self._lock = threading.Lock()
+
+    def request(self, method: str, path: str, timeout: Optional[float] = CONNECT_TIMEOUT) -> Tuple[int, object]:
+        """Send a query to the daemon
+
+        :param method: The HTTP method
+        :param path: The path and query string
+        :param timeout: The number of seconds to wait for an answer, or None to wait as long as it takes
+        :return: The status code and the decoded JSON body
+        """
+        with self._lock:
+            self._connection.timeout = timeout
+            if self._connection.sock is not None:
+                self._connection.sock.settimeout(timeout)
+            self._connection.request(method, path, headers={'X-Daemon-Secret': self.secret})
+            response = self._connection.getresponse()
+            return response.status, json.loads(response.read())
+
+    def status(self) -> dict:
+        return self.request('GET', '/status')[1]
+
+    def refresh(self, since: Optional[float] = None) -> dict:
+        """Ask the daemon to refresh, and wait until it has
+
+        :param since: Skip the refresh if the daemon has synced since this time
+        :return: The daemon's status after the refresh
+        """
+        path = '/refresh' if since is None else f'/refresh?since={since}'
+        return self.request('POST', path, timeout=None)[1]
+
+    def stop(self) -> None:
+        self.request('POST', '/stop')
+
+    def scan_profiles(self) -> list:
+        return self.request('GET', '/profiles', timeout=None)[1]
+
+    def inventory(self, include_subdomains: bool = False) -> 'RemoteInventory':
+        return RemoteInventory(self, 'all' if include_subdomains else 'roots')
+
+
+class RemoteInventory:
+    """A dictionary-like mapping of asset names to tokens answered by the daemon, with the lookups of AssetInventory
+
+    It also resolves domains to their root asset, like RootIndex.
+    """
+
+    def __init__(self, client: DaemonClient, scope: str):
+        self.client = client
+        self.scope = scope
+        self._requested_at = time.time()
+        self._refreshed = False
+        self._tokens = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        pass
+
+    def refresh(self) -> int:
+        """Make the daemon re-enumerate the team now, and wait until it has
+
+        :return: The number of assets it holds
+        """
+        self._refreshed = True
+        self._tokens.clear()
+        return self.client.refresh()['assets' if self.scope == 'all' else 'roots']
+
+    def lookup(self, name: str, refresh_on_miss: bool = True) -> Optional[str]:
+        """Look up the token for a given asset name, asking the daemon to refresh once if the name is unknown
+
+        :param name: The name of the asset to look up
+        :param refresh_on_miss: Whether an unknown name should trigger a refresh
+        :return: The asset token, or None if the asset does not exist
+        """
+        if name not in self._tokens:
+            status, body = self.client.request('GET', f'/assets/{quote(name, safe="")}?scope={self.scope}')
+            if status == 404 and refresh_on_miss and not self._refreshed:
+                self._refreshed = True
+                self.client.refresh(since=self._requested_at)
+                status, body = self.client.request('GET', f'/assets/{quote(name, safe="")}?scope={self.scope}')
+            self._tokens[name] = body['token'] if status == 200 else None
+        return self._tokens[name]
+
+    def get(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        token = self.lookup(name)
+        return default if token is None else token
+
+    def __getitem__(self, name: str) -> str:
+        token = self.lookup(name)
+        if token is None:
+            raise KeyError(name)
+        return token
+
+    def __contains__(self, name: str) -> bool:
+        return self.lookup(name) is not None
+
+    def __len__(self) -> int:
+        return self.client.status()['assets' if self.scope == 'all' else 'roots']
+
+    def __iter__(self) -> Iterator[str]:
+        return (name for name, _ in self.items())
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        """Iterate over every (name, token) pair the daemon holds
+
+        :return: An iterator of (name, token) tuples
+        """
+        return (tuple(item) for item in self.client.request('GET', f'/assets?scope={self.scope}', timeout=None)[1])
+
+    def assets(self) -> Iterator[dict]:
+        """Iterate over every asset as a small dictionary
+
+        :return: An iterator of dictionaries containing an asset name and token
+        """
+        return ({'name': name, 'token': token} for name, token in self.items())
+
+    def resolve(self, domain: str) -> Optional[tuple]:
+        """Find the longest root asset that a domain belongs to, asking the daemon to refresh once if there is none
+
+        :param domain: The domain to resolve
+        :return: A (name, token) pair for the root asset, or None if the domain does not belong to any root asset
+        """
+        status, body = self.client.request('GET', f'/roots/{quote(domain, safe="")}')
+        if status == 404 and not self._refreshed:
+            self._refreshed = True
+            self.client.refresh(since=self._requested_at)
+            status, body = self.client.request('GET', f'/roots/{quote(domain, safe="")}')
+        return (body['name'], body['token']) if status == 200 else None
+
+
+def connect(key: str) -> Optional[DaemonClient]:
+    """Connect to the daemon for an API key, if one is running
+
+    Setting the DETECTIFY_NO_DAEMON environment variable makes scripts ignore a running daemon.
+
+    :param key: A valid Detectify API key
+    :return: A client, or None if no daemon is running for this key
+    """
+    if os.environ.get('DETECTIFY_NO_DAEMON'):
+        return None
+    try:
+        with open(state_path(key)) as f:
+            state = json.load(f)
+        client = DaemonClient(state['port'], state['secret'])
+        client.status()
+    except (OSError, ValueError, KeyError, http.client.HTTPException):
+        return None
+    return client
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='keep the asset inventory of a team warm for the other scripts')
+    parser.add_argument('command', choices=['serve', 'status', 'refresh', 'stop'],
+                        help='run the daemon in the foreground, show its state, make it refresh, or stop it')
+    parser.add_argument('key', type=str, help='a valid Detectify API key')
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL,
+                        help=f'seconds between background refreshes (default: {DEFAULT_INTERVAL})')
+    parser.add_argument('--no-profiles', action='store_true',
+                        help='do not keep the list of scan profiles, for keys without permission to list them')
+    ratelimit.add_arguments(parser)
+    timeouts.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        if connect(args.key) is not None:
+            parser.exit(1, 'A daemon is already running for this key\n')
+        ratelimit.start(args)
+        timeouts.start(args)
+        InventoryDaemon(args.key, args.interval, not args.no_profiles).serve(state_path(args.key))
+        return
+
+    client = connect(args.key)
+    if client is None:
+        parser.exit(1, 'No daemon is running for this key\n')
+    if args.command == 'stop':
+        client.stop()
+        print('Stopped the daemon')
+        return
+    status = client.refresh() if args.command == 'refresh' else client.status()
+    print(f'{status["roots"]} root assets, {status["assets"]} assets and {status["profiles"]} scan profiles '
+          f'synced at {time.ctime(status["synced_at"])}')
+
+
+if __name__ == '__main__':
+    main()
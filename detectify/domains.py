@@ -0,0 +1,138 @@
+"""domains.py: read lists of domains given on the command line or in files, normalised and without duplicates
+
+Domain files are read lazily, line by line, so a list of any length is never held in memory at once. Every entry is
+normalised before use: comments starting with # and surrounding whitespace are removed, the name is lowercased, a
+trailing dot is dropped and internationalised names are converted to their ASCII (punycode) form, which is how the API
+stores them. Blank lines, invalid names and repeated entries are skipped, so no API call is wasted on them.
+
+Duplicates are detected with a set of 64-bit hashes kept in a flat array, which costs 16 bytes per distinct domain
+whatever its length.
+"""
+
+import hashlib
+import sys
+from array import array
+from itertools import chain
+from typing import Iterable, Iterator, Optional
+
+try:
+    import idna  # IDNA 2008, installed alongside requests
+except ImportError:
+    idna = None
+
+MAX_LENGTH = 253
+
+
+def normalize_domain(entry: str) -> Optional[str]:
+    """Normalise a domain as written by a user into the form the API uses
+
+    :param entry: A domain, optionally followed by a comment
+    :raises ValueError: If the entry is not a valid domain name
+    :return: The normalised domain, or None if the entry is blank or only a comment
+    """
+    domain = entry.split('#', 1)[0].strip().rstrip('.').lower()
+    if not domain:
+        return None
+    if not domain.isascii():
+        try:
+            domain = idna.encode(domain, uts46=True).decode() if idna else domain.encode('idna').decode()
+        except (UnicodeError, ValueError) as e:
+            raise ValueError(f'{entry.strip()!r} is not a valid domain name: {e}') from None
+    labels = domain.split('.')
+    if len(domain) > MAX_LENGTH or any(not label or len(label) > 63 for label in labels) \
+            or any(c.isspace() or c in '/:@' for c in domain):
+        raise ValueError(f'{entry.strip()!r} is not a valid domain name')
+    return domain
+
+
+class SeenSet:
+    """A compact set of strings, stored as 64-bit hashes in an open-addressing table
+
+    Two different strings share a hash with a probability of about n^2 / 2^65, which is negligible for any list of
+    domains.
+    """
+
+    __slots__ = ('_slots', '_size')
+
+    def __init__(self):
+        self._slots = array('Q', [0]) * 1024
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        # 0 marks an empty slot, so it is never used as a hash
+        return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'little') or 1
+
+    def _probe(self, h: int) -> int:
+        mask = len(self._slots) - 1
+        slot = h & mask
+        while self._slots[slot] not in (0, h):
+            slot = (slot + 1) & mask
+        return slot
+
+    def add(self, value: str) -> bool:
+        """Add a string to the set
+
+        :param value: The string to add
+        :return: True if the string was not in the set before
+        """
+        h = self._hash(value)
+        slot = self._probe(h)
+        if self._slots[slot] == h:
+            return False
+        self._slots[slot] = h
+        self._size += 1
+        if 2 * self._size > len(self._slots):
+            old, self._slots = self._slots, array('Q', [0]) * (2 * len(self._slots))
+            for h in old:
+                if h:
+                    self._slots[self._probe(h)] = h
+        return True
+
+    def __contains__(self, value: str) -> bool:
+        h = self._hash(value)
+        return self._slots[self._probe(h)] == h
+
+
+def iter_lines(files: Iterable[str]) -> Iterator[str]:
+    """Stream the lines of several files in turn, without reading any of them whole
+
+    :param files: The names of the files to read, where - reads standard input
+    :return: An iterator of lines
+    """
+    for file in files:
+        if file == '-':
+            yield from sys.stdin
+            continue
+        with open(file, 'r', encoding='utf-8-sig') as f:
+            yield from f
+
+
+def iter_domains(domains: Iterable[str] = (), files: Iterable[str] = ()) -> Iterator[str]:
+    """Stream domains from the command line and from files, normalised, validated and without duplicates
+
+    Invalid entries are reported and skipped.
+
+    :param domains: Domains given directly, such as the values of -d
+    :param files: Files with one domain per line, such as the value of -f
+    :return: An iterator of normalised domains, in the order they were first given
+    """
+    seen = SeenSet()
+    duplicates = 0
+    for entry in chain(domains, iter_lines(files)):
+        try:
+            domain = normalize_domain(entry)
+        except ValueError as e:
+            print(f'Skipping invalid entry: {e}')
+            continue
+        if domain is None:
+            continue
+        if seen.add(domain):
+            yield domain
+        else:
+            duplicates += 1
+    if duplicates:
+        print(f'Skipped {duplicates} duplicate domains')
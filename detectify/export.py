@@ -0,0 +1,48 @@
+"""export.py: incremental CSV and JSON Lines writers, optionally gzip-compressed
+
+Exports are written row by row as the data arrives instead of being collected first, so memory use does not grow with
+the size of the team and an interrupted run still leaves every row written so far on disk.
+"""
+
+import gzip
+import json
+from typing import IO, Optional
+
+FORMATS = ['csv', 'jsonl']
+
+
+def export_format(file: str, fmt: Optional[str] = None) -> str:
+    """Decide which format to write, based on an explicit choice or the file extension
+
+    :param file: The name of the file to save to
+    :param fmt: An explicit format, one of FORMATS
+    :return: The format to write
+    """
+    if fmt:
+        return fmt
+    name = file[:-3] if file.endswith('.gz') else file
+    return 'jsonl' if name.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def open_export(file: str, compress: Optional[bool] = None) -> IO:
+    """Open a file for writing an export, compressing it with gzip if requested or if the name ends in .gz
+
+    :param file: The name of the file to save to
+    :param compress: Whether to gzip the output, defaults to True for file names ending in .gz
+    :return: A text file object suitable for csv.writer or write_jsonl
+    """
+    if compress is None:
+        compress = file.endswith('.gz')
+    if compress:
+        return gzip.open(file, 'wt', newline='', encoding='utf-8')
+    return open(file, 'w+', newline='', encoding='utf-8')
+
+
+def write_jsonl(f: IO, record: dict) -> None:
+    """Write a single record as one line of JSON
+
+    :param f: A text file object
+    :param record: A JSON-serialisable dictionary
+    """
+    f.write(json.dumps(record, separators=(',', ':')))
+    f.write('\n')
@@ -0,0 +1,176 @@
+"""filters.py: select the Application Scan profiles a script acts on, before any scan is started or schedule removed
+
+Profiles can be selected by endpoint, with shell-style globs or a regular expression, by the root domain their
+endpoint belongs to, by whether they have a scan schedule, and by files of profile tokens or endpoints to include or
+exclude. Every criterion is turned into an index once (a compiled pattern, a reverse-label trie of roots, sets of
+tokens and endpoints, the set of scheduled profiles from a single listing call), so selecting from the profile list
+costs a few lookups per profile and no API calls.
+"""
+
+import argparse
+import fnmatch
+import re
+from typing import Iterable, Optional, Set
+from urllib.parse import urlsplit
+
+import requests
+
+from detectify import API_BASE_URL
+from detectify.domains import iter_lines
+from detectify.httpcache import ResponseCache
+from detectify.roots import RootIndex
+
+
+def endpoint_host(endpoint: str) -> str:
+    """Get the host name of a scan profile endpoint, which may include a scheme, port or path
+
+    :param endpoint: The endpoint of a scan profile
+    :return: The lowercase host name
+    """
+    if '://' in endpoint:
+        return (urlsplit(endpoint).hostname or '').lower()
+    return endpoint.split('/', 1)[0].rsplit(':', 1)[0].strip().rstrip('.').lower()
+
+
+def read_selection(files: Iterable[str]) -> Set[str]:
+    """Read files of profile tokens or endpoints, one per line, with comments starting with #
+
+    :param files: The files to read
+    :return: A set of lowercase tokens and endpoints
+    """
+    selection = set()
+    for line in iter_lines(files):
+        entry = line.split('#', 1)[0].strip().lower()
+        if entry:
+            selection.add(entry)
+    return selection
+
+
+def get_scheduled_tokens(key: str, cache: Optional[ResponseCache] = None) -> Set[str]:
+    """Get the tokens of every scan profile that has a scan schedule
+
+    :param key: A valid Detectify API key
+    :param cache: An optional response cache, used to revalidate the list fetched by an earlier run
+    :raises requests.HTTPError: If the schedules cannot be listed
+    :return: A set of scan profile tokens
+    """
+    api_endpoint = '/v2/scanschedules/'
+    if cache:
+        schedules = cache.get_json(f'{API_BASE_URL}{api_endpoint}')
+    else:
+        r = requests.get(url=f'{API_BASE_URL}{api_endpoint}',
+                         headers={'X-Detectify-Key': key,
+                                  'content-type': 'application/json'})
+        r.raise_for_status()
+        schedules = r.json()
+    return {schedule['scan_profile_token'] for schedule in schedules}
+
+
+class ProfileFilter:
+    """A conjunction of criteria on scan profiles; a profile is selected if it meets all of the given criteria"""
+
+    def __init__(self, endpoints: Iterable[str] = (), regex: Optional[str] = None, roots: Iterable[str] = (),
+                 has_schedule: Optional[bool] = None, scheduled: Optional[Set[str]] = None,
+                 include: Optional[Set[str]] = None, exclude: Optional[Set[str]] = None):
+        """
+        :param endpoints: Shell-style patterns, such as *.example.com, of which an endpoint must match at least one
+        :param regex: A regular expression that must match somewhere in the endpoint
+        :param roots: Root domains, of which the endpoint's host must be equal to or a subdomain of at least one
+        :param has_schedule: Only select profiles with (True) or without (False) a scan schedule
+        :param scheduled: The tokens of the scan profiles that have a schedule, required if has_schedule is set
+        :param include: Tokens or endpoints, of which a profile must match at least one
+        :param exclude: Tokens or endpoints, none of which a profile may match
+        """
+        endpoints = list(endpoints)
+        self.endpoints = re.compile('|'.join(fnmatch.translate(pattern.lower()) for pattern in endpoints)) \
+            if endpoints else None
+        self.regex = re.compile(regex, re.IGNORECASE) if regex else None
+        roots = list(roots)
+        self.roots = RootIndex((root, root) for root in roots) if roots else None
+        if has_schedule is not None and scheduled is None:
+            raise ValueError('the tokens of scheduled profiles are required to filter on schedules')
+        self.has_schedule = has_schedule
+        self.scheduled = scheduled
+        self.include = include
+        self.exclude = exclude
+
+    def matches(self, profile: dict) -> bool:
+        """Check whether a scan profile meets every criterion
+
+        :param profile: A dictionary containing the identifiers of an Application Scan profile
+        :return: True if the profile is selected
+        """
+        token = profile['token'].lower()
+        endpoint = profile.get('endpoint') or profile.get('name') or ''
+        host = endpoint_host(endpoint)
+        if self.has_schedule is not None and (profile['token'] in self.scheduled) != self.has_schedule:
+            return False
+        if self.include is not None and not {token, endpoint.lower(), host} & self.include:
+            return False
+        if self.exclude and {token, endpoint.lower(), host} & self.exclude:
+            return False
+        if self.endpoints and not (self.endpoints.match(endpoint.lower()) or self.endpoints.match(host)):
+            return False
+        if self.regex and not self.regex.search(endpoint):
+            return False
+        if self.roots and self.roots.resolve(host) is None:
+            return False
+        return True
+
+    def apply(self, profiles: Iterable[dict]) -> list:
+        """Select the scan profiles that meet every criterion
+
+        :param profiles: The scan profiles to select from
+        :return: A list of the selected profiles, in their original order
+        """
+        profiles = list(profiles)
+        selected = [profile for profile in profiles if self.matches(profile)]
+        if len(selected) != len(profiles):
+            print(f'Selected {len(selected)} of {len(profiles)} scan profiles')
+        return selected
+
+
+def add_arguments(parser: argparse.ArgumentParser, schedule: bool = True) -> None:
+    """Add the profile selection options to a script's argument parser
+
+    :param parser: The script's argument parser
+    :param schedule: Whether to add --has-schedule and --no-schedule
+    """
+    group = parser.add_argument_group('profile selection')
+    group.add_argument('--endpoint', type=str, action='append', default=[], metavar='GLOB',
+                       help='only profiles whose endpoint matches this pattern, such as *.example.com (repeatable)')
+    group.add_argument('--endpoint-regex', type=str, metavar='REGEX',
+                       help='only profiles whose endpoint matches this regular expression')
+    group.add_argument('--root', type=str, action='append', default=[],
+                       help='only profiles whose endpoint is this domain or one of its subdomains (repeatable)')
+    if schedule:
+        scheduled = group.add_mutually_exclusive_group()
+        scheduled.add_argument('--has-schedule', dest='has_schedule', action='store_const', const=True,
+                               help='only profiles with a scan schedule')
+        scheduled.add_argument('--no-schedule', dest='has_schedule', action='store_const', const=False,
+                               help='only profiles without a scan schedule')
+    group.add_argument('--include', type=str, action='append', default=[], metavar='FILE',
+                       help='only profiles whose token or endpoint is listed in this file (repeatable)')
+    group.add_argument('--exclude', type=str, action='append', default=[], metavar='FILE',
+                       help='skip profiles whose token or endpoint is listed in this file (repeatable)')
+
+
+def from_args(args: argparse.Namespace, cache: Optional[ResponseCache] = None,
+              has_schedule: Optional[bool] = None) -> ProfileFilter:
+    """Build the profile filter for a script, listing scan schedules only if a criterion needs them
+
+    :param args: The parsed arguments, including the API key and those added by add_arguments
+    :param cache: An optional response cache for the list of scan schedules
+    :param has_schedule: A schedule criterion imposed by the script, used if none was given on the command line
+    :return: A profile filter
+    """
+    if getattr(args, 'has_schedule', None) is not None:
+        has_schedule = args.has_schedule
+    scheduled = get_scheduled_tokens(args.key, cache) if has_schedule is not None else None
+    return ProfileFilter(endpoints=args.endpoint,
+                         regex=args.endpoint_regex,
+                         roots=[root.strip().rstrip('.').lower() for root in args.root],
+                         has_schedule=has_schedule,
+                         scheduled=scheduled,
+                         include=read_selection(args.include) if args.include else None,
+                         exclude=read_selection(args.exclude) if args.exclude else None)
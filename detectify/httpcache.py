@@ -0,0 +1,170 @@
+"""httpcache.py: a disk-backed cache of GET responses, revalidated with conditional requests
+
+Responses that carry an ETag or Last-Modified header are stored and revalidated on the next request with If-None-Match
+or If-Modified-Since, so an unchanged payload costs a 304 instead of a full transfer. Responses without validators are
+reused until a TTL expires, which is 0 (never reused) unless configured. The cache is an SQLite database in the cache
+directory, keyed per team, and evicts the least recently used responses once it grows beyond its size cap.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+import requests
+
+from detectify.inventory import cache_dir, team_id
+
+DEFAULT_TTL = 0  # seconds
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024  # bytes
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    team TEXT NOT NULL,
+    url TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    stored_at REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    PRIMARY KEY (team, url)
+);
+CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);
+"""
+
+
+class ResponseCache:
+    """A thread-safe, size-capped LRU cache of JSON GET responses for a single team"""
+
+    def __init__(self, key: str, ttl: float = DEFAULT_TTL, max_size: int = DEFAULT_MAX_SIZE,
+                 path: Optional[str] = None):
+        """
+        :param key: A valid Detectify API key
+        :param ttl: How many seconds a response without an ETag or Last-Modified header may be reused for
+        :param max_size: The total size of stored bodies, in bytes, above which old responses are evicted
+        :param path: The SQLite database to use, defaults to responses.sqlite3 in the cache directory
+        """
+        self.key = key
+        self.team = team_id(key)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = self.revalidated = self.misses = 0
+        if path is None:
+            os.makedirs(cache_dir(), exist_ok=True)
+            path = os.path.join(cache_dir(), 'responses.sqlite3')
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def get_json(self, url: str, session: Optional[requests.Session] = None):
+        """GET a URL, answering from the cache where possible, and decode the JSON body
+
+        :param url: The full URL to fetch
+        :param session: An optional session to reuse connections between calls
+        :raises requests.HTTPError: If the API answers with an error
+        :return: The decoded JSON body
+        """
+        with self._lock:
+            row = self.db.execute('SELECT etag, last_modified, body, stored_at FROM responses '
+                                  'WHERE team = ? AND url = ?', (self.team, url)).fetchone()
+        headers = {'X-Detectify-Key': self.key,
+                   'content-type': 'application/json'}
+        if row:
+            etag, last_modified, body, stored_at = row
+            if not (etag or last_modified) and time.time() - stored_at < self.ttl:
+                self._touch(url)
+                return json.loads(body)
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        r = (session or requests).get(url=url, headers=headers)
+        if r.status_code == 304 and row:
+            self._touch(url, revalidated=True)
+            return json.loads(row[2])
+        r.raise_for_status()
+        self._store(url, r)
+        return r.json()
+
+    def invalidate(self, url: str) -> None:
+        """Forget a cached response, for example after changing the resource it describes
+
+        :param url: The full URL of the cached response
+        """
+        with self._lock, self.db:
+            self.db.execute('DELETE FROM responses WHERE team = ? AND url = ?', (self.team, url))
+
+    def _touch(self, url: str, revalidated: bool = False) -> None:
+        now = time.time()
+        with self._lock, self.db:
+            if revalidated:
+                self.revalidated += 1
+                self.db.execute('UPDATE responses SET accessed_at = ?, stored_at = ? WHERE team = ? AND url = ?',
+                                (now, now, self.team, url))
+            else:
+                self.hits += 1
+                self.db.execute('UPDATE responses SET accessed_at = ? WHERE team = ? AND url = ?',
+                                (now, self.team, url))
+
+    def _store(self, url: str, r: requests.Response) -> None:
+        with self._lock:
+            self.misses += 1
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+        if not (etag or last_modified or self.ttl > 0):
+            return  # The response could never be reused
+        body = r.content
+        if len(body) > self.max_size:
+            return
+        now = time.time()
+        with self._lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO responses '
+                            '(team, url, etag, last_modified, body, size, stored_at, accessed_at) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            (self.team, url, etag, last_modified, body, len(body), now, now))
+            self._evict()
+
+    def _evict(self) -> None:
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_size:
+            return
+        for rowid, size in self.db.execute('SELECT rowid, size FROM responses ORDER BY accessed_at').fetchall():
+            self.db.execute('DELETE FROM responses WHERE rowid = ?', (rowid,))
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def report(self) -> None:
+        """Print how many requests the cache answered"""
+        print(f'Response cache: {self.hits} hits, {self.revalidated} revalidated, {self.misses} fetched')
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the --no-http-cache and --cache-ttl options to a script's argument parser
+
+    :param parser: The script's argument parser
+    """
+    parser.add_argument('--no-http-cache', action='store_true',
+                        help='always fetch responses from the API instead of revalidating cached copies')
+    parser.add_argument('--cache-ttl', type=float, default=DEFAULT_TTL,
+                        help='seconds to reuse responses that cannot be revalidated (default: 0)')
+
+
+def from_args(args: argparse.Namespace) -> Optional[ResponseCache]:
+    """Open the response cache for a script, unless disabled
+
+    :param args: The parsed arguments, including the API key and those added by add_arguments
+    :return: A response cache, or None if --no-http-cache was given
+    """
+    if args.no_http_cache:
+        return None
+    return ResponseCache(args.key, ttl=args.cache_ttl)
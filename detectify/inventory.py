@@ -0,0 +1,240 @@
+"""inventory.py: persistent local cache of asset names and tokens, keyed per Detectify team
+
+Looking up a token by name normally requires paging through the whole of /v2/assets/. The inventory keeps the result of
+that enumeration in a local SQLite database so that later runs can answer lookups without talking to the API. Entries
+expire after a TTL, and looking up a name that is not in the cache triggers a single re-sync.
+
+Teams are identified by a hash of their API key; the key itself is never written to disk.
+
+Usage: python -m detectify.inventory [-h] [--subdomains] [--cache-dir CACHE_DIR] {refresh,clear,show} key
+"""
+
+import argparse
+import hashlib
+import os
+import sqlite3
+import time
+from typing import Iterator, Optional
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'detectify')
+DEFAULT_TTL = 60 * 60  # seconds
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS assets (
+    team TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    name TEXT NOT NULL,
+    token TEXT NOT NULL,
+    PRIMARY KEY (team, scope, name)
+);
+CREATE TABLE IF NOT EXISTS syncs (
+    team TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    synced_at REAL NOT NULL,
+    asset_count INTEGER NOT NULL,
+    PRIMARY KEY (team, scope)
+);
+"""
+
+
+def cache_dir() -> str:
+    """Get the directory used for local caches, overridable with the DETECTIFY_CACHE_DIR environment variable
+
+    :return: The path to the cache directory
+    """
+    return os.environ.get('DETECTIFY_CACHE_DIR', DEFAULT_CACHE_DIR)
+
+
+def team_id(key: str) -> str:
+    """Derive a stable, non-reversible identifier for the team an API key belongs to
+
+    :param key: A valid Detectify API key
+    :return: A hex digest identifying the team
+    """
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+class AssetInventory:
+    """A dictionary-like, disk-backed mapping of asset names to asset tokens for a single team
+
+    Root assets and the full listing including subdomains are cached separately, since they are separate listings in
+    the API.
+    """
+
+    def __init__(self, key: str, include_subdomains: bool = False, ttl: float = DEFAULT_TTL,
+                 path: Optional[str] = None):
+        """
+        :param key: A valid Detectify API key
+        :param include_subdomains: Whether the inventory should contain subdomains as well as root assets
+        :param ttl: The number of seconds a sync stays valid for
+        :param path: The SQLite database to use, defaults to inventory.sqlite3 in the cache directory
+        """
+        self.key = key
+        self.team = team_id(key)
+        self.scope = 'all' if include_subdomains else 'roots'
+        self.ttl = ttl
+        self._refreshed = False
+        if path is None:
+            os.makedirs(cache_dir(), exist_ok=True)
+            path = os.path.join(cache_dir(), 'inventory.sqlite3')
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        self.db.close()
+
+    def synced_at(self) -> Optional[float]:
+        """Get the time of the last complete sync of this inventory
+
+        :return: A UNIX timestamp, or None if the inventory has never been synced
+        """
+        row = self.db.execute('SELECT synced_at FROM syncs WHERE team = ? AND scope = ?',
+                              (self.team, self.scope)).fetchone()
+        return row[0] if row else None
+
+    def is_stale(self) -> bool:
+        synced_at = self.synced_at()
+        return synced_at is None or time.time() - synced_at > self.ttl
+
+    def refresh(self) -> int:
+        """Re-enumerate the team's assets from Detectify and replace the cached copy
+
+        Pages are written as they arrive inside a single transaction, so an interrupted refresh leaves the previous
+        copy untouched.
+
+        :return: The number of assets stored
+        """
+        # Imported here so that commands which only read the cache, and team_id() users, do not load requests
+        from detectify.pagination import iter_asset_pages
+
+        print('Refreshing local asset inventory. . .')
+        count = 0
+        with self.db:
+            self.db.execute('DELETE FROM assets WHERE team = ? AND scope = ?', (self.team, self.scope))
+            for page in iter_asset_pages(self.key, include_subdomains=self.scope == 'all'):
+                self.db.executemany('INSERT OR REPLACE INTO assets (team, scope, name, token) VALUES (?, ?, ?, ?)',
+                                    [(self.team, self.scope, asset['name'], asset['token']) for asset in page])
+                count += len(page)
+            self.db.execute('INSERT OR REPLACE INTO syncs (team, scope, synced_at, asset_count) VALUES (?, ?, ?, ?)',
+                            (self.team, self.scope, time.time(), count))
+        self._refreshed = True
+        return count
+
+    def ensure_fresh(self) -> None:
+        """Refresh the inventory if it has never been synced or its TTL has expired"""
+        if self.is_stale():
+            self.refresh()
+
+    def refresh_once(self) -> bool:
+        """Refresh the inventory after a miss, unless it has already been refreshed since it was opened
+
+        :return: Whether the inventory was refreshed
+        """
+        if self._refreshed:
+            return False
+        self.refresh()
+        return True
+
+    def invalidate(self) -> None:
+        """Mark this team's inventory as stale in every scope, after assets were added or deleted, so that the next
+        lookup re-syncs it
+        """
+        with self.db:
+            self.db.execute('DELETE FROM syncs WHERE team = ?', (self.team,))
+
+    def clear(self) -> None:
+        """Remove every cached entry for this team, in all scopes"""
+        with self.db:
+            self.db.execute('DELETE FROM assets WHERE team = ?', (self.team,))
+            self.db.execute('DELETE FROM syncs WHERE team = ?', (self.team,))
+
+    def lookup(self, name: str, refresh_on_miss: bool = True) -> Optional[str]:
+        """Look up the token for a given asset name
+
+        A miss triggers at most one refresh per inventory, so a long list of unknown names does not cause repeated
+        enumerations.
+
+        :param name: The name of the asset to look up
+        :param refresh_on_miss: Whether an unknown name should trigger a re-sync
+        :return: The asset token, or None if the asset does not exist
+        """
+        self.ensure_fresh()
+        token = self._get(name)
+        if token is None and refresh_on_miss and self.refresh_once():
+            token = self._get(name)
+        return token
+
+    def _get(self, name: str) -> Optional[str]:
+        row = self.db.execute('SELECT token FROM assets WHERE team = ? AND scope = ? AND name = ?',
+                              (self.team, self.scope, name)).fetchone()
+        return row[0] if row else None
+
+    def get(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        token = self.lookup(name)
+        return default if token is None else token
+
+    def __getitem__(self, name: str) -> str:
+        token = self.lookup(name)
+        if token is None:
+            raise KeyError(name)
+        return token
+
+    def __contains__(self, name: str) -> bool:
+        return self.lookup(name) is not None
+
+    def __len__(self) -> int:
+        self.ensure_fresh()
+        return self.db.execute('SELECT COUNT(*) FROM assets WHERE team = ? AND scope = ?',
+                               (self.team, self.scope)).fetchone()[0]
+
+    def __iter__(self) -> Iterator[str]:
+        return (name for name, _ in self.items())
+
+    def items(self) -> Iterator[tuple]:
+        """Iterate over every cached (name, token) pair, in name order
+
+        :return: An iterator of (name, token) tuples
+        """
+        self.ensure_fresh()
+        return iter(self.db.execute('SELECT name, token FROM assets WHERE team = ? AND scope = ? ORDER BY name',
+                                    (self.team, self.scope)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='manage the local Detectify asset inventory cache')
+    parser.add_argument('command', choices=['refresh', 'clear', 'show'],
+                        help='refresh the cache from the API, remove it, or show its state')
+    parser.add_argument('key', type=str, help='a valid Detectify API key')
+    parser.add_argument('--subdomains', action='store_true',
+                        help='operate on the inventory including subdomains rather than root assets only')
+    parser.add_argument('--cache-dir', type=str, help='override the cache directory')
+    args = parser.parse_args()
+    if args.cache_dir:
+        os.environ['DETECTIFY_CACHE_DIR'] = args.cache_dir
+
+    with AssetInventory(args.key, include_subdomains=args.subdomains) as inventory:
+        if args.command == 'refresh':
+            print(f'Cached {inventory.refresh()} assets')
+        elif args.command == 'clear':
+            inventory.clear()
+            print('Cleared cached inventory')
+        else:
+            synced_at = inventory.synced_at()
+            if synced_at is None:
+                print('Inventory has never been synced')
+            else:
+                count = inventory.db.execute('SELECT asset_count FROM syncs WHERE team = ? AND scope = ?',
+                                             (inventory.team, inventory.scope)).fetchone()[0]
+                state = 'stale' if inventory.is_stale() else 'fresh'
+                print(f'{count} assets synced at {time.ctime(synced_at)} ({state})')
+
+
+if __name__ == '__main__':
+    main()
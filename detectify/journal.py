@@ -0,0 +1,192 @@
+"""journal.py: append-only checkpoint journal for resumable bulk scripts
+
+Every completed operation is appended to a journal as soon as its response arrives, keyed by the name or token of its
+target. A run started with --resume skips every target the journal already marks as done, so an interrupted run can
+pick up where it stopped instead of starting over. Targets that fail are also written, one per line, to a retry file
+that can be passed back to the script on its own. A run replaying the retry file replaces it when it ends with the
+targets that failed again, plus those it never reached if it was interrupted. Any other run only adds its failures to
+the retry file, so the targets left by an earlier run are kept until they are replayed.
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Callable, Iterable, Iterator, Optional
+
+import requests
+
+from detectify.inventory import cache_dir, team_id
+
+
+class Journal:
+    """A per-script, per-team journal of completed operations"""
+
+    def __init__(self, name: str, key: str, resume: bool = False, path: Optional[str] = None,
+                 retry_path: Optional[str] = None):
+        """
+        :param name: The name of the operation, used to name the journal and retry files
+        :param key: A valid Detectify API key
+        :param resume: Keep the existing journal and skip its completed targets instead of starting afresh
+        :param path: The journal file to use, defaults to a file under journals/ in the cache directory
+        :param retry_path: The file to write failed targets to, defaults to <name>.retry in the working directory
+        """
+        if path is None:
+            path = os.path.join(cache_dir(), 'journals', f'{name}-{team_id(key)[:16]}.jsonl')
+        self.path = path
+        self.retry_path = retry_path or f'{name}.retry'
+        self.done = set()
+        self.failed = 0
+        self._replayed = None  # the targets of the retry file, when it is this run's input
+        self._lock = threading.Lock()
+
+        if resume:
+            self.done = load_completed(path)
+            print(f'Resuming: {len(self.done)} operations already completed')
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._journal = open(path, 'a' if resume else 'w', encoding='utf-8')
+        self._retry_partial = f'{self.retry_path}.partial'
+        self._retry = open(self._retry_partial, 'w', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self.close(interrupted=exc_type is not None)
+
+    def close(self, interrupted: bool = False) -> None:
+        """Close the journal and write the failed targets to the retry file
+
+        :param interrupted: Whether the run ended with an exception, such as a KeyboardInterrupt
+        """
+        self._journal.close()
+        self._retry.close()
+        failed = read_targets(self._retry_partial)
+        if self._replayed is None:
+            if not failed:
+                os.remove(self._retry_partial)
+                return
+            earlier = read_targets(self.retry_path) if os.path.exists(self.retry_path) else []
+            self._replace_retry(earlier + failed)
+        elif interrupted:
+            unprocessed = [target for target in self._replayed if target not in self.done]
+            self._replace_retry(unprocessed + failed)
+            print(f'Interrupted: the targets not yet completed were kept in {self.retry_path}')
+        else:
+            self._replace_retry(failed)
+        if self.failed:
+            print(f'{self.failed} operations failed; their targets were written to {self.retry_path}')
+
+    def _replace_retry(self, targets: list) -> None:
+        targets = list(dict.fromkeys(targets))
+        if not targets:  # every target of the replayed retry file has been completed
+            os.remove(self._retry_partial)
+            if os.path.exists(self.retry_path):
+                os.remove(self.retry_path)
+            return
+        with open(self._retry_partial, 'w', encoding='utf-8') as f:
+            f.writelines(f'{target}\n' for target in targets)
+        os.replace(self._retry_partial, self.retry_path)
+
+    def read_ahead(self, items: Iterable, files: Iterable[str]) -> Iterable:
+        """Read the items eagerly if they come from this journal's retry file, which the run then replaces on exit
+
+        Only a run whose input is the retry file replaces or removes it; other runs add their failures to it.
+
+        :param items: The items to process, possibly a lazy iterator over the files
+        :param files: The input files the items are read from
+        :return: The items, as a list if one of the files is the retry file
+        """
+        retry_path = os.path.abspath(self.retry_path)
+        if any(os.path.abspath(file) == retry_path for file in files if file != '-'):
+            self._replayed = read_targets(self.retry_path)
+            return list(items)
+        return items
+
+    def pending(self, items: Iterable, target: Callable = str) -> Iterator:
+        """Filter out the items whose targets were completed by an earlier run
+
+        :param items: The items to process
+        :param target: A function returning the journal key of an item
+        :return: An iterator of items that still need to be processed
+        """
+        for item in items:
+            if target(item) in self.done:
+                print(f'Skipping {target(item)}, already completed')
+            else:
+                yield item
+
+    def record(self, target: str, response: Optional[requests.Response] = None,
+               error: Optional[Exception] = None) -> None:
+        """Record the outcome of an operation
+
+        :param target: The journal key of the operation's target
+        :param response: The response received, if any
+        :param error: The exception raised by the operation, if any
+        """
+        ok = error is None and response is not None and response.status_code < 400
+        entry = {'target': target, 'ok': ok, 'time': time.time()}
+        if response is not None:
+            entry['status'] = response.status_code
+        with self._lock:
+            self._journal.write(json.dumps(entry) + '\n')
+            self._journal.flush()
+            if ok:
+                self.done.add(target)
+            else:
+                self.failed += 1
+                self._retry.write(f'{target}\n')
+                self._retry.flush()
+
+    def track(self, func: Callable, target: Callable = str) -> Callable:
+        """Wrap a function so that the outcome of each call is recorded in the journal
+
+        Calls that return None are treated as skipped and are not recorded.
+
+        :param func: A function taking a single item and returning a response, or None to skip the item
+        :param target: A function returning the journal key of an item
+        :return: A function with the same signature as func
+        """
+        def tracked(item):
+            try:
+                response = func(item)
+            except Exception as e:
+                self.record(target(item), error=e)
+                raise
+            if response is not None:
+                self.record(target(item), response)
+            return response
+        return tracked
+
+
+def load_completed(path: str) -> set:
+    """Read the set of completed targets from a journal
+
+    A partially written last line, as left by a crash, is ignored.
+
+    :param path: The journal file
+    :return: A set of journal keys
+    """
+    done = set()
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry.get('ok'):
+                    done.add(entry['target'])
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def read_targets(file: str) -> list:
+    """Read a list of targets, such as a retry file, one per line
+
+    :param file: The file to read
+    :return: A list of non-empty lines
+    """
+    with open(file, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
@@ -0,0 +1,242 @@
+"""metrics.py: request-level instrumentation and metrics export for the scripts
+
+Once installed, every request sent through `requests`, whether from a session or the module-level helpers, is timed
+and counted per endpoint and status code along with the bytes sent and received. Scripts can also time their phases
+(enumerate, resolve, mutate, export) with `phase`. At exit, the metrics are written as a JSON summary and/or a
+Prometheus textfile, for example for node_exporter's textfile collector.
+
+Output paths are taken from --metrics-json and --metrics-prom, or the DETECTIFY_METRICS_JSON and DETECTIFY_METRICS_PROM
+environment variables.
+"""
+
+import argparse
+import atexit
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Iterator, Optional
+from urllib.parse import urlsplit
+
+import requests
+
+from detectify import API_BASE_URL
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_TOKEN_SEGMENT = re.compile(r'/[0-9a-fA-F-]{16,}(?=/|$)')
+_API_PATH = urlsplit(API_BASE_URL).path.rstrip('/')
+
+
+def endpoint_name(method: str, url: str) -> str:
+    """Normalise a request into an endpoint name, replacing tokens in the path so that calls can be aggregated
+
+    :param method: The HTTP method
+    :param url: The request URL
+    :return: A name such as 'GET /v2/domains/{token}/settings/'
+    """
+    path = urlsplit(url).path
+    if _API_PATH and path.startswith(_API_PATH):
+        path = path[len(_API_PATH):]
+    return f'{method} {_TOKEN_SEGMENT.sub("/{token}", path)}'
+
+
+class Histogram:
+    """A cumulative latency histogram with fixed buckets"""
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate a quantile as the upper bound of the bucket it falls in
+
+        :param q: The quantile, between 0 and 1
+        :return: The estimated value, or None if nothing was observed
+        """
+        if not self.count:
+            return None
+        for bound, count in zip(BUCKETS, self.counts):
+            if count >= q * self.count:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """Thread-safe storage for request and phase metrics"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.script = 'detectify'
+        self.started = time.time()
+        self.latency = defaultdict(Histogram)
+        self.requests = Counter()  # (endpoint, status) -> count
+        self.bytes_sent = Counter()
+        self.bytes_received = Counter()
+        self.phases = Counter()
+
+    def observe(self, endpoint: str, status: str, seconds: float, sent: int, received: int) -> None:
+        with self.lock:
+            self.latency[endpoint].observe(seconds)
+            self.requests[(endpoint, status)] += 1
+            self.bytes_sent[endpoint] += sent
+            self.bytes_received[endpoint] += received
+
+    def add_phase(self, name: str, seconds: float) -> None:
+        with self.lock:
+            self.phases[name] += seconds
+
+    def summary(self) -> dict:
+        """Summarise all metrics as a JSON-serialisable dictionary"""
+        with self.lock:
+            endpoints = {}
+            for endpoint, histogram in sorted(self.latency.items()):
+                endpoints[endpoint] = {
+                    'requests': histogram.count,
+                    'status_codes': {status: count for (name, status), count in sorted(self.requests.items())
+                                     if name == endpoint},
+                    'latency_seconds': {'sum': histogram.sum,
+                                        'mean': histogram.sum / histogram.count,
+                                        'p50': histogram.quantile(0.5),
+                                        'p95': histogram.quantile(0.95),
+                                        'p99': histogram.quantile(0.99)},
+                    'bytes_sent': self.bytes_sent[endpoint],
+                    'bytes_received': self.bytes_received[endpoint]}
+            return {'script': self.script,
+                    'started': self.started,
+                    'duration_seconds': time.time() - self.started,
+                    'requests': sum(self.requests.values()),
+                    'endpoints': endpoints,
+                    'phases_seconds': dict(self.phases)}
+
+    def prometheus(self) -> str:
+        """Render all metrics in the Prometheus text exposition format"""
+        script = self.script
+        lines = ['# HELP detectify_request_duration_seconds Latency of Detectify API requests',
+                 '# TYPE detectify_request_duration_seconds histogram']
+        with self.lock:
+            for endpoint, histogram in sorted(self.latency.items()):
+                labels = f'script="{script}",endpoint="{endpoint}"'
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    lines.append(f'detectify_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'detectify_request_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f'detectify_request_duration_seconds_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'detectify_request_duration_seconds_count{{{labels}}} {histogram.count}')
+            lines += ['# HELP detectify_requests_total Detectify API requests by endpoint and status',
+                      '# TYPE detectify_requests_total counter']
+            for (endpoint, status), count in sorted(self.requests.items()):
+                lines.append(f'detectify_requests_total{{script="{script}",endpoint="{endpoint}",status="{status}"}}'
+                             f' {count}')
+            lines += ['# HELP detectify_request_bytes_total Bytes transferred to and from the Detectify API',
+                      '# TYPE detectify_request_bytes_total counter']
+            for direction, counter in (('sent', self.bytes_sent), ('received', self.bytes_received)):
+                for endpoint, count in sorted(counter.items()):
+                    lines.append(f'detectify_request_bytes_total{{script="{script}",endpoint="{endpoint}",'
+                                 f'direction="{direction}"}} {count}')
+            lines += ['# HELP detectify_phase_duration_seconds Time spent in each phase of the script',
+                      '# TYPE detectify_phase_duration_seconds gauge']
+            for name, seconds in sorted(self.phases.items()):
+                lines.append(f'detectify_phase_duration_seconds{{script="{script}",phase="{name}"}} {seconds}')
+            lines += ['# HELP detectify_run_duration_seconds Total run time of the script',
+                      '# TYPE detectify_run_duration_seconds gauge',
+                      f'detectify_run_duration_seconds{{script="{script}"}} {time.time() - self.started}',
+                      '# HELP detectify_last_run_timestamp_seconds When the script last finished',
+                      '# TYPE detectify_last_run_timestamp_seconds gauge',
+                      f'detectify_last_run_timestamp_seconds{{script="{script}"}} {time.time()}']
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+_original_send = None
+
+
+def install() -> None:
+    """Start recording every request sent through requests in this process
+
+    Safe to call more than once.
+    """
+    global _original_send
+    if _original_send is not None:
+        return
+    _original_send = requests.Session.send
+
+    def send(session, request, **kwargs):
+        endpoint = endpoint_name(request.method, request.url)
+        body = request.body
+        sent = len(body) if isinstance(body, (bytes, str)) else 0
+        start = time.perf_counter()
+        try:
+            response = _original_send(session, request, **kwargs)
+        except Exception as e:
+            METRICS.observe(endpoint, type(e).__name__, time.perf_counter() - start, sent, 0)
+            raise
+        received = len(response.content) if not kwargs.get('stream') else 0
+        METRICS.observe(endpoint, str(response.status_code), time.perf_counter() - start, sent, received)
+        return response
+
+    requests.Session.send = send
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Time a phase of a script, such as 'enumerate', 'resolve', 'mutate' or 'export'
+
+    :param name: The name of the phase
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        METRICS.add_phase(name, time.perf_counter() - start)
+
+
+def _write_atomically(path: str, content: str) -> None:
+    with open(f'{path}.tmp', 'w') as f:
+        f.write(content)
+    os.replace(f'{path}.tmp', path)
+
+
+def write_json(path: str) -> None:
+    _write_atomically(path, json.dumps(METRICS.summary(), indent=2) + '\n')
+
+
+def write_prometheus(path: str) -> None:
+    _write_atomically(path, METRICS.prometheus())
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the --metrics-json and --metrics-prom options to a script's argument parser
+
+    :param parser: The script's argument parser
+    """
+    parser.add_argument('--metrics-json', type=str, default=os.environ.get('DETECTIFY_METRICS_JSON'),
+                        help='write a JSON summary of request metrics to this file')
+    parser.add_argument('--metrics-prom', type=str, default=os.environ.get('DETECTIFY_METRICS_PROM'),
+                        help='write request metrics to this file in Prometheus textfile format')
+
+
+def start(args: argparse.Namespace, script: str) -> None:
+    """Start recording metrics for a script if any metrics output was requested, and write them out at exit
+
+    :param args: The parsed arguments, including those added by add_arguments
+    :param script: The name of the script, used to label the metrics
+    """
+    if not (args.metrics_json or args.metrics_prom):
+        return
+    METRICS.script = script
+    install()
+    if args.metrics_json:
+        atexit.register(write_json, args.metrics_json)
+    if args.metrics_prom:
+        atexit.register(write_prometheus, args.metrics_prom)
@@ -0,0 +1,68 @@
+"""pagination.py: stream assets from the marker-paginated /v2/assets/ endpoint
+
+Each page is parsed exactly once and its assets are yielded as soon as they arrive. While the caller is working through
+one page, the next page is already being fetched in a background thread.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+
+import requests
+
+from detectify import API_BASE_URL
+
+
+def get_asset_page(key: str, marker: str = '', include_subdomains: bool = False,
+                   session: Optional[requests.Session] = None) -> dict:
+    """Get a single page of assets from Detectify
+
+    :param key: A valid Detectify API key
+    :param marker: The marker returned by the previous page, or an empty string for the first page
+    :param include_subdomains: Whether subdomains should be listed alongside root assets
+    :param session: An optional session to reuse connections between pages
+    :return: The decoded page, containing 'assets', 'has_more' and optionally 'next_marker'
+    """
+    api_endpoint = '/v2/assets/'
+    params = {'marker': marker}
+    if include_subdomains:
+        params['include_subdomains'] = 'true'
+    r = (session or requests).get(url=f'{API_BASE_URL}{api_endpoint}',
+                                  headers={'X-Detectify-Key': key,
+                                           'content-type': 'application/json'},
+                                  params=params)
+    return r.json()
+
+
+def iter_asset_pages(key: str, include_subdomains: bool = False, prefetch: bool = True) -> Iterator[list]:
+    """Iterate over every page of assets in a Detectify team
+
+    :param key: A valid Detectify API key
+    :param include_subdomains: Whether subdomains should be listed alongside root assets
+    :param prefetch: Fetch the next page in the background while the current page is being consumed
+    :return: An iterator of lists of dictionaries containing asset information
+    """
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=1) as executor:
+        def fetch(marker: str):
+            if prefetch:
+                return executor.submit(get_asset_page, key, marker, include_subdomains, session).result
+            page = get_asset_page(key, marker, include_subdomains, session)
+            return lambda: page
+
+        pending = fetch('')
+        while pending:
+            page = pending()
+            # next_marker may not exist when has_more is False
+            pending = fetch(page.get('next_marker', '')) if page.get('has_more') else None
+            yield page['assets']
+
+
+def iter_assets(key: str, include_subdomains: bool = False, prefetch: bool = True) -> Iterator[dict]:
+    """Iterate over every asset in a Detectify team, page by page as they arrive
+
+    :param key: A valid Detectify API key
+    :param include_subdomains: Whether subdomains should be listed alongside root assets
+    :param prefetch: Fetch the next page in the background while the current page is being consumed
+    :return: An iterator of dictionaries containing asset information
+    """
+    for assets in iter_asset_pages(key, include_subdomains, prefetch):
+        yield from assets
@@ -0,0 +1,265 @@
+"""ratelimit.py: an adaptive token-bucket rate limiter shared by every process using the same API key
+
+Requests are paced by a token bucket whose rate adapts to the API's feedback. Like TCP, it starts by doubling every
+second until the API first answers 429 Too Many Requests, then grows additively while requests succeed and is halved on
+every 429 (AIMD), so it settles just below the API's limit, and never above --max-rate. The rate only grows while the
+bucket is holding callers back: a run whose requests are bound by latency leaves it where it is, rather than teaching
+the next run a rate it never sent at. A Retry-After header pauses every caller until it has passed, and the throttled
+request is retried.
+
+On platforms with fcntl, several scripts running on the same host with the same API key share one budget through a
+small state file in the cache directory. Each process paces itself in memory with its share of the team's rate, and
+merges what it learned with the file every half second, or at once after a 429. The learned rate is kept for an hour,
+so the next run starts where the last one settled. Elsewhere the budget is shared between the threads of a single
+process only. The limiter can be used from threads with acquire() and from asyncio code with
+acquire_async().
+"""
+
+import argparse
+import asyncio
+import email.utils
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+import requests
+
+from detectify.inventory import cache_dir, team_id
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+DEFAULT_RATE = 50.0  # requests per second
+DEFAULT_MAX_RATE = 200.0
+MIN_RATE = 0.5
+DEFAULT_MAX_RETRIES = 5
+SYNC_INTERVAL = 0.5  # seconds between merges with the shared state file
+PROCESS_TTL = 5.0  # seconds after which a process that has not synced no longer takes a share of the rate
+IDLE_RESET = 3600  # seconds after which a shared state file left by an earlier run is ignored
+
+
+def parse_retry_after(value: Optional[str], default: float = 1.0) -> float:
+    """Parse a Retry-After header, given either in seconds or as an HTTP date
+
+    :param value: The header value
+    :param default: The delay to use if the header is missing or invalid
+    :return: The number of seconds to wait
+    """
+    if not value:
+        return default
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+class RateLimiter:
+    """An AIMD token bucket, optionally shared between processes through a locked state file"""
+
+    def __init__(self, key: Optional[str] = None, rate: float = DEFAULT_RATE, max_rate: float = DEFAULT_MAX_RATE,
+                 min_rate: float = MIN_RATE, increase: float = 1.0, decrease: float = 0.5,
+                 path: Optional[str] = None):
+        """
+        :param key: The API key whose budget is shared between processes; None keeps the limiter in this process
+        :param rate: The initial number of requests per second
+        :param max_rate: The rate will never grow beyond this
+        :param min_rate: The rate will never shrink below this
+        :param increase: How much the rate grows, in requests per second, for each second of successful requests
+        :param decrease: The factor the rate is multiplied by when the API answers 429
+        :param path: The state file to share, defaults to a file per team in the cache directory
+        """
+        self.initial_rate = min(rate, max_rate)
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self._lock = threading.Lock()
+        self._state = {'rate': self.initial_rate, 'tokens': 1.0, 'updated': time.time(), 'blocked_until': 0.0,
+                       'slow_start': True}
+        self._share = 1  # the number of processes currently splitting the rate
+        self._synced_rate = None  # the team's rate as of the last sync, None before the first one
+        self._synced_at = 0.0
+        self._decreased = False  # whether a 429 lowered the rate since the last sync
+        self._limiting = False  # whether the last reservation had to wait for the bucket to refill
+        self.path = None
+        if fcntl is not None and (path or key):
+            self.path = path or os.path.join(cache_dir(), f'ratelimit-{team_id(key)[:16]}.json')
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with self._lock:
+                self._sync(time.time())
+
+    def _sync(self, now: float) -> None:
+        """Merge this process's view of the rate with the state file shared with other processes
+
+        Growth since the last sync is added to the shared rate, so the successes of every process count towards it,
+        while a decrease replaces it, so one 429 seen by several processes halves the rate only once. Must be called
+        with self._lock held.
+        """
+        state = self._state
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    shared = json.loads(f.read())
+                    if now - shared['updated'] > IDLE_RESET:
+                        raise ValueError('stale state')
+                except (ValueError, KeyError):
+                    shared = {'rate': state['rate'], 'blocked_until': 0.0, 'slow_start': state['slow_start'],
+                              'processes': {}}
+                else:
+                    if self._decreased:
+                        shared['rate'] = min(shared['rate'], state['rate'])
+                    elif self._synced_rate is not None:
+                        shared['rate'] += state['rate'] - self._synced_rate
+                    shared['slow_start'] = shared['slow_start'] and state['slow_start']
+                    shared['blocked_until'] = max(shared['blocked_until'], state['blocked_until'])
+                shared['rate'] = max(self.min_rate, min(self.max_rate, shared['rate']))
+                processes = {pid: seen for pid, seen in shared.get('processes', {}).items() if now - seen < PROCESS_TTL}
+                processes[str(os.getpid())] = now
+                shared['processes'] = processes
+                shared['updated'] = now
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(shared))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        state['rate'] = shared['rate']
+        state['slow_start'] = shared['slow_start']
+        state['blocked_until'] = shared['blocked_until']
+        self._synced_rate = shared['rate']
+        self._share = len(processes)
+        self._synced_at = now
+        self._decreased = False
+
+    @property
+    def rate(self) -> float:
+        with self._lock:
+            return self._state['rate']
+
+    def reserve(self) -> float:
+        """Take a token from the bucket, going into debt if it is empty
+
+        Callers that go into debt are served in the order they reserved, once the bucket has refilled. The state is
+        kept in memory and merged with the shared state file every SYNC_INTERVAL seconds.
+
+        :return: The number of seconds to wait before sending the request
+        """
+        with self._lock:
+            now = time.time()
+            if self.path is not None and now - self._synced_at >= SYNC_INTERVAL:
+                self._sync(now)
+            state = self._state
+            rate = state['rate'] / self._share
+            burst = max(rate, 1.0)
+            state['tokens'] = min(burst, state['tokens'] + (now - state['updated']) * rate) - 1
+            state['updated'] = now
+            self._limiting = state['tokens'] < 0
+            wait = -state['tokens'] / rate if self._limiting else 0.0
+            return max(wait, state['blocked_until'] - now)
+
+    def acquire(self) -> None:
+        """Block the current thread until a request may be sent"""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self) -> None:
+        """Wait, without blocking the event loop, until a request may be sent"""
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def succeeded(self) -> None:
+        """Grow the rate after a request that was not throttled, if the bucket is what is holding requests back"""
+        with self._lock:
+            if not self._limiting:
+                return
+            state = self._state
+            # One success per token, so adding 1 per success in slow start doubles the rate every second
+            growth = 1.0 if state['slow_start'] else self.increase / state['rate']
+            state['rate'] = min(self.max_rate, state['rate'] + growth)
+
+    def throttled(self, retry_after: float) -> None:
+        """Shrink the rate and pause every caller after the API answered 429
+
+        Several 429s received for requests that were already in flight count as a single decrease. Other processes
+        sharing the state file are told at once.
+
+        :param retry_after: The number of seconds the API asked us to wait
+        """
+        with self._lock:
+            state = self._state
+            now = time.time()
+            if now >= state['blocked_until']:
+                state['rate'] = max(self.min_rate, state['rate'] * self.decrease)
+                state['slow_start'] = False
+                self._decreased = True
+            state['blocked_until'] = max(state['blocked_until'], now + retry_after)
+            state['tokens'] = min(state['tokens'], 0.0)
+            if self.path is not None:
+                self._sync(now)
+
+
+_original_send = None
+
+
+def install(limiter: RateLimiter, max_retries: int = DEFAULT_MAX_RETRIES) -> None:
+    """Pace every request sent through requests in this process, and retry requests that the API throttled
+
+    Requests with a streamed body cannot be replayed, so a 429 for one of those is returned to the caller.
+
+    :param limiter: The rate limiter to use
+    :param max_retries: How many times a throttled request is retried before its 429 is returned
+    """
+    global _original_send
+    if _original_send is not None:
+        return
+    _original_send = requests.Session.send
+
+    def send(session, request, **kwargs):
+        replayable = request.body is None or isinstance(request.body, (bytes, str))
+        attempt = 0
+        while True:
+            limiter.acquire()
+            response = _original_send(session, request, **kwargs)
+            if response.status_code != 429:
+                limiter.succeeded()
+                return response
+            limiter.throttled(parse_retry_after(response.headers.get('Retry-After')))
+            if not replayable or attempt >= max_retries:
+                return response
+            attempt += 1
+
+    requests.Session.send = send
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the --rate and --max-rate options to a script's argument parser
+
+    :param parser: The script's argument parser
+    """
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE,
+                        help=f'initial requests per second, adapted to the API\'s feedback (default: {DEFAULT_RATE:g})')
+    parser.add_argument('--max-rate', type=float, default=DEFAULT_MAX_RATE,
+                        help=f'never send more requests per second than this (default: {DEFAULT_MAX_RATE:g})')
+
+
+def start(args: argparse.Namespace) -> RateLimiter:
+    """Rate limit every request made by a script, sharing the budget with other scripts using the same API key
+
+    :param args: The parsed arguments, including the API key and those added by add_arguments
+    :return: The installed rate limiter
+    """
+    limiter = RateLimiter(args.key, rate=args.rate, max_rate=args.max_rate)
+    install(limiter)
+    return limiter
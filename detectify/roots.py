@@ -0,0 +1,63 @@
+"""roots.py: resolve domains to the registered root asset they belong to
+
+Root assets are stored in a trie keyed by DNS label, starting from the top-level domain, so resolving a domain walks at
+most one node per label and only ever matches on label boundaries: `example.com` owns `www.example.com` but not
+`notexample.com` or `example.com.evil.net`.
+"""
+
+from typing import Iterable, Optional
+
+_TOKEN = ''  # Labels are never empty, so the empty string marks a node that is itself a registered root
+
+
+def split_labels(domain: str) -> list:
+    """Split a domain into its DNS labels, from the top-level domain downwards
+
+    :param domain: A domain name
+    :return: A list of lowercase labels in reverse order
+    """
+    return domain.strip().rstrip('.').lower().split('.')[::-1]
+
+
+class RootIndex:
+    """A reverse-label trie of root asset names and tokens"""
+
+    def __init__(self, assets: Iterable = ()):
+        """
+        :param assets: An iterable of (name, token) pairs for root assets
+        """
+        self._root = {}
+        self._size = 0
+        for name, token in assets:
+            self.add(name, token)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, name: str, token: str) -> None:
+        """Register a root asset
+
+        :param name: The name of the root asset
+        :param token: The asset token of the root asset
+        """
+        node = self._root
+        for label in split_labels(name):
+            node = node.setdefault(label, {})
+        if _TOKEN not in node:
+            self._size += 1
+        node[_TOKEN] = (name, token)
+
+    def resolve(self, domain: str) -> Optional[tuple]:
+        """Find the longest registered root asset that a domain belongs to
+
+        :param domain: The domain to resolve
+        :return: A (name, token) pair for the root asset, or None if the domain does not belong to any root asset
+        """
+        node = self._root
+        match = None
+        for label in split_labels(domain):
+            node = node.get(label)
+            if node is None:
+                break
+            match = node.get(_TOKEN, match)
+        return match
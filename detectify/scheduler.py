@@ -0,0 +1,159 @@
+"""scheduler.py: start Application Scans in waves instead of all at once
+
+Starting a scan for every profile at the same moment loads the scanned sites and the scan queue all at once. The
+scheduler keeps at most a given number of scans running, waits a minimum time between scans of the same root asset,
+and polls the status of running scans so that the next profile in line is started as soon as a slot frees up. A scan
+whose status cannot be read several polls in a row, for example because the API key may not read scan status, is
+given up on: its slot is freed and it is reported as unknown.
+Profiles are started in priority order, as given by a file of tokens or endpoints, and otherwise in listing order.
+"""
+
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+import requests
+
+from detectify.bulk import BulkSummary
+from detectify.concurrency import describe_error
+from detectify.domains import iter_lines
+from detectify.filters import endpoint_host
+
+DEFAULT_MAX_CONCURRENT = 5
+DEFAULT_POLL_INTERVAL = 30.0  # seconds
+DEFAULT_MAX_STATUS_FAILURES = 5
+
+
+def read_priorities(file: str) -> Dict[str, int]:
+    """Read a priority file listing profile tokens or endpoints, most urgent first
+
+    :param file: The file to read, one token or endpoint per line, with comments starting with #
+    :return: A dictionary of lowercase entries to their rank
+    """
+    priorities = {}
+    for line in iter_lines([file]):
+        entry = line.split('#', 1)[0].strip().lower()
+        if entry and entry not in priorities:
+            priorities[entry] = len(priorities)
+    return priorities
+
+
+def prioritize(profiles: Iterable[dict], priorities: Dict[str, int]) -> List[dict]:
+    """Order scan profiles by priority, keeping the listing order for profiles of equal or no priority
+
+    :param profiles: The scan profiles to order
+    :param priorities: Ranks from read_priorities, matched against each profile's token, endpoint and host
+    :return: A new list of profiles, the highest priority first
+    """
+    def rank(profile: dict) -> float:
+        endpoint = (profile.get('endpoint') or profile.get('name') or '').lower()
+        keys = (profile['token'].lower(), endpoint, endpoint_host(endpoint))
+        return min((priorities[key] for key in keys if key in priorities), default=float('inf'))
+
+    return sorted(profiles, key=rank)
+
+
+def root_of(profile: dict) -> str:
+    """Identify the root asset a scan profile belongs to, for spacing scans of the same site"""
+    return profile.get('asset_token') or endpoint_host(profile.get('endpoint') or profile.get('name') or '')
+
+
+class WaveScheduler:
+    """Starts scans with a bounded number running at once and a minimum spacing per root asset"""
+
+    def __init__(self, start: Callable[[dict], Optional[requests.Response]], is_running: Callable[[dict], bool],
+                 max_concurrent: int = DEFAULT_MAX_CONCURRENT, root_spacing: float = 0.0,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL, max_status_failures: int = DEFAULT_MAX_STATUS_FAILURES,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        """
+        :param start: A function starting the scan of a profile and returning the API response
+        :param is_running: A function asking the API whether the scan of a profile is still running
+        :param max_concurrent: The maximum number of scans running at the same time
+        :param root_spacing: The minimum number of seconds between starting scans of the same root asset
+        :param poll_interval: The number of seconds between status checks of the running scans
+        :param max_status_failures: The number of status checks of a scan in a row that may fail before its status is
+            considered unknown and its slot is freed
+        :param clock: A monotonic clock, in seconds
+        :param sleep: A function sleeping for a number of seconds
+        """
+        self.start = start
+        self.is_running = is_running
+        self.max_concurrent = max(max_concurrent, 1)
+        self.root_spacing = root_spacing
+        self.poll_interval = poll_interval
+        self.max_status_failures = max(max_status_failures, 1)
+        self.unknown = []  # tokens of the scans given up on
+        self.clock = clock
+        self.sleep = sleep
+
+    def run(self, profiles: Iterable[dict]) -> BulkSummary:
+        """Start a scan for every profile, waiting for slots and root spacing, until every started scan has finished
+
+        :param profiles: The scan profiles to scan, in the order they should be started
+        :return: A summary of the responses to the start requests
+        """
+        queue = list(profiles)
+        running = {}
+        last_start = {}
+        finished = 0
+        status_failures = {}
+        summary = BulkSummary()
+        next_poll = self.clock() + self.poll_interval
+        while queue or running:
+            self._start_eligible(queue, running, last_start, summary)
+            if not (queue or running):
+                break
+
+            wake = next_poll if running else float('inf')
+            if queue and len(running) < self.max_concurrent:
+                # Some slots are free but every waiting profile's root was scanned too recently
+                wake = min(wake, min((last_start[root_of(profile)] + self.root_spacing for profile in queue
+                                      if root_of(profile) in last_start), default=wake))
+            self.sleep(max(wake - self.clock(), 0.0))
+
+            if running and self.clock() >= next_poll:
+                for token, profile in list(running.items()):
+                    try:
+                        still_running = self.is_running(profile)
+                    except Exception as e:
+                        status_failures[token] = status_failures.get(token, 0) + 1
+                        if status_failures[token] < self.max_status_failures:
+                            print(f'Failed to get the scan status of {token}, will check again: {describe_error(e)}')
+                            continue
+                        print(f'Failed to get the scan status of {token} {status_failures[token]} times in a row, '
+                              f'giving up on it: {describe_error(e)}')
+                        del running[token]
+                        self.unknown.append(token)
+                        continue
+                    status_failures.pop(token, None)
+                    if not still_running:
+                        del running[token]
+                        finished += 1
+                print(f'{len(running)} scans running, {len(queue)} waiting, {finished} finished'
+                      + (f', {len(self.unknown)} unknown' if self.unknown else ''))
+                next_poll = self.clock() + self.poll_interval
+        summary.report()
+        if self.unknown:
+            print(f'  Status unknown: {len(self.unknown)} scans, which may still be running')
+        return summary
+
+    def _start_eligible(self, queue: list, running: dict, last_start: dict, summary: BulkSummary) -> None:
+        """Start the first waiting profiles whose root may be scanned again, until every slot is taken"""
+        i = 0
+        while len(running) < self.max_concurrent and i < len(queue):
+            profile = queue[i]
+            root = root_of(profile)
+            if root in last_start and self.clock() - last_start[root] < self.root_spacing:
+                i += 1
+                continue
+            del queue[i]
+            last_start[root] = self.clock()
+            try:
+                response = self.start(profile)
+            except Exception as e:
+                print(f'Failed to start a scan on {profile["token"]}: {describe_error(e)}')
+                summary.record(None, e)
+                continue
+            summary.record(response)
+            # A 409 means the profile is already being scanned, which also takes a slot until it finishes
+            if response is not None and (response.ok or response.status_code == 409):
+                running[profile['token']] = profile
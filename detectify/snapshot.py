@@ -0,0 +1,125 @@
+"""snapshot.py: compact sorted snapshots of asset names, and a streaming diff between two of them
+
+A snapshot is a gzip-compressed text file with one asset name per line, sorted and without duplicates. The names of a
+new listing are sorted with an external merge sort, spilling sorted runs to temporary files, and compared to the
+previous snapshot with a sort-merge join, so memory use stays bounded by the run size however large the team is.
+"""
+
+import gzip
+import heapq
+import os
+import tempfile
+from itertools import islice
+from typing import IO, Iterable, Iterator, List, Tuple
+
+RUN_SIZE = 100000  # names sorted in memory at a time
+
+ADDED = 'added'
+REMOVED = 'removed'
+
+
+def _write_run(names: List[str]) -> IO:
+    run = tempfile.TemporaryFile('w+', encoding='utf-8')
+    run.writelines(f'{name}\n' for name in sorted(names))
+    run.seek(0)
+    return run
+
+
+def _read_run(run: IO) -> Iterator[str]:
+    for line in run:
+        yield line.rstrip('\n')
+
+
+def sort_unique(names: Iterable[str], run_size: int = RUN_SIZE) -> Iterator[str]:
+    """Sort names and drop duplicates, holding at most run_size names in memory
+
+    :param names: The names to sort, in any order
+    :param run_size: How many names to sort in memory before spilling them to a temporary file
+    :return: An iterator of unique names in sorted order
+    """
+    names = iter(names)
+    runs = []
+    try:
+        while True:
+            chunk = list(islice(names, run_size))
+            if not chunk:
+                break
+            runs.append(_write_run(chunk))
+        previous = None
+        for name in heapq.merge(*(_read_run(run) for run in runs)):
+            if name != previous:
+                yield name
+                previous = name
+    finally:
+        for run in runs:
+            run.close()
+
+
+def read_snapshot(path: str) -> Iterator[str]:
+    """Stream the names in a snapshot
+
+    :param path: The snapshot file
+    :raises ValueError: If the file is not sorted, and so was not written by write_snapshot
+    :return: An iterator of names in sorted order
+    """
+    previous = None
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            name = line.rstrip('\n')
+            if previous is not None and name <= previous:
+                raise ValueError(f'{path} is not a sorted snapshot ({name!r} follows {previous!r})')
+            yield name
+            previous = name
+
+
+def diff_sorted(old: Iterable[str], new: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """Compare two sorted, duplicate-free sequences of names with a sort-merge join
+
+    :param old: The names in the previous snapshot
+    :param new: The names in the current listing
+    :return: An iterator of (ADDED or REMOVED, name) tuples, in name order
+    """
+    old, new = iter(old), iter(new)
+    a, b = next(old, None), next(new, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a < b):
+            yield REMOVED, a
+            a = next(old, None)
+        elif a is None or b < a:
+            yield ADDED, b
+            b = next(new, None)
+        else:
+            a, b = next(old, None), next(new, None)
+
+
+def update_snapshot(names: Iterable[str], path: str, run_size: int = RUN_SIZE) -> Iterator[Tuple[str, str]]:
+    """Replace a snapshot with a new listing of names, yielding what changed since the previous one
+
+    The new snapshot is written alongside the old one and only replaces it once the whole diff has been consumed, so an
+    interrupted run leaves the previous snapshot in place. If there is no previous snapshot, nothing is yielded.
+
+    :param names: The current asset names, in any order
+    :param path: The snapshot file to compare against and replace
+    :param run_size: How many names to sort in memory at a time
+    :return: An iterator of (ADDED or REMOVED, name) tuples, in name order
+    """
+    baseline = os.path.exists(path)
+    old = read_snapshot(path) if baseline else iter(())
+    tmp = f'{path}.tmp'
+    try:
+        with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+            def written(sorted_names: Iterator[str]) -> Iterator[str]:
+                for name in sorted_names:
+                    f.write(f'{name}\n')
+                    yield name
+
+            changes = diff_sorted(old, written(sort_unique(names, run_size)))
+            if baseline:
+                yield from changes
+            else:
+                for _ in changes:
+                    pass
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
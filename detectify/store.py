@@ -0,0 +1,148 @@
+"""store.py: a compact in-memory mapping of asset names to tokens for very large teams
+
+Keeping a team's assets as decoded JSON dictionaries costs around a kilobyte per asset, and even a plain dictionary of
+names to tokens costs a few hundred bytes, mostly in per-object overhead. AssetStore keeps only the name and token of
+each asset, encoded back to back in two byte buffers with their end offsets in arrays, so no Python object exists per
+asset until one is looked up. Names are found through an open-addressing hash table of positions, itself a flat
+array, and the root asset of a subdomain is found by looking up each of its parent domains in turn.
+"""
+
+from array import array
+from typing import Iterable, Iterator, Optional, Tuple
+
+
+class _Column:
+    """A sequence of strings stored as UTF-8 in a single buffer"""
+
+    __slots__ = ('data', 'ends')
+
+    def __init__(self):
+        self.data = bytearray()
+        self.ends = array('Q')
+
+    def __len__(self) -> int:
+        return len(self.ends)
+
+    def append(self, value: str) -> None:
+        self.data += value.encode()
+        self.ends.append(len(self.data))
+
+    def raw(self, i: int) -> bytes:
+        start = self.ends[i - 1] if i else 0
+        return bytes(self.data[start:self.ends[i]])
+
+    def __getitem__(self, i: int) -> str:
+        return self.raw(i).decode()
+
+    def nbytes(self) -> int:
+        return len(self.data) + self.ends.itemsize * len(self.ends)
+
+
+class AssetStore:
+    """A compact, dictionary-like mapping of asset names to asset tokens, kept in the order assets were added"""
+
+    __slots__ = ('_names', '_tokens', '_slots')
+
+    def __init__(self, assets: Iterable[Tuple[str, str]] = ()):
+        """
+        :param assets: An iterable of (name, token) pairs, such as the items of another mapping
+        """
+        self._names = _Column()
+        self._tokens = _Column()
+        self._slots = array('i', [-1]) * 8
+        for name, token in assets:
+            self.add(name, token)
+
+    @classmethod
+    def from_assets(cls, assets: Iterable[dict]) -> 'AssetStore':
+        """Build a store from asset dictionaries as returned by the API, keeping only their names and tokens
+
+        :param assets: An iterable of dictionaries containing asset information, such as iter_assets()
+        :return: A new store
+        """
+        return cls((asset['name'], asset['token']) for asset in assets)
+
+    def add(self, name: str, token: str) -> None:
+        """Add an asset; adding a name that is already present shadows the earlier entry in lookups
+
+        :param name: The name of the asset
+        :param token: The asset token
+        """
+        # Keep the table at most half full, so that probe sequences stay short
+        if 2 * (len(self._names) + 1) > len(self._slots):
+            self._resize(2 * len(self._slots))
+        self._names.append(name)
+        self._tokens.append(token)
+        self._insert(len(self._names) - 1, self._names.raw(len(self._names) - 1))
+
+    def _probe(self, key: bytes) -> int:
+        """Find the slot holding a name, or the empty slot where it would go"""
+        mask = len(self._slots) - 1
+        slot = hash(key) & mask
+        while True:
+            position = self._slots[slot]
+            if position < 0 or self._names.raw(position) == key:
+                return slot
+            slot = (slot + 1) & mask
+
+    def _insert(self, position: int, key: bytes) -> None:
+        self._slots[self._probe(key)] = position
+
+    def _resize(self, size: int) -> None:
+        self._slots = array('i', [-1]) * size
+        for position in range(len(self._names)):
+            self._insert(position, self._names.raw(position))
+
+    def _find(self, name: str) -> Optional[int]:
+        position = self._slots[self._probe(name.encode())]
+        return position if position >= 0 else None
+
+    def get(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        i = self._find(name)
+        return default if i is None else self._tokens[i]
+
+    def __getitem__(self, name: str) -> str:
+        i = self._find(name)
+        if i is None:
+            raise KeyError(name)
+        return self._tokens[i]
+
+    def __contains__(self, name: str) -> bool:
+        return self._find(name) is not None
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __iter__(self) -> Iterator[str]:
+        return (self._names[i] for i in range(len(self._names)))
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        """Iterate over every (name, token) pair, in the order they were added
+
+        :return: An iterator of (name, token) tuples
+        """
+        return ((self._names[i], self._tokens[i]) for i in range(len(self._names)))
+
+    def assets(self) -> Iterator[dict]:
+        """Iterate over every asset as a small dictionary, in the order they were added
+
+        :return: An iterator of dictionaries containing an asset name and token
+        """
+        return ({'name': name, 'token': token} for name, token in self.items())
+
+    def root(self, name: str) -> Optional[str]:
+        """Find the root asset of a domain, as the shortest domain in the store that it is equal to or a subdomain of
+
+        :param name: The domain to find the root asset of
+        :return: The name of the root asset, or None if the domain does not belong to any asset in the store
+        """
+        labels = name.split('.')
+        for i in range(len(labels) - 1, -1, -1):
+            parent = '.'.join(labels[i:])
+            if parent in self:
+                return parent
+        return None
+
+    def nbytes(self) -> int:
+        """The number of bytes used by the store's buffers, excluding the fixed size of the Python objects"""
+        return self._names.nbytes() + self._tokens.nbytes() + self._slots.itemsize * len(self._slots)
@@ -0,0 +1,208 @@
+"""teams.py: run one of the scripts for many Detectify teams at once
+
+The scripts each take the API key of a single team. This runner reads a file of keys and runs a script once per team,
+with up to --jobs teams at a time, each in its own process. The per-team work is independent and mostly spent waiting
+on the API, so the whole run takes about as long as the slowest team rather than the sum of all of them. Every team
+keeps its own rate limit, since the limiter's budget is shared per API key.
+
+The key file has one team per line, either a bare API key or a label followed by the key, separated by whitespace.
+Blank lines and lines starting with # are ignored. In the script's arguments, {key} is replaced by each team's API key
+and {team} by its label, for example to give every team its own output file. Every line a script prints is tagged with
+its team's label, and a merged report of exit codes, durations and API requests is printed once all teams are done.
+
+Usage: python -m detectify.teams [-h] [-j JOBS] [--report REPORT] key_file script ...
+
+Example: python -m detectify.teams keys.txt get_SM_settings {key} settings-{team}.csv
+"""
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+from detectify.concurrency import DEFAULT_CONCURRENCY
+from detectify.inventory import team_id
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.join(PACKAGE_DIR, os.pardir)
+
+_print_lock = threading.Lock()
+
+
+def read_keys(file: str) -> List[Tuple[str, str]]:
+    """Read the teams to run for from a key file, dropping duplicate keys
+
+    :param file: A file with one API key, optionally preceded by a label, per line
+    :raises ValueError: If a line has more than two fields
+    :return: A list of (label, key) tuples, labelled by a hash of the key where no label is given
+    """
+    teams = []
+    seen = set()
+    with open(file, 'r') as f:
+        for number, line in enumerate(f, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) > 2:
+                raise ValueError(f'{file}:{number}: expected "[label] key"')
+            key = fields[-1]
+            label = fields[0] if len(fields) == 2 else team_id(key)[:8]
+            if key not in seen:
+                seen.add(key)
+                teams.append((label, key))
+    return teams
+
+
+def find_script(name: str) -> str:
+    """Find one of the scripts in this repository by name
+
+    :param name: A path to a script, or the name of a script in this repository with or without .py
+    :raises ValueError: If no script, or more than one, has that name
+    :return: The path to the script
+    """
+    if os.path.isfile(name):
+        return name
+    file = name if name.endswith('.py') else f'{name}.py'
+    matches = glob.glob(os.path.join(REPO_ROOT, '*', file))
+    matches = [match for match in matches
+               if os.path.basename(os.path.dirname(match)) not in ('detectify', 'benchmarks')]
+    if not matches:  # Installed as a package rather than run from a checkout
+        matches = glob.glob(os.path.join(PACKAGE_DIR, 'scripts', '*', file))
+    if len(matches) != 1:
+        raise ValueError(f'No script named {name}' if not matches else f'More than one script named {name}')
+    return os.path.normpath(matches[0])
+
+
+def team_command(script: str, args: List[str], label: str, key: str) -> List[str]:
+    """Build the command running a script for a single team
+
+    :param script: The path to the script
+    :param args: The script's arguments, where {key} and {team} are replaced by the team's API key and label
+    :param label: The team's label
+    :param key: The team's API key
+    :return: The command line
+    """
+    return [sys.executable, script] + [arg.replace('{key}', key).replace('{team}', label) for arg in args]
+
+
+def tagged_print(label: str, line: str) -> None:
+    with _print_lock:
+        print(f'[{label}] {line}', flush=True)
+
+
+def run_team(label: str, command: List[str], metrics_file: str) -> dict:
+    """Run a script for one team, printing its output tagged with the team's label as it arrives
+
+    :param label: The team's label
+    :param command: The command line from team_command
+    :param metrics_file: Where the script should write its request metrics
+    :return: The team's result, with its exit code, duration, last line of output and API requests made
+    """
+    env = dict(os.environ, PYTHONUNBUFFERED='1', DETECTIFY_METRICS_JSON=metrics_file)
+    start = time.perf_counter()
+    last_line = ''
+    try:
+        process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   stdin=subprocess.DEVNULL, text=True, errors='replace')
+    except OSError as e:
+        tagged_print(label, f'Failed to start: {e}')
+        return {'team': label, 'exit_code': None, 'duration': 0.0, 'last_line': str(e), 'requests': 0,
+                'status_codes': {}}
+    with process:
+        for line in process.stdout:
+            line = line.rstrip('\n')
+            tagged_print(label, line)
+            if line.strip():
+                last_line = line
+    result = {'team': label,
+              'exit_code': process.returncode,
+              'duration': time.perf_counter() - start,
+              'last_line': last_line,
+              'requests': 0,
+              'status_codes': {}}
+    try:
+        with open(metrics_file, 'r') as f:
+            summary = json.load(f)
+    except (OSError, ValueError):
+        return result
+    result['requests'] = summary['requests']
+    for endpoint in summary['endpoints'].values():
+        for status, count in endpoint['status_codes'].items():
+            result['status_codes'][status] = result['status_codes'].get(status, 0) + count
+    return result
+
+
+def run_all(teams: List[Tuple[str, str]], script: str, args: List[str], jobs: int = DEFAULT_CONCURRENCY) -> list:
+    """Run a script for every team, with up to jobs teams at a time
+
+    :param teams: A list of (label, key) tuples from read_keys
+    :param script: The path to the script
+    :param args: The script's arguments, where {key} and {team} are replaced for every team
+    :param jobs: The maximum number of teams to run at the same time
+    :return: A list of results from run_team, in the order of teams
+    """
+    with tempfile.TemporaryDirectory() as tmp, ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = [executor.submit(run_team, label, team_command(script, args, label, key),
+                                   os.path.join(tmp, f'{i}.json'))
+                   for i, (label, key) in enumerate(teams)]
+        return [future.result() for future in futures]
+
+
+def print_report(results: list, duration: float) -> None:
+    """Print the merged results of all teams
+
+    :param results: A list of results from run_team
+    :param duration: The wall time of the whole run, in seconds
+    """
+    width = max([len(result['team']) for result in results] + [4])
+    print()
+    print(f'{"team":<{width}}  {"exit":>4}  {"seconds":>8}  {"requests":>8}  last output')
+    for result in results:
+        exit_code = '-' if result['exit_code'] is None else result['exit_code']
+        print(f'{result["team"]:<{width}}  {exit_code:>4}  {result["duration"]:>8.2f}  {result["requests"]:>8}  '
+              f'{result["last_line"]}')
+    failed = sum(1 for result in results if result['exit_code'] != 0)
+    slowest = max((result['duration'] for result in results), default=0.0)
+    print(f'{len(results) - failed} teams succeeded, {failed} failed in {duration:.2f}s '
+          f'(slowest team {slowest:.2f}s, all teams {sum(result["duration"] for result in results):.2f}s)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='run a script for every Detectify team in a key file')
+    parser.add_argument('key_file', type=str, help='a file with one API key, optionally preceded by a label, per line')
+    parser.add_argument('script', type=str, help='the script to run, for example get_SM_settings')
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help='arguments for the script, where {key} and {team} are replaced for every team')
+    parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_CONCURRENCY,
+                        help=f'number of teams to run at the same time (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('--report', type=str, help='also save the merged results to this JSON file')
+    args = parser.parse_args()
+
+    try:
+        script = find_script(args.script)
+        teams = read_keys(args.key_file)
+    except ValueError as e:
+        parser.error(str(e))
+    if not any('{key}' in arg for arg in args.args):
+        parser.error('the script arguments must include {key}')
+
+    start = time.perf_counter()
+    results = run_all(teams, script, args.args, args.jobs)
+    duration = time.perf_counter() - start
+    print_report(results, duration)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'script': script, 'duration': duration, 'teams': results}, f, indent=2)
+    if any(result['exit_code'] != 0 for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+"""timeouts.py: per-request timeouts, a job deadline, retries with jittered backoff and hedged GETs
+
+Without a timeout, a single stalled connection can hang a script forever. Once installed, every request sent through
+`requests` gets a connect and a read timeout, which can be tuned per endpoint, and none is allowed to run past the
+job's deadline: requests started after it has passed fail at once with DeadlineExceeded, so a bulk script records the
+remaining items as failed (and writes them to its retry file) instead of running on.
+
+Idempotent requests (GET, HEAD, OPTIONS) that time out, fail to connect or are answered with a 5xx error are retried a
+bounded number of times, waiting a random time up to an exponentially growing cap between attempts ("full jitter"), so
+that many workers failing together do not retry in lockstep. Other requests are sent once.
+
+GETs can also be hedged: when a GET has not been answered after the given quantile (the p95 by default) of the
+latencies recently observed for its endpoint, a duplicate is sent and whichever answers first is used. This cuts the
+tail latency caused by an occasional slow server, at the cost of a few percent more requests. Hedging only starts once
+an endpoint has enough latency samples to estimate the quantile, and duplicates are capped at the share of GETs that
+should exceed it, so an overloaded API, where most requests are slow, is not sent more.
+"""
+
+import argparse
+import fnmatch
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, Optional, Tuple
+
+import requests
+
+from detectify.concurrency import DEFAULT_CONCURRENCY
+from detectify.metrics import endpoint_name
+
+DEFAULT_CONNECT_TIMEOUT = 5.0  # seconds
+DEFAULT_READ_TIMEOUT = 30.0
+DEFAULT_RETRIES = 3
+DEFAULT_HEDGE_QUANTILE = 0.95
+BACKOFF_BASE = 0.5  # seconds
+BACKOFF_CAP = 10.0
+MIN_SAMPLES = 20  # latencies needed before an endpoint is hedged
+WINDOW = 200  # recent latencies kept per endpoint
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+RETRY_STATUSES = {500, 502, 503, 504}
+
+
+class DeadlineExceeded(requests.Timeout):
+    """The job's deadline passed before a request could be completed"""
+
+
+class LatencyWindow:
+    """The most recent latencies of each endpoint, for estimating when a request has become a straggler"""
+
+    def __init__(self, size: int = WINDOW, min_samples: int = MIN_SAMPLES):
+        self.min_samples = min_samples
+        self._samples = defaultdict(lambda: deque(maxlen=size))
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint: str, seconds: float) -> None:
+        with self._lock:
+            self._samples[endpoint].append(seconds)
+
+    def quantile(self, endpoint: str, q: float) -> Optional[float]:
+        """Estimate a quantile of an endpoint's latency
+
+        :param endpoint: The endpoint name
+        :param q: The quantile, between 0 and 1
+        :return: The latency in seconds, or None if too few requests have been observed
+        """
+        with self._lock:
+            samples = sorted(self._samples[endpoint])
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+class RequestPolicy:
+    """Timeouts, deadline, retries and hedging applied to every request"""
+
+    def __init__(self, connect_timeout: float = DEFAULT_CONNECT_TIMEOUT, read_timeout: float = DEFAULT_READ_TIMEOUT,
+                 endpoint_timeouts: Optional[Dict[str, float]] = None, deadline: Optional[float] = None,
+                 retries: int = DEFAULT_RETRIES, hedge: bool = False, hedge_endpoints: Iterable[str] = (),
+                 hedge_quantile: float = DEFAULT_HEDGE_QUANTILE):
+        """
+        :param connect_timeout: The number of seconds to wait for a connection
+        :param read_timeout: The number of seconds to wait for the server to send data
+        :param endpoint_timeouts: Read timeouts for endpoints matching shell-style patterns, such as '*/settings/'
+        :param deadline: The number of seconds from now after which no request may run
+        :param retries: How many times an idempotent request that failed is retried
+        :param hedge: Whether to send a duplicate of slow GETs
+        :param hedge_endpoints: Only hedge GETs to endpoints matching these patterns; all GETs if empty
+        :param hedge_quantile: The quantile of an endpoint's latency after which a GET is hedged
+        """
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.endpoint_timeouts = dict(endpoint_timeouts or {})
+        self.deadline = time.monotonic() + deadline if deadline is not None else None
+        self.retries = retries
+        self.hedge_endpoints = list(hedge_endpoints)
+        self.hedge = hedge or bool(self.hedge_endpoints)
+        self.hedge_quantile = hedge_quantile
+        self.latencies = LatencyWindow()
+        self.hedged = 0
+        self.hedge_candidates = 0  # GETs that could have been hedged
+        self.hedges_won = 0
+        self.retried = 0
+
+    def remaining(self) -> Optional[float]:
+        """Get the number of seconds left until the deadline, or None if there is none"""
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def timeout(self, endpoint: str) -> Tuple[float, float]:
+        """Get the connect and read timeouts of a request, shortened so that it cannot outlast the deadline
+
+        :param endpoint: The endpoint name of the request
+        :raises DeadlineExceeded: If the deadline has already passed
+        :return: A (connect, read) timeout tuple as accepted by requests
+        """
+        read = next((seconds for pattern, seconds in self.endpoint_timeouts.items()
+                     if fnmatch.fnmatchcase(endpoint, pattern)), self.read_timeout)
+        connect = self.connect_timeout
+        remaining = self.remaining()
+        if remaining is not None:
+            if remaining <= 0:
+                raise DeadlineExceeded(f'job deadline passed before {endpoint}')
+            connect, read = min(connect, remaining), min(read, remaining)
+        return connect, read
+
+    def hedge_delay(self, method: str, endpoint: str) -> Optional[float]:
+        """Get how long to wait for a request before sending a duplicate
+
+        :param method: The HTTP method of the request
+        :param endpoint: The endpoint name of the request
+        :return: The delay in seconds, or None if the request should not be hedged
+        """
+        if not self.hedge or method != 'GET':
+            return None
+        if self.hedge_endpoints and not any(fnmatch.fnmatchcase(endpoint, p) for p in self.hedge_endpoints):
+            return None
+        return self.latencies.quantile(endpoint, self.hedge_quantile)
+
+    def within_hedge_budget(self) -> bool:
+        """Check whether another duplicate may be sent without hedging more GETs than the quantile implies
+
+        :return: Whether fewer than 1 - hedge_quantile of the GETs that could have been hedged were
+        """
+        return self.hedged < (1 - self.hedge_quantile) * self.hedge_candidates
+
+    def backoff(self, attempt: int) -> float:
+        """Get a random delay before retrying, with an exponentially growing cap, that ends before the deadline
+
+        :param attempt: The number of attempts made so far, starting at 1
+        :return: The number of seconds to wait
+        """
+        delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+        remaining = self.remaining()
+        return delay if remaining is None else max(min(delay, remaining), 0.0)
+
+
+_original_send = None
+_hedge_executor = None
+
+
+def _discard(future) -> None:
+    """Release the connection of the losing copy of a hedged request"""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def install(policy: RequestPolicy, workers: int = DEFAULT_CONCURRENCY) -> None:
+    """Apply a request policy to every request sent through requests in this process
+
+    Requests with an explicit timeout keep it. Requests with a streamed body cannot be replayed, so they are never
+    retried.
+
+    :param policy: The policy to apply
+    :param workers: The number of threads of the script sending requests at once, which hedged GETs are sized for
+    """
+    global _original_send, _hedge_executor
+    if _original_send is not None:
+        return
+    _original_send = requests.Session.send
+    # A primary and a hedge copy for each worker, and for the page prefetching thread
+    _hedge_executor = ThreadPoolExecutor(max_workers=2 * (workers + 1), thread_name_prefix='hedge')
+
+    def timed_send(session, request, endpoint, sent_at=None, **kwargs):
+        start = time.perf_counter()
+        if sent_at is not None:
+            sent_at.append(start)
+        response = _original_send(session, request, **kwargs)
+        policy.latencies.observe(endpoint, time.perf_counter() - start)
+        return response
+
+    def hedged_send(session, request, endpoint, delay, **kwargs):
+        policy.hedge_candidates += 1
+        sent_at = []
+        futures = [_hedge_executor.submit(timed_send, session, request, endpoint, sent_at, **kwargs)]
+        # The delay runs from when the primary is sent, so time spent waiting for a free thread never triggers a hedge
+        timeout = delay
+        while True:
+            done, _ = wait(futures, timeout=timeout)
+            if done or (sent_at and time.perf_counter() - sent_at[0] >= delay):
+                break
+            timeout = delay - (time.perf_counter() - sent_at[0]) if sent_at else delay
+        if not done and policy.within_hedge_budget():
+            policy.hedged += 1
+            futures.append(_hedge_executor.submit(timed_send, session, request.copy(), endpoint, **kwargs))
+        pending = list(futures)
+        while True:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                if future.exception() is None or not pending:
+                    for other in pending:
+                        other.add_done_callback(_discard)
+                    if future is not futures[0]:
+                        policy.hedges_won += 1
+                    return future.result()
+
+    def send(session, request, **kwargs):
+        endpoint = endpoint_name(request.method, request.url)
+        replayable = request.body is None or isinstance(request.body, (bytes, str))
+        attempts = 1 + (policy.retries if request.method in IDEMPOTENT_METHODS and replayable else 0)
+        for attempt in range(1, attempts + 1):
+            timeout = policy.timeout(endpoint)
+            send_kwargs = dict(kwargs, timeout=kwargs.get('timeout') or timeout)
+            delay = None if kwargs.get('stream') else policy.hedge_delay(request.method, endpoint)
+            try:
+                if delay is None:
+                    response = timed_send(session, request, endpoint, **send_kwargs)
+                else:
+                    response = hedged_send(session, request, endpoint, delay, **send_kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= attempts:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt >= attempts:
+                    return response
+                response.close()
+            policy.retried += 1
+            time.sleep(policy.backoff(attempt))
+
+    requests.Session.send = send
+
+
+def parse_endpoint_timeout(value: str) -> Tuple[str, float]:
+    """Parse a PATTERN=SECONDS option value"""
+    pattern, sep, seconds = value.rpartition('=')
+    try:
+        if not sep or not pattern:
+            raise ValueError
+        return pattern, float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected PATTERN=SECONDS, got {value!r}') from None
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the timeout, deadline, retry and hedging options to a script's argument parser
+
+    :param parser: The script's argument parser
+    """
+    group = parser.add_argument_group('timeouts')
+    group.add_argument('--connect-timeout', type=float, default=DEFAULT_CONNECT_TIMEOUT, metavar='SECONDS',
+                       help=f'seconds to wait for a connection (default: {DEFAULT_CONNECT_TIMEOUT:g})')
+    group.add_argument('--read-timeout', type=float, default=DEFAULT_READ_TIMEOUT, metavar='SECONDS',
+                       help=f'seconds to wait for the API to send data (default: {DEFAULT_READ_TIMEOUT:g})')
+    group.add_argument('--endpoint-timeout', type=parse_endpoint_timeout, action='append', default=[],
+                       metavar='PATTERN=SECONDS',
+                       help="read timeout for endpoints matching a pattern, such as 'GET */settings/=10' (repeatable)")
+    group.add_argument('--deadline', type=float, metavar='SECONDS',
+                       help='fail every request not finished this many seconds after the script started')
+    group.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                       help=f'retries of a GET that timed out or failed with a 5xx error (default: {DEFAULT_RETRIES})')
+    group.add_argument('--hedge', action='store_true',
+                       help='send a duplicate of a GET that is slower than most recent requests to the same endpoint')
+    group.add_argument('--hedge-endpoint', type=str, action='append', default=[], metavar='PATTERN',
+                       help='only hedge GETs to endpoints matching this pattern, implies --hedge (repeatable)')
+    group.add_argument('--hedge-quantile', type=float, default=DEFAULT_HEDGE_QUANTILE,
+                       help=f'latency quantile after which a GET is hedged (default: {DEFAULT_HEDGE_QUANTILE:g})')
+
+
+def from_args(args: argparse.Namespace) -> RequestPolicy:
+    """Build the request policy of a script
+
+    :param args: The parsed arguments, including those added by add_arguments
+    :return: A request policy; its deadline starts now
+    """
+    return RequestPolicy(connect_timeout=args.connect_timeout,
+                         read_timeout=args.read_timeout,
+                         endpoint_timeouts=dict(args.endpoint_timeout),
+                         deadline=args.deadline,
+                         retries=args.retries,
+                         hedge=args.hedge,
+                         hedge_endpoints=args.hedge_endpoint,
+                         hedge_quantile=args.hedge_quantile)
+
+
+def start(args: argparse.Namespace) -> RequestPolicy:
+    """Apply timeouts, the deadline, retries and hedging to every request made by a script
+
+    :param args: The parsed arguments, including those added by add_arguments, and the script's --concurrency or
+        --workers option if it has one
+    :return: The installed request policy
+    """
+    policy = from_args(args)
+    install(policy, getattr(args, 'concurrency', None) or getattr(args, 'workers', None) or DEFAULT_CONCURRENCY)
+    return policy
@@ -0,0 +1,170 @@
+"""zonefile.py: validate zone files locally and stream them to /v2/zone/file/
+
+Before a zone file is uploaded it is parsed once to check that it declares an $ORIGIN, to count its records and to hash
+its content. The hash of every successful upload is remembered per team, so unchanged zone files can be skipped on the
+next run. Zone files are streamed from disk with a Content-Length, never with chunked transfer-encoding; compressed
+uploads are gzipped into a temporary file first.
+"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import zlib
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator
+
+from detectify.inventory import cache_dir, team_id
+
+CHUNK_SIZE = 64 * 1024
+
+_ORIGIN = re.compile(r'^\$ORIGIN\s+(\S+)', re.IGNORECASE)
+_DOMAIN = re.compile(r'^(?=.{1,254}$)([a-z0-9_](?:[a-z0-9_-]{0,61}[a-z0-9])?\.)+[a-z0-9-]{2,63}\.?$', re.IGNORECASE)
+
+
+class ZoneFileError(ValueError):
+    """Raised when a zone file fails local validation"""
+
+
+class ZoneFile:
+    """The result of parsing a zone file locally"""
+
+    def __init__(self, path: str, origin: str, records: int, sha256: str):
+        self.path = path
+        self.origin = origin
+        self.records = records
+        self.sha256 = sha256
+
+
+def _strip_comment(line: str) -> str:
+    in_quotes = False
+    for i, char in enumerate(line):
+        if char == '"':
+            in_quotes = not in_quotes
+        elif char == ';' and not in_quotes:
+            return line[:i]
+    return line
+
+
+def parse_zone_file(path: str) -> ZoneFile:
+    """Validate a zone file and count its records
+
+    Records that span several lines in parentheses are counted once. The first $ORIGIN directive is taken as the
+    origin of the zone.
+
+    :param path: The path to a zone file
+    :raises ZoneFileError: If the zone file has no valid $ORIGIN or no records
+    :return: The parsed zone file
+    """
+    digest = hashlib.sha256()
+    origin = None
+    records = 0
+    depth = 0
+    with open(path, 'rb') as f:
+        for raw_line in f:
+            digest.update(raw_line)
+            line = _strip_comment(raw_line.decode('utf-8', errors='replace')).strip()
+            if not line:
+                continue
+            if depth == 0:
+                match = _ORIGIN.match(line)
+                if match:
+                    if origin is None:
+                        origin = match.group(1)
+                elif not line.startswith('$'):
+                    records += 1
+            depth = max(depth + line.count('(') - line.count(')'), 0)
+
+    if origin is None:
+        raise ZoneFileError(f'{path} does not specify an $ORIGIN')
+    if not _DOMAIN.match(origin):
+        raise ZoneFileError(f'{path} has an invalid $ORIGIN {origin}')
+    if records == 0:
+        raise ZoneFileError(f'{path} does not contain any records')
+    return ZoneFile(path, origin.rstrip('.').lower(), records, digest.hexdigest())
+
+
+def iter_chunks(path: str, compress: bool = False) -> Iterator[bytes]:
+    """Read a file in chunks, optionally gzipping them on the fly
+
+    :param path: The path to the file
+    :param compress: Whether to gzip the chunks on the fly
+    :return: An iterator of byte strings
+    """
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None  # wbits 16+ writes a gzip header
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if compressor:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+            yield chunk
+    if compressor:
+        yield compressor.flush()
+
+
+@contextmanager
+def open_upload(path: str, compress: bool = False) -> Iterator[BinaryIO]:
+    """Open a zone file as a request body whose length is known, so requests sends it with a Content-Length
+
+    :param path: The path to the zone file
+    :param compress: Whether to gzip the zone file, into a temporary file that is removed afterwards
+    :return: A binary file object positioned at the start of the body
+    """
+    if not compress:
+        with open(path, 'rb') as f:
+            yield f
+        return
+    with tempfile.TemporaryFile() as f:
+        for chunk in iter_chunks(path, compress=True):
+            f.write(chunk)
+        f.seek(0)
+        yield f
+
+
+class UploadHistory:
+    """The content hashes of zone files that were uploaded successfully, per team and origin
+
+    The history is a small JSON file in the cache directory. It is safe to update from several threads.
+    """
+
+    def __init__(self, key: str, path: str = None):
+        """
+        :param key: A valid Detectify API key
+        :param path: The JSON file to use, defaults to zone_uploads.json in the cache directory
+        """
+        self.team = team_id(key)
+        self.path = path or os.path.join(cache_dir(), 'zone_uploads.json')
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self._history = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._history = {}
+
+    def is_unchanged(self, zone: ZoneFile) -> bool:
+        """Check whether a zone file has the same content as the last successful upload for its origin
+
+        :param zone: A parsed zone file
+        :return: True if the zone file was already uploaded
+        """
+        with self._lock:
+            return self._history.get(self.team, {}).get(zone.origin) == zone.sha256
+
+    def record(self, zone: ZoneFile) -> None:
+        """Remember a successful upload
+
+        :param zone: A parsed zone file that was uploaded
+        """
+        with self._lock:
+            self._history.setdefault(self.team, {})[zone.origin] = zone.sha256
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(f'{self.path}.tmp', 'w') as f:
+                json.dump(self._history, f)
+            os.replace(f'{self.path}.tmp', self.path)
+